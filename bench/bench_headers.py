@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+
+#=======================================================================
+# Micro-benchmark: request header rewriting.
+#
+# Compares the compiled `HeaderRewriter` with the `ProxyApp.mod_headers`
+# method it replaced, on a typical browser request and on a header-heavy
+# one (many cookies and custom headers).
+#=======================================================================
+
+# Standard library
+import argparse
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Application modules
+from txcasproxy.headers import (
+    DROP, REPLACE, forwarded_header_rules, HeaderRewriter)
+
+PROXIED_NETLOC = 'backend.example.org:8443'
+
+
+def legacy_mod_headers(h, proxied_netloc=PROXIED_NETLOC):
+    """
+    `ProxyApp.mod_headers` before the header rewriting rules (without the
+    dead Referer code).
+    """
+    keymap = {}
+    for k,v in h.iteritems():
+        key = k.lower()
+        if key in keymap:
+            keymap[key].append(k)
+        else:
+            keymap[key] = [k]
+    if 'host' in keymap:
+        for k in keymap['host']:
+            h[k] = [proxied_netloc]
+    if 'origin' in keymap:
+        for k in keymap['origin']:
+            h[k] = [proxied_netloc]
+    if 'content-length' in keymap:
+        for k in keymap['content-length']:
+            del h[k]
+    if 'transfer-encoding' in keymap:
+        for k in keymap['transfer-encoding']:
+            del h[k]
+    if 'referer' in keymap:
+        for k in keymap['referer']:
+            del h[k]
+    return h
+
+
+class FakeRequest(object):
+
+    def getClientIP(self):
+        return '192.0.2.10'
+
+    def isSecure(self):
+        return True
+
+    def getHeader(self, name):
+        return 'proxy.example.org'
+
+
+def browser_headers():
+    return [
+        ('Host', ['proxy.example.org']),
+        ('User-Agent', ['Mozilla/5.0 (X11; Linux x86_64; rv:91.0) Gecko/20100101 Firefox/91.0']),
+        ('Accept', ['text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8']),
+        ('Accept-Language', ['en-US,en;q=0.5']),
+        ('Accept-Encoding', ['gzip, deflate, br']),
+        ('Referer', ['https://proxy.example.org/app/index.html']),
+        ('Connection', ['keep-alive']),
+        ('Cookie', ['TWISTED_SESSION=0123456789abcdef0123456789abcdef']),
+        ('Upgrade-Insecure-Requests', ['1']),
+    ]
+
+def heavy_headers():
+    headers = browser_headers()
+    headers.append(('Origin', ['https://proxy.example.org']))
+    headers.append(('Content-Length', ['1234']))
+    headers.append(('X-Forwarded-For', ['198.51.100.7']))
+    headers.extend(
+        ('Cookie-%d' % n, ['name%d=%s' % (n, 'v' * 40)]) for n in range(20))
+    headers.extend(
+        ('X-Custom-Header-%d' % n, ['value-%d' % n]) for n in range(30))
+    return headers
+
+def make_rewriter(forwarded):
+    rules = [
+        (REPLACE, 'Host', PROXIED_NETLOC),
+        (REPLACE, 'Origin', PROXIED_NETLOC),
+        (DROP, 'Content-Length', None),
+        (DROP, 'Referer', None),
+        (DROP, 'REMOTE_USER', None),
+        (DROP, 'Remote-User', None),
+    ]
+    if forwarded:
+        rules.extend(forwarded_header_rules())
+    return HeaderRewriter(rules)
+
+def measure(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def main(args):
+    request = FakeRequest()
+    rewriter = make_rewriter(forwarded=False)
+    forwarding_rewriter = make_rewriter(forwarded=True)
+    print "%-10s %-28s %12s" % ('headers', 'implementation', 'usec/request')
+    for label, headers in (('browser', browser_headers()), ('heavy', heavy_headers())):
+        candidates = [
+            ('mod_headers (old)', lambda: legacy_mod_headers(dict(headers))),
+            ('HeaderRewriter', lambda: rewriter.rewrite(headers, request)),
+            ('HeaderRewriter + X-Fwd-*', lambda: forwarding_rewriter.rewrite(headers, request)),
+        ]
+        for name, func in candidates:
+            seconds = measure(func, args.number, args.repeat)
+            print "%-10s %-28s %12.2f" % (label, name, seconds * 1e6)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Header rewriting micro-benchmark.")
+    parser.add_argument(
+        '--number',
+        action='store',
+        type=int,
+        default=20000,
+        help='Calls per timing run.')
+    parser.add_argument(
+        '--repeat',
+        action='store',
+        type=int,
+        default=5,
+        help='Timing runs (the fastest is reported).')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+
+#=======================================================================
+# Memory benchmark: authenticated sessions held in memory.
+#
+# Fills a session store with many sessions for fewer users (each user has
+# several browser sessions and a sizeable set of attributes) and reports
+# the memory used per session, for the dict based session records the
+# memory store used to keep and for the current compact records.  Each
+# store is measured in a process of its own.
+#=======================================================================
+
+# Standard library
+import argparse
+import os.path
+import random
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LegacyMemorySessionStore(object):
+    """
+    `MemorySessionStore` before compact session records: a dict per session
+    holding the attribute map parsed for that session.
+    """
+
+    def __init__(self):
+        self.valid_sessions = {}
+        self.logout_tickets = {}
+
+    def add(self, uid, username, ticket, attributes):
+        valid_sessions = self.valid_sessions
+        if uid not in valid_sessions:
+            valid_sessions[uid] = {}
+        valid_sessions[uid].update({
+            'username': username,
+            'ticket': ticket,
+            'attributes': attributes})
+        uids = self.logout_tickets.setdefault(ticket, [])
+        if uid not in uids:
+            uids.append(uid)
+
+
+def fresh(s):
+    """
+    Return a new string object equal to `s`, as parsing a CAS response
+    would.
+    """
+    return (s + '.')[:-1]
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not found.")
+
+def make_users(count, groups, group_pool, seed=42):
+    rng = random.Random(seed)
+    pool = ['cn=group-%04d,ou=groups,dc=example,dc=org' % n for n in range(group_pool)]
+    users = []
+    for n in range(count):
+        username = 'user%06d' % n
+        users.append((username, {
+            'mail': ['%s@example.org' % username],
+            'displayName': ['User Number %d' % n],
+            'eduPersonAffiliation': ['member', 'staff'],
+            'memberOf': rng.sample(pool, groups),
+        }))
+    return users
+
+def parsed_attributes(attributes):
+    """
+    A fresh attribute map, as `ProxyApp.parse_sv_results` builds for each
+    validation.
+    """
+    return dict(
+        (fresh(name), [fresh(value) for value in values])
+        for name, values in attributes.iteritems())
+
+def measure(variant, sessions, users, groups, group_pool):
+    """
+    Fill a store in this process.  Return the bytes used per session.
+    """
+    if variant == 'legacy':
+        store = LegacyMemorySessionStore()
+    else:
+        from txcasproxy.sessionstore import MemorySessionStore
+        store = MemorySessionStore()
+    user_list = make_users(users, groups, group_pool)
+    keys = [('%032x' % n, 'ST-%d-%s-cas.example.org' % (n, 'x' * 20)) for n in range(sessions)]
+    before = rss()
+    for n, (uid, ticket) in enumerate(keys):
+        username, attributes = user_list[n % users]
+        store.add(uid, fresh(username), ticket, parsed_attributes(attributes))
+    after = rss()
+    return float(after - before) / sessions
+
+def main(args):
+    if args.variant is not None:
+        print measure(args.variant, args.sessions, args.users, args.groups, args.group_pool)
+        return
+    print "%d sessions, %d users, %d groups per user" % (args.sessions, args.users, args.groups)
+    print "%-10s %16s" % ('records', 'bytes/session')
+    results = {}
+    for variant in ('legacy', 'compact'):
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__),
+            '--variant', variant,
+            '--sessions', str(args.sessions),
+            '--users', str(args.users),
+            '--groups', str(args.groups),
+            '--group-pool', str(args.group_pool)])
+        results[variant] = float(output.strip())
+        print "%-10s %16.0f" % (variant, results[variant])
+    print "%-10s %15.1fx" % ('ratio', results['legacy'] / results['compact'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Session memory benchmark.")
+    parser.add_argument(
+        '--sessions',
+        action='store',
+        type=int,
+        default=100000,
+        help='Authenticated sessions to create.')
+    parser.add_argument(
+        '--users',
+        action='store',
+        type=int,
+        default=25000,
+        help='Distinct users the sessions belong to.')
+    parser.add_argument(
+        '--groups',
+        action='store',
+        type=int,
+        default=30,
+        help='Group memberships per user.')
+    parser.add_argument(
+        '--group-pool',
+        action='store',
+        type=int,
+        default=2000,
+        help='Distinct groups.')
+    parser.add_argument(
+        '--variant',
+        action='store',
+        choices=('legacy', 'compact'),
+        default=None,
+        help='Internal.  Measure one kind of session record in this process.')
+
+    args = parser.parse_args()
+    main(args)
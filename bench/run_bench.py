@@ -0,0 +1,588 @@
+#! /usr/bin/env python
+
+#=======================================================================
+# End-to-end benchmark for txcasproxy.
+#
+# Starts the stub CAS and proxied service (`stubs.py`) and the proxy
+# itself (`twistd casproxy`) as separate processes, then drives load
+# through the proxy for each scenario and reports requests/sec, latency
+# percentiles and the peak RSS of the proxy.
+#=======================================================================
+
+# Standard library
+import argparse
+import datetime
+import json
+import os
+import os.path
+import socket
+import subprocess
+import sys
+import time
+from StringIO import StringIO
+import urlparse
+
+# External modules
+from twisted.internet import defer, task
+from twisted.internet.protocol import Protocol
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    PotentialDataLoss,
+    ResponseDone)
+from twisted.web.http_headers import Headers
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_root = os.path.dirname(bench_dir)
+
+LOGOUT_REQUEST = """<samlp:LogoutRequest
+    xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"
+    xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"
+    ID="LR-{n}" Version="2.0" IssueInstant="{instant}">
+  <saml:NameID>@NOT_USED@</saml:NameID>
+  <samlp:SessionIndex>{ticket}</samlp:SessionIndex>
+</samlp:LogoutRequest>
+"""
+
+
+class BenchError(Exception):
+    pass
+
+
+#-----------------------------------------------------------------------
+# Processes
+#-----------------------------------------------------------------------
+
+def wait_for_port(port, process, timeout=20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise BenchError("Process exited with status {0} before listening on port {1}.".format(
+                process.returncode, port))
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 0.5)
+        except socket.error:
+            time.sleep(0.1)
+        else:
+            sock.close()
+            return
+    raise BenchError("Timed out waiting for port {0}.".format(port))
+
+def start_processes(args, output):
+    env = dict(os.environ)
+    pythonpath = [repo_root]
+    if env.get('PYTHONPATH'):
+        pythonpath.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(pythonpath)
+    stubs = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(bench_dir, 'stubs.py'),
+            '--cas-port', str(args.cas_port),
+            '--backend-port', str(args.backend_port)],
+        env=env,
+        stdout=output,
+        stderr=subprocess.STDOUT)
+    processes = [stubs]
+    try:
+        wait_for_port(args.cas_port, stubs)
+        wait_for_port(args.backend_port, stubs)
+        proxy = subprocess.Popen(
+            [
+                sys.executable,
+                '-c',
+                'from twisted.scripts.twistd import run; run()',
+                '--nodaemon',
+                '--pidfile=',
+                'casproxy',
+                '--endpoint', 'tcp:{0}:interface=127.0.0.1'.format(args.proxy_port),
+                '--proxied-url', 'http://127.0.0.1:{0}/app'.format(args.backend_port),
+                '--cas-login', 'http://127.0.0.1:{0}/cas/login'.format(args.cas_port),
+                '--fqdn', '127.0.0.1',
+                '--log-level', 'warn'] + (args.proxy_arg or []),
+            cwd=repo_root,
+            env=env,
+            stdout=output,
+            stderr=subprocess.STDOUT)
+        processes.append(proxy)
+        wait_for_port(args.proxy_port, proxy)
+    except Exception:
+        stop_processes(processes)
+        raise
+    return processes
+
+def stop_processes(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    deadline = time.time() + 10.0
+    for process in processes:
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+def process_tree(pid):
+    """
+    Return `pid` and the PIDs of its descendants (worker processes).
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(entry)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The command name may contain spaces; the PPID follows it.
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    return pids
+
+def reset_peak_rss(pid):
+    """
+    Reset the peak RSS of the proxy processes (Linux 4.0+).
+    Return False if it could not be reset.
+    """
+    try:
+        for p in process_tree(pid):
+            with open('/proc/{0}/clear_refs'.format(p), 'w') as f:
+                f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+def peak_rss(pid):
+    """
+    Return the sum of the peak RSS (bytes) of the proxy processes, or None
+    if it is not available.
+    """
+    total = 0
+    try:
+        for p in process_tree(pid):
+            with open('/proc/{0}/status'.format(p)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        return None
+    return total
+
+
+#-----------------------------------------------------------------------
+# Client
+#-----------------------------------------------------------------------
+
+class CountingReceiver(Protocol):
+    """
+    Read a response body, keeping only its length (or, for small bodies,
+    its content).
+    """
+
+    def __init__(self, finished, keep):
+        self.finished = finished
+        self.keep = keep
+        self.length = 0
+        self.chunks = []
+
+    def dataReceived(self, data):
+        self.length += len(data)
+        if self.keep:
+            self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback((self.length, ''.join(self.chunks)))
+        else:
+            self.finished.errback(reason)
+
+
+class VirtualUser(object):
+    """
+    A user agent with its own cookies.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.cookies = {}
+        self.ticket = None
+
+    def cookie_header(self):
+        return '; '.join('%s=%s' % item for item in self.cookies.items())
+
+    def update_cookies(self, headers):
+        for value in headers.getRawHeaders('set-cookie', []):
+            pair = value.split(';', 1)[0]
+            if '=' in pair:
+                name, value = pair.split('=', 1)
+                self.cookies[name.strip()] = value.strip()
+
+
+class BenchClient(object):
+
+    def __init__(self, reactor, proxy_port, concurrency):
+        self.reactor = reactor
+        self.proxy_url = 'http://127.0.0.1:{0}'.format(proxy_port)
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = concurrency * 2
+        self.agent = Agent(reactor, pool=self.pool)
+        self.logouts = 0
+
+    @defer.inlineCallbacks
+    def fetch(self, method, url, user=None, expect=200, body=None, content_type=None, keep=False):
+        """
+        Make a request and read the whole response body.
+        Fire with `(response, length, content)`.
+        """
+        headers = Headers()
+        if user is not None and user.cookies:
+            headers.setRawHeaders('Cookie', [user.cookie_header()])
+        if content_type is not None:
+            headers.setRawHeaders('Content-Type', [content_type])
+        producer = None
+        if body is not None:
+            producer = FileBodyProducer(StringIO(body))
+        response = yield self.agent.request(method, url, headers, producer)
+        finished = defer.Deferred()
+        response.deliverBody(CountingReceiver(finished, keep))
+        length, content = yield finished
+        if user is not None:
+            user.update_cookies(response.headers)
+        if response.code != expect:
+            raise BenchError("{0} {1} returned {2}, expected {3}.".format(
+                method, url, response.code, expect))
+        defer.returnValue((response, length, content))
+
+    @defer.inlineCallbacks
+    def login(self, user):
+        """
+        Log `user` in through CAS: the proxy redirects to CAS, CAS redirects
+        back with a service ticket, and the proxy validates the ticket.
+        """
+        user.cookies.clear()
+        response, _, _ = yield self.fetch(
+            'GET', self.proxy_url + '/index.html', user, expect=302)
+        location = response.headers.getRawHeaders('location')[0]
+        response, _, _ = yield self.fetch('GET', location, expect=302)
+        location = response.headers.getRawHeaders('location')[0]
+        query = urlparse.parse_qs(urlparse.urlparse(location).query)
+        user.ticket = query['ticket'][0]
+        yield self.fetch('GET', location, user, expect=302)
+
+    def logout(self, user):
+        """
+        Send the SAML single logout request CAS would send for `user`.
+        """
+        self.logouts += 1
+        instant = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        body = LOGOUT_REQUEST.format(n=self.logouts, instant=instant, ticket=user.ticket)
+        return self.fetch('POST', self.proxy_url + '/', body=body, content_type='text/xml')
+
+
+#-----------------------------------------------------------------------
+# Scenarios
+#-----------------------------------------------------------------------
+
+class Scenario(object):
+    """
+    A benchmark scenario.  Subclasses define `operation(user)`, which
+    returns a deferred that fires when one operation is done.  `run()`
+    performs one operation and fires with the latency to record.
+    """
+    name = None
+    description = None
+    # Whether users log in before the scenario is timed.
+    needs_session = True
+
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.bytes = 0
+
+    def run(self, user):
+        start = time.time()
+        d = self.operation(user)
+        d.addCallback(lambda ignored: time.time() - start)
+        return d
+
+
+class GetScenario(Scenario):
+    name = 'get'
+    description = 'Authenticated GET of a small page.'
+
+    def operation(self, user):
+        return self.client.fetch('GET', self.client.proxy_url + '/index.html', user)
+
+
+class DownloadScenario(Scenario):
+    name = 'download'
+    description = 'Authenticated GET of a large response.'
+
+    @defer.inlineCallbacks
+    def operation(self, user):
+        size = self.args.download_size
+        _, length, _ = yield self.client.fetch(
+            'GET', self.client.proxy_url + '/large?size={0}'.format(size), user)
+        if length != size:
+            raise BenchError("Downloaded {0} bytes, expected {1}.".format(length, size))
+        self.bytes += length
+
+
+class UploadScenario(Scenario):
+    name = 'upload'
+    description = 'Authenticated POST of a large request body.'
+
+    def __init__(self, client, args):
+        Scenario.__init__(self, client, args)
+        self.payload = '\0' * args.upload_size
+
+    @defer.inlineCallbacks
+    def operation(self, user):
+        payload = self.payload
+        _, _, content = yield self.client.fetch(
+            'POST', self.client.proxy_url + '/upload', user,
+            body=payload, content_type='application/octet-stream', keep=True)
+        if content.strip() != str(len(payload)):
+            raise BenchError("Service received {0} bytes, expected {1}.".format(
+                content.strip(), len(payload)))
+        self.bytes += len(payload)
+
+
+class LoginScenario(Scenario):
+    name = 'login'
+    description = 'First time login: CAS redirects and ticket validation.'
+    needs_session = False
+
+    def operation(self, user):
+        return self.client.login(user)
+
+
+class LogoutScenario(Scenario):
+    name = 'logout'
+    description = 'SAML single logout (only the logout request is timed).'
+    needs_session = False
+
+    @defer.inlineCallbacks
+    def run(self, user):
+        yield self.client.login(user)
+        start = time.time()
+        yield self.client.logout(user)
+        defer.returnValue(time.time() - start)
+
+
+scenarios = [
+    GetScenario,
+    DownloadScenario,
+    UploadScenario,
+    LoginScenario,
+    LogoutScenario,
+]
+scenario_map = dict((s.name, s) for s in scenarios)
+
+
+#-----------------------------------------------------------------------
+# Runner
+#-----------------------------------------------------------------------
+
+def percentile(ordered, fraction):
+    if len(ordered) == 0:
+        return None
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+@defer.inlineCallbacks
+def run_scenario(client, scenario, users, total, proxy_pid):
+    if scenario.needs_session:
+        yield defer.gatherResults([client.login(user) for user in users])
+    rss_reset = reset_peak_rss(proxy_pid)
+    latencies = []
+    errors = []
+    remaining = [total]
+
+    @defer.inlineCallbacks
+    def drive(user):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            try:
+                latency = yield scenario.run(user)
+            except Exception as ex:
+                errors.append(str(ex))
+            else:
+                latencies.append(latency)
+
+    start = time.time()
+    yield defer.gatherResults([drive(user) for user in users])
+    elapsed = time.time() - start
+    latencies.sort()
+    result = {
+        'scenario': scenario.name,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed > 0 else None,
+        'p50_ms': None,
+        'p90_ms': None,
+        'p99_ms': None,
+        'max_ms': None,
+        'mb_per_second': (scenario.bytes / 1048576.0) / elapsed if scenario.bytes else None,
+        'peak_rss_mb': None,
+        'peak_rss_cumulative': not rss_reset,
+    }
+    for key, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99), ('max_ms', 1.0)):
+        value = percentile(latencies, fraction)
+        if value is not None:
+            result[key] = value * 1000.0
+    rss = peak_rss(proxy_pid)
+    if rss is not None:
+        result['peak_rss_mb'] = rss / 1048576.0
+    if errors:
+        result['first_error'] = errors[0]
+    defer.returnValue(result)
+
+def format_value(value, fmt):
+    if value is None:
+        return '-'
+    return fmt % value
+
+def print_report(results):
+    columns = [
+        ('scenario', 'scenario', '%s', 10),
+        ('requests', 'requests', '%d', 9),
+        ('errors', 'errors', '%d', 7),
+        ('req/s', 'requests_per_second', '%.1f', 9),
+        ('p50 ms', 'p50_ms', '%.1f', 9),
+        ('p90 ms', 'p90_ms', '%.1f', 9),
+        ('p99 ms', 'p99_ms', '%.1f', 9),
+        ('max ms', 'max_ms', '%.1f', 9),
+        ('MB/s', 'mb_per_second', '%.1f', 8),
+        ('peak RSS MB', 'peak_rss_mb', '%.1f', 12),
+    ]
+    print ' '.join(title.rjust(width) for title, _, _, width in columns)
+    for result in results:
+        print ' '.join(
+            format_value(result[key], fmt).rjust(width) for _, key, fmt, width in columns)
+    for result in results:
+        if result['peak_rss_cumulative']:
+            print "Note: peak RSS for '%s' includes earlier scenarios." % result['scenario']
+        if 'first_error' in result:
+            print "First error in '%s': %s" % (result['scenario'], result['first_error'])
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo_root, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    if args.proxy_output is None:
+        output = open(os.devnull, 'w')
+    else:
+        output = open(args.proxy_output, 'a')
+    processes = start_processes(args, output)
+    proxy_pid = processes[-1].pid
+    client = BenchClient(reactor, args.proxy_port, args.concurrency)
+    results = []
+    try:
+        for name in args.scenario:
+            scenario = scenario_map[name](client, args)
+            users = [VirtualUser(n) for n in range(args.concurrency)]
+            result = yield run_scenario(client, scenario, users, args.requests, proxy_pid)
+            results.append(result)
+    finally:
+        yield client.pool.closeCachedConnections()
+        stop_processes(processes)
+        output.close()
+    print_report(results)
+    if args.json is not None:
+        report = {
+            'revision': git_revision(),
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'download_size': args.download_size,
+            'upload_size': args.upload_size,
+            'proxy_args': args.proxy_arg or [],
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="End-to-end txcasproxy benchmark.",
+        epilog="Scenarios: " + '; '.join(
+            "'%s': %s" % (s.name, s.description) for s in scenarios))
+    parser.add_argument(
+        '--scenario',
+        action='store',
+        nargs='+',
+        choices=[s.name for s in scenarios],
+        default=[s.name for s in scenarios],
+        help='Run SCENARIO (default all).')
+    parser.add_argument(
+        '--concurrency',
+        action='store',
+        type=int,
+        default=20,
+        help='Number of concurrent user agents.')
+    parser.add_argument(
+        '--requests',
+        action='store',
+        type=int,
+        default=2000,
+        help='Number of timed operations per scenario.')
+    parser.add_argument(
+        '--download-size',
+        action='store',
+        type=int,
+        default=10 * 1048576,
+        help='Size of the response body in the download scenario.')
+    parser.add_argument(
+        '--upload-size',
+        action='store',
+        type=int,
+        default=1048576,
+        help='Size of the request body in the upload scenario.')
+    parser.add_argument(
+        '--proxy-port',
+        action='store',
+        type=int,
+        default=9400,
+        help='Port the proxy listens on.')
+    parser.add_argument(
+        '--cas-port',
+        action='store',
+        type=int,
+        default=9401,
+        help='Port the stub CAS listens on.')
+    parser.add_argument(
+        '--backend-port',
+        action='store',
+        type=int,
+        default=9402,
+        help='Port the stub proxied service listens on.')
+    parser.add_argument(
+        '--proxy-arg',
+        action='append',
+        help='Pass PROXY_ARG to `twistd casproxy` (repeatable), '
+             'e.g. --proxy-arg=--session-store=sqlite:/tmp/sessions.db')
+    parser.add_argument(
+        '--proxy-output',
+        action='store',
+        help='Append the output of the proxy and stub processes to PROXY_OUTPUT.')
+    parser.add_argument(
+        '--json',
+        action='store',
+        help='Also write the results to JSON (for comparing releases).')
+
+    args = parser.parse_args()
+
+    task.react(main, [args])
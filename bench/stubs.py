@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+
+#=======================================================================
+# Stub CAS and stub proxied service used by the benchmark harness.
+#
+# CAS:
+#   GET /cas/login?service=URL          -> 302 to URL with a new ticket.
+#   GET /cas/serviceValidate?ticket=... -> successful validation.
+# Proxied service (under /app):
+#   GET /app/large?size=N               -> N bytes, streamed.
+#   POST|PUT /app/upload                -> size of the uploaded body.
+#   anything else                       -> a small HTML page.
+#=======================================================================
+
+# Standard library
+import argparse
+import itertools
+import sys
+from urllib import urlencode
+import urlparse
+
+# External modules
+from klein import Klein
+from twisted.internet import reactor
+from twisted.internet.endpoints import serverFromString
+from twisted.python import log
+from twisted.web.server import NOT_DONE_YET, Site
+
+SV_SUCCESS = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+  <cas:authenticationSuccess>
+    <cas:user>{user}</cas:user>
+    <cas:attributes>
+      <cas:mail>{user}@example.org</cas:mail>
+      <cas:memberOf>cn=staff,ou=groups,dc=example,dc=org</cas:memberOf>
+      <cas:memberOf>cn=bench,ou=groups,dc=example,dc=org</cas:memberOf>
+    </cas:attributes>
+  </cas:authenticationSuccess>
+</cas:serviceResponse>
+"""
+
+SV_FAILURE = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+  <cas:authenticationFailure code="INVALID_TICKET">Ticket not recognized</cas:authenticationFailure>
+</cas:serviceResponse>
+"""
+
+PAGE = "<html><head><title>bench</title></head><body>%s</body></html>" % ("x" * 1000)
+
+CHUNK = "\0" * 65536
+
+
+class StubCAS(object):
+    app = Klein()
+
+    def __init__(self):
+        self.counter = itertools.count(1)
+        self.tickets = {}
+
+    @app.route("/cas/login")
+    def login(self, request):
+        service = request.args.get('service', [None])[0]
+        if service is None:
+            request.setResponseCode(400)
+            return "Missing service."
+        n = next(self.counter)
+        ticket = "ST-%d-bench" % n
+        self.tickets[ticket] = "user%d" % (n % 1000)
+        p = urlparse.urlparse(service)
+        query = p.query
+        if query:
+            query += '&'
+        query += urlencode({'ticket': ticket})
+        request.redirect(urlparse.urlunparse(p[:4] + (query,) + p[5:]))
+        return ""
+
+    @app.route("/cas/serviceValidate")
+    def service_validate(self, request):
+        ticket = request.args.get('ticket', [None])[0]
+        user = self.tickets.pop(ticket, None)
+        request.responseHeaders.setRawHeaders('Content-Type', ['text/xml'])
+        if user is None:
+            return SV_FAILURE
+        return SV_SUCCESS.format(user=user)
+
+
+class LargeBodyProducer(object):
+    """
+    Write `size` bytes to `request`, respecting backpressure.
+    """
+
+    def __init__(self, request, size):
+        self.request = request
+        self.remaining = size
+        self.paused = False
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.resumeProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        while not self.paused and self.remaining > 0:
+            chunk = CHUNK[:self.remaining]
+            self.remaining -= len(chunk)
+            self.request.write(chunk)
+        if self.remaining <= 0 and not self.paused:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.remaining = -1
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def stopProducing(self):
+        self.remaining = -1
+
+
+class StubBackend(object):
+    app = Klein()
+
+    @app.route("/app/large")
+    def large(self, request):
+        size = int(request.args.get('size', ['1048576'])[0])
+        request.responseHeaders.setRawHeaders('Content-Type', ['application/octet-stream'])
+        request.responseHeaders.setRawHeaders('Content-Length', [str(size)])
+        LargeBodyProducer(request, size).start()
+        return NOT_DONE_YET
+
+    @app.route("/app/upload", methods=['POST', 'PUT'])
+    def upload(self, request):
+        content = request.content
+        content.seek(0, 2)
+        return str(content.tell())
+
+    @app.route("/app/", branch=True)
+    def page(self, request):
+        request.responseHeaders.setRawHeaders('Content-Type', ['text/html'])
+        return PAGE
+
+
+def main(args):
+    if args.verbose:
+        log.startLogging(sys.stderr)
+    cas = StubCAS()
+    backend = StubBackend()
+    serverFromString(reactor, "tcp:%d:interface=127.0.0.1" % args.cas_port).listen(
+        Site(cas.app.resource()))
+    serverFromString(reactor, "tcp:%d:interface=127.0.0.1" % args.backend_port).listen(
+        Site(backend.app.resource()))
+    reactor.run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub CAS and proxied service.")
+    parser.add_argument('--cas-port', type=int, default=9401)
+    parser.add_argument('--backend-port', type=int, default=9402)
+    parser.add_argument('--verbose', action='store_true')
+    main(parser.parse_args())
@@ -10,9 +10,10 @@ import urlparse
 
 # Application modules
 from txcasproxy.interfaces import IRProxyPluginFactory, IRProxyInfoAcceptor, \
-                            IResponseContentModifier, ICASRedirectHandler, \
+                            IStreamingContentModifier, ICASRedirectHandler, \
                             IResourceInterceptor, IStaticResourceProvider
-from txcasproxy import proxyutils
+from txcasproxy.contentmod import ReplacingTransformer
+from txcasproxy.proxyutils import url_path
 
 # External modules
 from jinja2 import Environment, FileSystemLoader
@@ -58,7 +59,7 @@ class GrouperPlugin(object):
     
     implements(
         IRProxyInfoAcceptor, 
-        IResponseContentModifier, 
+        IStreamingContentModifier, 
         ICASRedirectHandler, 
         IResourceInterceptor,
         IStaticResourceProvider)
@@ -68,6 +69,7 @@ class GrouperPlugin(object):
     proxied_scheme = 'http'
     proxied_netloc = '127.0.0.1:8443'
     proxied_path = '/'
+    url_mapper = None
     expire_session = lambda self, uid: None
     
     mod_sequence = 7
@@ -75,7 +77,11 @@ class GrouperPlugin(object):
     interceptor_sequence = 7
     
     owasp_js_servlet_resource = '/grouper/grouperExternal/public/OwaspJavaScriptServlet'
+    content_path_prefixes = (owasp_js_servlet_resource,)
+    content_types = None
+    max_content_size = None
     logout_resource = '/grouper/logout.do'
+    intercepted_paths = (logout_resource,)
     cas_logout_url = None
     
     static_resource_base = "/_static/grouper"
@@ -103,44 +109,24 @@ class GrouperPlugin(object):
         parts = proxied_netloc.split(":", 2)
         self.proxied_host = parts[0]
         
-    def transform_content(self, content, request):
+    def begin_transform(self, request, response):
         """
-        Transform `content`
+        Return a transformer for the OWASP CSRF JavaScript servlet content.
+        The proxy only consults this plugin for `content_path_prefixes`.
         """
-        if request.isSecure():
-            scheme = 'https'
-        else:
-            scheme = 'http'
-        p = urlparse.urlparse(request.uri)
-        path = p.path
-        params = p.params
-        query = p.query
-        fragment = p.fragment
-        netloc = "%s:%d" % (self.proxy_fqdn, self.proxy_port)
-        url = urlparse.urlunparse((scheme, netloc, path, params, query, fragment))
-        proxied_url = proxyutils.proxy_url_to_proxied_url(
-            self.proxied_scheme,
-            self.proxy_fqdn, 
-            self.proxy_port, 
-            self.proxied_netloc, 
-            self.proxied_path, 
-            url)
-        
-        p = urlparse.urlparse(proxied_url)
-        if p.path == self.owasp_js_servlet_resource:
-            return defer.succeed(self.csrf_js_hack(content))
-            
-        return content
+        return ReplacingTransformer(self.csrf_js_replacements())
             
-    def csrf_js_hack(self, s):
+    def csrf_js_replacements(self):
         """
         """
-        s = s.replace(self.proxied_host, self.proxy_fqdn)
-        s = s.replace('''part = "/grouper/" + url;''', '''part = "/" + url;''')
-        s = s.replace(
-            self.owasp_js_servlet_resource, 
-            self.owasp_js_servlet_resource[len(self.proxied_path):])
-        return s
+        replacements = []
+        if self.url_mapper is not None:
+            replacements.extend(self.url_mapper.url_prefix_pairs())
+        return replacements + [
+            (self.proxied_host, self.proxy_fqdn),
+            ('''part = "/grouper/" + url;''', '''part = "/" + url;'''),
+            (self.owasp_js_servlet_resource, 
+                self.owasp_js_servlet_resource[len(self.proxied_path):]),]
         
     def intercept_service_url(self, service_url, request):
         """
@@ -161,18 +147,17 @@ class GrouperPlugin(object):
         """
         Return True if resource should be intercepted.
         """
-        p = urlparse.urlparse(url)
-        if p.path == self.logout_resource:
+        if url_path(url) == self.logout_resource:
             return True
         
     def handle_resource(self, url, method, headers, proxy_request):
         """
         Return a deferred that fires the response body or a response body.
         """
-        p = urlparse.urlparse(url)
-        assert self.should_resource_be_intercepted(url, method, headers, proxy_request), "Invalid resource: {method} {url}".format(method, url)
+        path = url_path(url)
+        assert self.should_resource_be_intercepted(url, method, headers, proxy_request), "Invalid resource: {method} {url}".format(method=method, url=url)
         
-        if p.path == self.logout_resource:
+        if path == self.logout_resource:
             sess = proxy_request.getSession()
             self.expire_session(sess.uid)
             return self._renderTemplate(
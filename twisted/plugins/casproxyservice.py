@@ -1,10 +1,20 @@
 
 # Standard library
+import re
 import sys
 
 # Application modules
+from txcasproxy.compression import ResponseCompressor
 from txcasproxy.interfaces import IRProxyPluginFactory
+from txcasproxy.lifecycle import SessionLifecycle
+from txcasproxy.headers import parse_header_rule
+from txcasproxy.httpcache import parse_size, ResponseCache
+from txcasproxy.logger import configure_logging, level_names
+from txcasproxy.matcher import parse_rule
 from txcasproxy.service import ProxyService
+from txcasproxy.sessionstore import make_session_store
+from txcasproxy.snapshot import SessionSnapshot
+from txcasproxy.workers import WorkerSupervisorService
 
 # External modules
 from twisted.application.service import IServiceMaker
@@ -40,6 +50,15 @@ def get_tag(plugin_str):
 class Options(usage.Options):
     optFlags = [
             ["help-plugins", None, "Help about available plugins."],
+            ["no-pool-retry", None, 
+                "Do not retry idempotent requests that fail on a stale pooled connection."],
+            ["server-timing", None, "Add a Server-Timing header to proxied responses."],
+            ["timing-log", None, "Log the time taken by each phase of proxied requests."],
+            ["no-forwarded-headers", None, 
+                "Do not add X-Forwarded-For/Proto/Host headers to proxied requests."],
+            ["no-compression", None, 
+                "Pass content codings through unchanged (no compression to user agents, "
+                "no decoding for content modifiers)."],
         ]
 
     optParameters = [
@@ -53,6 +72,70 @@ class Options(usage.Options):
                         ["auth-info-resource", "A", None, 
                             "Resource on the main site that provides authentication info."],
                         ["help-plugin", None, None, "Help or a specific plugin."],
+                        ["logout-resource", None, None, 
+                            "Only look for CAS single logout requests in POSTs to this resource."],
+                        ["logout-max-size", None, 65536, 
+                            "Largest POST examined as a CAS single logout request.", parse_size],
+                        ["metrics-endpoint", "m", None, 
+                            "Endpoint for the metrics service (Prometheus text format at /metrics)."],
+                        ["session-store", None, "memory", 
+                            "Where authenticated sessions are kept: 'memory' or 'sqlite:PATH' "
+                            "(shared by proxy processes on the same host)."],
+                        ["session-idle-timeout", None, 900, 
+                            "Seconds an authenticated session may go unused.", int],
+                        ["session-max-lifetime", None, 0, 
+                            "Seconds an authenticated session lasts however much it is used "
+                            "(0 for no limit).", int],
+                        ["login-timeout", None, 300, 
+                            "Seconds a new session has to log in.", int],
+                        ["max-sessions", None, 100000, 
+                            "Authenticated sessions kept per process; the least recently used "
+                            "are logged out beyond that (0 for no limit).", int],
+                        ["session-snapshot", None, None, 
+                            "Save the sessions of the memory session store to this file "
+                            "periodically and on shutdown, and restore them on startup."],
+                        ["session-snapshot-interval", None, 60, 
+                            "Seconds between session snapshots.", int],
+                        ["validation-cache-ttl", None, 10, 
+                            "Seconds a successful ticket validation is reused for retries of the "
+                            "same ticket URL from the same client (0 disables).", int],
+                        ["backend-pool-size", None, 20, 
+                            "Persistent connections kept open to the proxied service.", int],
+                        ["backend-pool-idle-timeout", None, 240, 
+                            "Seconds an idle connection to the proxied service is kept open.", int],
+                        ["backend-pool-warmup", None, 0, 
+                            "Connections to the proxied service to open at startup.", int],
+                        ["cas-pool-size", None, 4, 
+                            "Persistent connections kept open to CAS.", int],
+                        ["cas-pool-idle-timeout", None, 240, 
+                            "Seconds an idle connection to CAS is kept open.", int],
+                        ["cas-pool-warmup", None, 0, 
+                            "Connections to CAS to open at startup.", int],
+                        ["log-level", None, "info", 
+                            "Proxy log level: debug, info, warn or error."],
+                        ["debug-sample", None, 1, 
+                            "Emit only one of every N debug messages.", int],
+                        ["proxy-log", None, None, 
+                            "Write proxy log lines to this file through a buffered background "
+                            "writer instead of the Twisted log."],
+                        ["response-cache-size", None, 0, 
+                            "Cache responses for excluded resources in up to this many bytes "
+                            "of memory (K, M and G suffixes allowed; 0 disables).", parse_size],
+                        ["response-cache-max-entry", None, 1048576, 
+                            "Largest response the response cache stores.", parse_size],
+                        ["static-max-age", None, 86400, 
+                            "Seconds user agents may cache plugin static resources.", int],
+                        ["static-cache-size", None, 4194304, 
+                            "Memory for the contents of small plugin static files "
+                            "(K, M and G suffixes allowed; 0 disables).", parse_size],
+                        ["compression-level", None, 6, 
+                            "Compression level (1-9) for responses to user agents (0 disables).", int],
+                        ["compression-min-size", None, 1024, 
+                            "Smallest response compressed for user agents.", parse_size],
+                        ["workers", None, 1, 
+                            "Number of proxy worker processes that share the listening socket.", int],
+                        ["worker-fd", None, None, 
+                            "Internal.  Serve the listening socket inherited as this file descriptor.", int],
                     ]
 
     def __init__(self):
@@ -62,6 +145,10 @@ class Options(usage.Options):
         self.valid_plugins = set([])
         self['excluded-resources'] = set([])
         self['excluded-branches'] = set([])
+        self['excluded-globs'] = []
+        self['excluded-regexes'] = []
+        self['request-header-rules'] = []
+        self['response-header-rules'] = []
         for factory in getPlugins(IRProxyPluginFactory):
             if hasattr(factory, 'tag'):
                 self.valid_plugins.add(factory.tag)
@@ -81,15 +168,57 @@ class Options(usage.Options):
     def opt_exclude(self, resource):
         """
         Exclude a specific resource from being proxied.
+        Prefix with 'METHOD[,METHOD...]:' to exclude only some methods.
         """
         self['excluded-resources'].add(resource)
 
     def opt_excludeBranch(self, branch):
         """
-        Exclude a resource and all its children from being proxied
+        Exclude a resource and all its children from being proxied.
+        Prefix with 'METHOD[,METHOD...]:' to exclude only some methods.
         """
         self['excluded-branches'].add(branch)
 
+    def opt_excludeGlob(self, glob):
+        """
+        Exclude resources matching a shell style glob ('*' matches '/').
+        Prefix with 'METHOD[,METHOD...]:' to exclude only some methods.
+        """
+        self['excluded-globs'].append(glob)
+
+    def opt_excludeRegex(self, regex):
+        """
+        Exclude resources whose path starts with a match for a regular expression.
+        Prefix with 'METHOD[,METHOD...]:' to exclude only some methods.
+        """
+        methods, pattern = parse_rule(regex)
+        try:
+            re.compile(pattern)
+        except re.error as ex:
+            raise usage.UsageError("Invalid regular expression '{0}': {1}".format(pattern, ex))
+        self['excluded-regexes'].append(regex)
+
+    def _header_rule(self, rule):
+        try:
+            return parse_header_rule(rule)
+        except ValueError as ex:
+            raise usage.UsageError(str(ex))
+
+    def opt_requestHeader(self, rule):
+        """
+        Rewrite a header of requests to the proxied service: 'set:NAME:VALUE',
+        'replace:NAME:VALUE', 'append:NAME:VALUE', 'drop:NAME' or
+        'rename:NAME:NEWNAME'.
+        """
+        self['request-header-rules'].append(self._header_rule(rule))
+
+    def opt_responseHeader(self, rule):
+        """
+        Rewrite a header of responses from the proxied service (see
+        --requestHeader).
+        """
+        self['response-header-rules'].append(self._header_rule(rule))
+
     def postOptions(self):
         if self['help-plugins'] or self['help-plugin'] is not None:
             return
@@ -107,6 +236,34 @@ class Options(usage.Options):
             self['cas-service-validate'] = serviceValidate
             del parts
             del login
+        session_store = self['session-store']
+        if session_store != 'memory' and not session_store.startswith('sqlite:'):
+            raise usage.UsageError("Invalid session store '{0}'.".format(session_store))
+        if self['session-snapshot'] is not None:
+            if session_store != 'memory':
+                raise usage.UsageError(
+                    "Session snapshots are only needed for the memory session store.")
+            if self['session-snapshot-interval'] <= 0:
+                raise usage.UsageError("The session snapshot interval must be positive.")
+        if self['log-level'] not in level_names:
+            raise usage.UsageError("Invalid log level '{0}'.".format(self['log-level']))
+        for name in ('session-idle-timeout', 'login-timeout'):
+            if self[name] <= 0:
+                raise usage.UsageError("The {0} must be positive.".format(name.replace('-', ' ')))
+        if not 0 <= self['compression-level'] <= 9:
+            raise usage.UsageError("The compression level must be between 0 and 9.")
+        if self['workers'] < 1:
+            raise usage.UsageError("The number of workers must be at least 1.")
+        if self['workers'] > 1:
+            if session_store == 'memory':
+                raise usage.UsageError(
+                    "Multiple workers require a shared session store (e.g. 'sqlite:PATH').")
+            if self['auth-info-endpoint'] is not None:
+                raise usage.UsageError(
+                    "The authentication info service is not supported with multiple workers.")
+            if self['metrics-endpoint'] is not None:
+                raise usage.UsageError(
+                    "The metrics service is not supported with multiple workers.")
         bad_tags = [get_tag(plugin_str) for plugin_str in self['plugins'] 
                         if get_tag(plugin_str) not in self.valid_plugins]
         if len(bad_tags) > 0:
@@ -140,6 +297,14 @@ class MyServiceMaker(object):
             sys.exit(0)
                     
             
+        configure_logging(
+            options['log-level'], 
+            options['debug-sample'], 
+            options['proxy-log'])
+        if options['workers'] > 1 and options['worker-fd'] is None:
+            return WorkerSupervisorService(
+                options['endpoint'], options['workers'], tapname=self.tapname)
+
         cas_info = dict(
             login_url=options['cas-login'],
             service_validate_url=options['cas-service-validate'])
@@ -167,6 +332,41 @@ class MyServiceMaker(object):
         authInfoResource = options['auth-info-resource'] 
         excluded_resources = options['excluded-resources']
         excluded_branches = options['excluded-branches']
+        excluded_globs = options['excluded-globs']
+        excluded_regexes = options['excluded-regexes']
+        session_store = make_session_store(
+            options['session-store'],
+            idle_timeout=options['session-idle-timeout'],
+            absolute_timeout=options['session-max-lifetime'])
+        response_cache = None
+        if options['response-cache-size'] > 0:
+            response_cache = ResponseCache(
+                options['response-cache-size'], 
+                options['response-cache-max-entry'])
+        compression = None
+        if not options['no-compression']:
+            compression = ResponseCompressor(
+                level=options['compression-level'],
+                min_size=options['compression-min-size'])
+        lifecycle = SessionLifecycle(
+            idle_timeout=options['session-idle-timeout'],
+            absolute_timeout=options['session-max-lifetime'],
+            login_timeout=options['login-timeout'],
+            max_sessions=options['max-sessions'])
+        session_snapshot = None
+        if options['session-snapshot'] is not None:
+            session_snapshot = SessionSnapshot(options['session-snapshot'])
+        retry = not options['no-pool-retry']
+        backend_pool_options = dict(
+            max_persistent=options['backend-pool-size'],
+            idle_timeout=options['backend-pool-idle-timeout'],
+            retry=retry,
+            warmup=options['backend-pool-warmup'])
+        cas_pool_options = dict(
+            max_persistent=options['cas-pool-size'],
+            idle_timeout=options['cas-pool-idle-timeout'],
+            retry=retry,
+            warmup=options['cas-pool-warmup'])
         # Create the service.
         return ProxyService(
             endpoint_s=options['endpoint'], 
@@ -178,7 +378,29 @@ class MyServiceMaker(object):
             authInfoEndpointStr=authInfoEndpointStr,
             authInfoResource=authInfoResource,
             excluded_resources=excluded_resources,
-            excluded_branches=excluded_branches) 
+            excluded_branches=excluded_branches,
+            excluded_globs=excluded_globs,
+            excluded_regexes=excluded_regexes,
+            session_store=session_store,
+            inherited_fd=options['worker-fd'],
+            validation_cache_ttl=options['validation-cache-ttl'],
+            backend_pool_options=backend_pool_options,
+            cas_pool_options=cas_pool_options,
+            metricsEndpointStr=options['metrics-endpoint'],
+            server_timing=options['server-timing'],
+            timing_log=options['timing-log'],
+            request_header_rules=options['request-header-rules'],
+            response_header_rules=options['response-header-rules'],
+            forwarded_headers=not options['no-forwarded-headers'],
+            response_cache=response_cache,
+            static_max_age=options['static-max-age'],
+            static_cache_size=options['static-cache-size'],
+            compression=compression,
+            lifecycle=lifecycle,
+            session_snapshot=session_snapshot,
+            snapshot_interval=options['session-snapshot-interval'],
+            logout_resource=options['logout-resource'],
+            logout_max_size=options['logout-max-size']) 
 
 
 # Now construct an object which *provides* the relevant interfaces
@@ -5,6 +5,9 @@
 # Use this as the `contextFactory` for `twisted.web.client.Agent`.
 #=======================================================================
 
+# Standard library
+import weakref
+
 # External modules
 from OpenSSL import crypto
 
@@ -16,17 +19,47 @@ from zope.interface import implementer
 
 
 class AddExtraTrustRoots(proxyForInterface(IOpenSSLClientConnectionCreator)):
+    """
+    Connection creator that trusts extra CAs and resumes TLS sessions.
+
+    Every connection made by `original` shares one OpenSSL context, so the
+    extra trust roots are added to its certificate store only once.  Each
+    new connection offers the session of the previous one, which lets the
+    server skip the full handshake.
+    """
     def __init__(self, extraTrustRoots, original):
         self._extraTrustRoots = extraTrustRoots
+        self._rootsAdded = False
+        self._lastConnection = None
+        self._session = None
         super(AddExtraTrustRoots, self).__init__(original)
 
 
     def clientConnectionForTLS(self, tlsProtocol):
         connection = (super(AddExtraTrustRoots, self).clientConnectionForTLS(tlsProtocol))
-        cert_store = connection.get_context().get_cert_store()
-        for cert in self._extraTrustRoots:
-            cert_store.add_cert(cert)
+        if not self._rootsAdded:
+            cert_store = connection.get_context().get_cert_store()
+            for cert in self._extraTrustRoots:
+                cert_store.add_cert(cert)
+            self._rootsAdded = True
+        self._resumeSession(connection)
         return connection
+
+    def _resumeSession(self, connection):
+        lastConnection = self._lastConnection
+        if lastConnection is not None:
+            lastConnection = lastConnection()
+        self._lastConnection = weakref.ref(connection)
+        try:
+            if lastConnection is not None:
+                session = lastConnection.get_session()
+                if session is not None:
+                    self._session = session
+            if self._session is not None:
+                connection.set_session(self._session)
+        except AttributeError:
+            # This version of pyOpenSSL cannot resume sessions.
+            pass
  
 @implementer(IPolicyForHTTPS)
 class CustomPolicyForHTTPS(object):
@@ -37,11 +70,19 @@ class CustomPolicyForHTTPS(object):
         if extraTrustRoots is None:
             extraTrustRoots = []
         self._extraTrustRoots = extraTrustRoots
+        self._creators = {}
 
     def creatorForNetloc(self, hostname, port):
         """
+        Return the connection creator for `hostname` and `port`.  Creators
+        (and their OpenSSL contexts) are built once per netloc and reused.
         """
-        return AddExtraTrustRoots(
-            self._extraTrustRoots, 
-            ssl.optionsForClientTLS(hostname.decode("ascii")))
+        key = (hostname, port)
+        creator = self._creators.get(key, None)
+        if creator is None:
+            creator = AddExtraTrustRoots(
+                self._extraTrustRoots, 
+                ssl.optionsForClientTLS(hostname.decode("ascii")))
+            self._creators[key] = creator
+        return creator
 
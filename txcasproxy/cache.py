@@ -0,0 +1,58 @@
+
+#=======================================================================
+# Small bounded caches.
+#=======================================================================
+
+# Standard library
+from collections import OrderedDict
+import time
+
+
+class LRUCache(object):
+    """
+    A mapping that holds at most `max_entries` items and discards the
+    least recently used item when it is full.  Items may be given a time
+    to live, after which they are treated as missing.
+    """
+    clock = time.time
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entries = self._entries
+        try:
+            value, expires = entries.pop(key)
+        except KeyError:
+            return default
+        if expires is not None and expires <= self.clock():
+            return default
+        entries[key] = (value, expires)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.max_entries <= 0:
+            return
+        entries = self._entries
+        if ttl is None:
+            expires = None
+        else:
+            expires = self.clock() + ttl
+        entries.pop(key, None)
+        entries[key] = (value, expires)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        try:
+            value, expires = self._entries.pop(key)
+        except KeyError:
+            return default
+        return value
+
+    def clear(self):
+        self._entries.clear()
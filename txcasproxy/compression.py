@@ -0,0 +1,278 @@
+
+#=======================================================================
+# Content coding between the proxied service, the content modifiers and
+# the user agent.
+#
+# The proxied service is asked for compressed responses.  A compressed
+# body is relayed as is when no content modifier wants it and the user
+# agent accepts its coding; otherwise it is decoded on the way through.
+# Uncompressed text is compressed for user agents that accept gzip (or
+# brotli, if the `brotli` module is installed).  All coding is streamed
+# through `IContentTransformer` stages in the content pipeline.
+#=======================================================================
+
+# Standard library
+import zlib
+
+# Application modules
+from contentmod import ContentPipeline, media_type
+from headers import parse_accept_encoding
+from httpcache import parse_cache_control
+from interfaces import IContentTransformer
+
+# External modules
+from zope.interface import implementer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Media types worth compressing besides `text/*`.
+compressible_types = frozenset([
+    'application/atom+xml',
+    'application/ecmascript',
+    'application/javascript',
+    'application/json',
+    'application/ld+json',
+    'application/manifest+json',
+    'application/rss+xml',
+    'application/vnd.ms-fontobject',
+    'application/x-javascript',
+    'application/xhtml+xml',
+    'application/xml',
+    'font/otf',
+    'font/ttf',
+    'image/svg+xml',
+    'image/x-icon',
+])
+
+# Streams must reach the user agent as they are produced.
+uncompressible_types = frozenset([
+    'text/event-stream',
+])
+
+
+def is_compressible(content_type):
+    """
+    Return True if responses of media type `content_type` are worth
+    compressing.
+    """
+    if content_type is None or content_type in uncompressible_types:
+        return False
+    return content_type.startswith('text/') or content_type in compressible_types
+
+def content_coding(headers):
+    """
+    Return the lower case content coding of `headers`, None for identity or
+    '' if there are several codings.
+    """
+    values = headers.getRawHeaders('content-encoding')
+    if not values:
+        return None
+    codings = [
+        coding.strip().lower()
+        for value in values
+        for coding in value.split(',')
+        if coding.strip().lower() not in ('', 'identity')]
+    if len(codings) == 0:
+        return None
+    if len(codings) > 1:
+        return ''
+    return codings[0]
+
+
+@implementer(IContentTransformer)
+class ZlibDecoder(object):
+    """
+    Decode `gzip` or `deflate` content.  Some services send `deflate`
+    content without the zlib wrapper, so that is accepted too.
+    """
+
+    def __init__(self, coding):
+        if coding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        self._raw_retry = (coding == 'deflate')
+
+    def transform_chunk(self, data):
+        try:
+            result = self._decompressor.decompress(data)
+        except zlib.error:
+            if not self._raw_retry:
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self._decompressor.decompress(data)
+        self._raw_retry = False
+        return result
+
+    def finish(self):
+        return self._decompressor.flush()
+
+
+@implementer(IContentTransformer)
+class BrotliDecoder(object):
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def transform_chunk(self, data):
+        return self._decompressor.process(data)
+
+    def finish(self):
+        return ''
+
+
+@implementer(IContentTransformer)
+class GzipEncoder(object):
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def transform_chunk(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+@implementer(IContentTransformer)
+class BrotliEncoder(object):
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def transform_chunk(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def make_decoder(coding):
+    """
+    Return an `IContentTransformer` that decodes `coding`, or None if the
+    coding is not supported.
+    """
+    if coding in ('gzip', 'x-gzip'):
+        return ZlibDecoder('gzip')
+    if coding == 'deflate':
+        return ZlibDecoder('deflate')
+    if coding == 'br' and brotli is not None:
+        return BrotliDecoder()
+    return None
+
+
+class ResponseCompressor(object):
+    """
+    Decide the content coding of each proxied response.
+
+    `level` is the gzip compression level (and brotli quality) used for
+    responses to the user agent; 0 turns compression off.  Responses of a
+    known length below `min_size` are not compressed.
+    """
+
+    def __init__(self, level=6, min_size=1024, use_brotli=True):
+        self.level = level
+        self.min_size = min_size
+        codings = []
+        if use_brotli and brotli is not None:
+            codings.append('br')
+        codings.append('gzip')
+        # Codings offered to user agents, most preferred first.
+        self.codings = tuple(codings)
+        # Codings that can be decoded, so may be requested upstream.
+        decodable = list(codings)
+        decodable.append('deflate')
+        self.upstream_accept_encoding = ', '.join(decodable)
+
+    def choose_coding(self, request):
+        """
+        Return the coding to compress the response to `request` with, or
+        None.
+        """
+        accepted = parse_accept_encoding(request.requestHeaders.getRawHeaders('accept-encoding'))
+        if len(accepted) == 0:
+            return None
+        best = None
+        best_q = 0.0
+        for coding in self.codings:
+            q = accepted.get(coding)
+            if q is None:
+                q = accepted.get('*', 0.0)
+            if q > best_q:
+                best = coding
+                best_q = q
+        return best
+
+    def make_encoder(self, coding):
+        if coding == 'br':
+            return BrotliEncoder(self.level)
+        return GzipEncoder(self.level)
+
+    def apply(self, request, response, pipeline):
+        """
+        Return the `ContentPipeline` (or None) that relays the body of
+        `response` to `request`, given the content modifier `pipeline` (or
+        None).  The response headers of `request` are adjusted to match.
+        """
+        if request.method == 'HEAD' or response.code in (204, 206, 304):
+            return pipeline
+        upstream_headers = response.headers
+        directives = parse_cache_control(upstream_headers.getRawHeaders('cache-control'))
+        if 'no-transform' in directives:
+            return pipeline
+        headers = request.responseHeaders
+        upstream_coding = content_coding(upstream_headers)
+        content_type = media_type(upstream_headers)
+        compressible = self.level > 0 and is_compressible(content_type)
+        transformers = []
+        if upstream_coding is not None:
+            decoder = make_decoder(upstream_coding)
+            if decoder is None:
+                # Nothing can be done with an unknown coding.
+                return None
+            if pipeline is None:
+                accepted = parse_accept_encoding(
+                    request.requestHeaders.getRawHeaders('accept-encoding'))
+                if accepted.get(upstream_coding, accepted.get('*', 0.0)) > 0.0:
+                    add_vary(headers, 'Accept-Encoding')
+                    return None
+            transformers.append(decoder)
+            headers.removeHeader('content-encoding')
+        if pipeline is not None:
+            transformers.extend(pipeline.transformers)
+        coding = None
+        if compressible:
+            length = response.length
+            if upstream_coding is not None or not isinstance(length, (int, long)) or \
+                    length >= self.min_size:
+                coding = self.choose_coding(request)
+        if coding is not None:
+            transformers.append(self.make_encoder(coding))
+            headers.setRawHeaders('content-encoding', [coding])
+        if upstream_coding is not None or compressible:
+            add_vary(headers, 'Accept-Encoding')
+        if upstream_coding is not None or coding is not None:
+            # The representation differs from the one the service tagged.
+            etags = headers.getRawHeaders('etag')
+            if etags and not etags[0].startswith('W/'):
+                headers.setRawHeaders('etag', ['W/' + etags[0]])
+        if len(transformers) == 0:
+            return None
+        return ContentPipeline(transformers)
+
+
+def add_vary(headers, name):
+    """
+    Add the header `name` to the `Vary` header of `headers`.
+    """
+    values = headers.getRawHeaders('vary') or []
+    lower = name.lower()
+    for value in values:
+        for token in value.split(','):
+            token = token.strip().lower()
+            if token == lower or token == '*':
+                return
+    headers.setRawHeaders('vary', values + [name])
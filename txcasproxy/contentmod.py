@@ -0,0 +1,269 @@
+
+#=======================================================================
+# Chunk-wise response content modification.
+#=======================================================================
+
+# Application modules
+from interfaces import (
+    IContentTransformer,
+    IResponseContentModifier,
+    IStreamingContentModifier)
+
+# External modules
+from twisted.internet import defer
+from zope.interface import implementer
+
+
+@implementer(IContentTransformer)
+class ReplacingTransformer(object):
+    """
+    Replace literal strings in streamed content.
+
+    `replacements` is a sequence of `(old, new)` pairs.  They are applied in
+    order, as successive calls to `str.replace()` would be.  Each pair keeps
+    back the last `len(old) - 1` bytes of a chunk so that occurrences split
+    across chunk boundaries are still replaced.
+    """
+
+    def __init__(self, replacements):
+        self._replacements = [(old, new) for old, new in replacements if old != '']
+        self._pending = [''] * len(self._replacements)
+
+    def transform_chunk(self, data):
+        pending = self._pending
+        for n, (old, new) in enumerate(self._replacements):
+            buf = pending[n] + data
+            size = len(old)
+            parts = []
+            start = 0
+            while True:
+                pos = buf.find(old, start)
+                if pos == -1:
+                    break
+                parts.append(buf[start:pos])
+                parts.append(new)
+                start = pos + size
+            # Anything that could be the start of a match must wait for
+            # the next chunk.
+            safe = max(start, len(buf) - size + 1)
+            parts.append(buf[start:safe])
+            pending[n] = buf[safe:]
+            data = ''.join(parts)
+        return data
+
+    def finish(self):
+        # Flush the held back tail of each stage through the stages that
+        # follow it.
+        pending = self._pending
+        replacements = self._replacements
+        data = ''
+        for n, (old, new) in enumerate(replacements):
+            data = (pending[n] + data).replace(old, new)
+            pending[n] = ''
+        return data
+
+
+@implementer(IContentTransformer)
+class WholeBodyTransformer(object):
+    """
+    Collect the complete content and hand it to a whole-body
+    `IResponseContentModifier`.
+
+    If more than `max_size` bytes arrive, whatever the headers said, the
+    content is passed through unmodified instead.
+    """
+
+    def __init__(self, modifier, request, max_size=None):
+        self._modifier = modifier
+        self._request = request
+        self._max_size = max_size
+        self._chunks = []
+        self._size = 0
+        self._passing = False
+
+    def transform_chunk(self, data):
+        if self._passing:
+            return data
+        self._chunks.append(data)
+        self._size += len(data)
+        max_size = self._max_size
+        if max_size is not None and self._size > max_size:
+            self._passing = True
+            data = ''.join(self._chunks)
+            self._chunks = []
+            return data
+        return ''
+
+    def finish(self):
+        if self._passing:
+            return ''
+        body = ''.join(self._chunks)
+        self._chunks = []
+        return defer.maybeDeferred(self._modifier.transform_content, body, self._request)
+
+
+@implementer(IStreamingContentModifier)
+class WholeBodyContentModifier(object):
+    """
+    Adapt an `IResponseContentModifier` to `IStreamingContentModifier`.
+    The adapted plugin sees complete response bodies, so content passing
+    through it is buffered.
+    """
+
+    def __init__(self, modifier):
+        self.modifier = modifier
+        self.mod_sequence = modifier.mod_sequence
+        self.content_path_prefixes = getattr(modifier, 'content_path_prefixes', None)
+        self.content_types = getattr(modifier, 'content_types', None)
+        self.max_content_size = getattr(modifier, 'max_content_size', None)
+
+    def begin_transform(self, request, response):
+        return WholeBodyTransformer(self.modifier, request, self.max_content_size)
+
+
+def as_streaming_modifier(plugin):
+    """
+    Return `plugin` as an `IStreamingContentModifier`.
+    """
+    if IStreamingContentModifier.providedBy(plugin):
+        return plugin
+    if IResponseContentModifier.providedBy(plugin):
+        return WholeBodyContentModifier(plugin)
+    raise TypeError("{0!r} is not a content modifier.".format(plugin))
+
+
+class ContentModifierIndex(object):
+    """
+    Dispatch index of content modifiers, built once from the scopes that
+    the modifiers declare (`content_path_prefixes`, `content_types` and
+    `max_content_size`).
+
+    Lookups walk the segments of the resource path, so the cost depends on
+    the depth of the path rather than on the number of modifiers.
+    """
+
+    def __init__(self, modifiers):
+        self._unscoped = []
+        self._by_prefix = {}
+        self._filters = []
+        for position, modifier in enumerate(modifiers):
+            content_types = getattr(modifier, 'content_types', None)
+            if content_types is not None:
+                exact = frozenset(t.lower() for t in content_types if not t.endswith('/*'))
+                major = frozenset(t[:-1].lower() for t in content_types if t.endswith('/*'))
+                content_types = (exact, major)
+            max_size = getattr(modifier, 'max_content_size', None)
+            self._filters.append((modifier, content_types, max_size))
+            prefixes = getattr(modifier, 'content_path_prefixes', None)
+            if prefixes is None:
+                self._unscoped.append(position)
+                continue
+            for prefix in prefixes:
+                if prefix != '/' and prefix.endswith('/'):
+                    prefix = prefix[:-1]
+                if prefix in ('', '/'):
+                    self._unscoped.append(position)
+                    break
+                positions = self._by_prefix.setdefault(prefix, [])
+                if position not in positions:
+                    positions.append(position)
+        self._unscoped.sort()
+
+    def __len__(self):
+        return len(self._filters)
+
+    def _positions_for_path(self, path):
+        by_prefix = self._by_prefix
+        if len(by_prefix) == 0:
+            return self._unscoped
+        matched = None
+        candidate = path
+        end = len(path)
+        while True:
+            positions = by_prefix.get(candidate)
+            if positions is not None:
+                if matched is None:
+                    matched = set(self._unscoped)
+                matched.update(positions)
+            end = path.rfind('/', 0, end)
+            if end <= 0:
+                break
+            candidate = path[:end]
+        if matched is None:
+            return self._unscoped
+        return sorted(matched)
+
+    def select(self, path, content_type, length):
+        """
+        Return the modifiers, in sequence order, that want to see a response
+        for the proxied resource `path` with media type `content_type` (or 
+        None) and a body of `length` bytes (or None if unknown).
+        """
+        selected = []
+        filters = self._filters
+        for position in self._positions_for_path(path):
+            modifier, content_types, max_size = filters[position]
+            if content_types is not None:
+                if content_type is None:
+                    continue
+                exact, major = content_types
+                if content_type not in exact and \
+                        content_type[:content_type.find('/') + 1] not in major:
+                    continue
+            if max_size is not None and length is not None and length > max_size:
+                continue
+            selected.append(modifier)
+        return selected
+
+
+def media_type(headers):
+    """
+    Return the lower-cased media type from the Content-Type of `headers` or
+    None.
+    """
+    values = headers.getRawHeaders('Content-Type')
+    if not values:
+        return None
+    return values[0].split(';', 1)[0].strip().lower()
+
+
+class ContentPipeline(object):
+    """
+    Pass streamed content through a sequence of `IContentTransformer`.
+    """
+
+    def __init__(self, transformers):
+        self.transformers = transformers
+
+    def feed(self, data):
+        """
+        Transform a chunk of content.  Return the content that can be
+        written now.
+        """
+        for transformer in self.transformers:
+            if data == '':
+                break
+            data = transformer.transform_chunk(data)
+        return data
+
+    def finish(self):
+        """
+        Return a deferred that fires with the remaining content once every
+        transformer has been flushed.
+        """
+        return self._finish_from(0, '')
+
+    def _finish_from(self, index, data):
+        transformers = self.transformers
+        while index < len(transformers):
+            transformer = transformers[index]
+            index += 1
+            if data != '':
+                data = transformer.transform_chunk(data)
+            tail = transformer.finish()
+            if isinstance(tail, defer.Deferred):
+                tail.addCallback(
+                    lambda tail, head=data, index=index: self._finish_from(index, head + tail))
+                return tail
+            data += tail
+        return defer.succeed(data)
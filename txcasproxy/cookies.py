@@ -0,0 +1,100 @@
+
+#=======================================================================
+# Set-Cookie rewriting.
+#
+# Only the `Path` and `Domain` attributes are changed; the rest of the
+# header value is kept exactly as the proxied service sent it.  Services
+# send the same few cookie shapes over and over, so rewritten attributes
+# are kept in a small LRU cache.
+#=======================================================================
+
+# Application modules
+from cache import LRUCache
+from proxyutils import is_proxy_path_or_child
+
+
+class SetCookieRewriter(object):
+    """
+    Rewrite `Set-Cookie` values from the proxied service for the proxy:
+
+    - a `Path` under `proxied_path` loses that prefix,
+    - a `Domain` naming `proxied_host` is replaced by `proxy_host`.
+    """
+
+    def __init__(self, proxied_path, proxied_host, proxy_host, cache_size=1000):
+        if proxied_path.endswith('/'):
+            proxied_path = proxied_path[:-1]
+        self.proxied_path = proxied_path
+        self.proxied_host = proxied_host.lower()
+        self.proxy_host = proxy_host
+        self._cache = LRUCache(cache_size)
+
+    def rewrite(self, value):
+        """
+        Return the rewritten `Set-Cookie` header value.
+        """
+        # Cookie values vary (session IDs), their attributes rarely do.
+        semi = value.find(';')
+        if semi == -1:
+            return value
+        attributes = value[semi:]
+        cache = self._cache
+        rewritten = cache.get(attributes)
+        if rewritten is None:
+            rewritten = self._rewrite_attributes(attributes)
+            cache.set(attributes, rewritten)
+        if rewritten is attributes:
+            return value
+        return value[:semi] + rewritten
+
+    def rewrite_all(self, values):
+        rewrite = self.rewrite
+        return [rewrite(value) for value in values]
+
+    def _rewrite_attributes(self, attributes):
+        """
+        Rewrite the attributes (`; Name=Value; ...`) of a cookie.
+        """
+        segments = attributes.split(';')
+        changed = False
+        for n in range(1, len(segments)):
+            segment = segments[n]
+            eq = segment.find('=')
+            if eq == -1:
+                continue
+            name = segment[:eq].strip().lower()
+            if name == 'path':
+                new_value = self.rewrite_path(segment[eq + 1:].strip())
+            elif name == 'domain':
+                new_value = self.rewrite_domain(segment[eq + 1:].strip())
+            else:
+                continue
+            if new_value is not None:
+                segments[n] = segment[:eq + 1] + new_value
+                changed = True
+        if not changed:
+            return attributes
+        return ';'.join(segments)
+
+    def rewrite_path(self, path):
+        """
+        Return the proxy path for the proxied path `path`, or None if it
+        does not change.
+        """
+        proxied_path = self.proxied_path
+        if proxied_path == '' or not is_proxy_path_or_child(proxied_path, path):
+            return None
+        return path[len(proxied_path):] or '/'
+
+    def rewrite_domain(self, domain):
+        """
+        Return the proxy domain for the cookie domain `domain`, or None if it
+        does not change.
+        """
+        if domain.startswith('.'):
+            bare = domain[1:]
+        else:
+            bare = domain
+        if bare.lower() != self.proxied_host:
+            return None
+        return self.proxy_host
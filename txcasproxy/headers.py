@@ -0,0 +1,216 @@
+
+#=======================================================================
+# Header rewriting.
+#
+# Rules are compiled once into a map from lower case header names to
+# actions, so rewriting a set of headers is a single pass over them with
+# one dictionary lookup per header.  Rewritten headers are returned in a
+# dictionary keyed by lower case header names.
+#=======================================================================
+
+# Hop-by-hop headers (RFC 7230 section 6.1) apply to a single connection
+# and are never forwarded.  Neither are headers named by `Connection`.
+hop_by_hop_headers = frozenset([
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'proxy-connection',
+    'te',
+    'trailer',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+])
+
+SET = 'set'
+REPLACE = 'replace'
+APPEND = 'append'
+DROP = 'drop'
+RENAME = 'rename'
+
+actions = (SET, REPLACE, APPEND, DROP, RENAME)
+
+
+def parse_header_rule(rule):
+    """
+    Parse a rule given on the command line:
+
+        set:NAME:VALUE      Set the header, replacing any values.
+        replace:NAME:VALUE  Replace the values of the header if present.
+        append:NAME:VALUE   Add a value to the header.
+        drop:NAME           Remove the header.
+        rename:NAME:NEWNAME Rename the header.
+
+    Return `(action, name, argument)`.  Raise ValueError for an invalid rule.
+    """
+    parts = rule.split(':', 2)
+    action = parts[0].lower()
+    if action not in actions:
+        raise ValueError("Unknown header rule action '{0}'.".format(parts[0]))
+    if action == DROP:
+        if len(parts) != 2 or parts[1].strip() == '':
+            raise ValueError("Expected 'drop:NAME', got '{0}'.".format(rule))
+        return action, parts[1].strip(), None
+    if len(parts) != 3 or parts[1].strip() == '':
+        raise ValueError("Expected '{0}:NAME:VALUE', got '{1}'.".format(action, rule))
+    argument = parts[2].strip()
+    if action == RENAME and argument == '':
+        raise ValueError("Expected 'rename:NAME:NEWNAME', got '{0}'.".format(rule))
+    return action, parts[1].strip(), argument
+
+
+class HeaderRewriter(object):
+    """
+    Rewrite headers according to a list of `(action, name, argument)` rules.
+
+    `argument` is the value for `set`, `replace` and `append` rules (or a
+    callable that computes it from the context passed to `rewrite()`), and
+    the new name for `rename` rules.  When several rules name the same
+    header, the last one wins.  Hop-by-hop headers are removed unless
+    `strip_hop_by_hop` is False.
+    """
+
+    max_names = 1024
+
+    def __init__(self, rules=(), strip_hop_by_hop=True):
+        compiled = {}
+        for action, name, argument in rules:
+            if action not in actions:
+                raise ValueError("Unknown header rule action '{0}'.".format(action))
+            key = name.lower()
+            if action == RENAME:
+                argument = argument.lower()
+            compiled[key] = (action, argument)
+        if strip_hop_by_hop:
+            for key in hop_by_hop_headers:
+                compiled[key] = (DROP, None)
+        self.strip_hop_by_hop = strip_hop_by_hop
+        self._rules = compiled
+        # Header name as received -> (lower case name, rule or None).
+        self._names = {}
+        # Headers added even if absent from the original headers.
+        self._additions = tuple(
+            (key, action, argument)
+            for key, (action, argument) in compiled.items()
+            if action in (SET, APPEND))
+
+    def _classify(self, name):
+        key = name.lower()
+        entry = (key, self._rules.get(key))
+        # Header names are mostly the usual few, but user agents can send
+        # any, so stop remembering them at some point.
+        if len(self._names) < self.max_names:
+            self._names[name] = entry
+        return entry
+
+    def rewrite(self, headers, context=None):
+        """
+        Rewrite `headers`, a sequence of `(name, values)` pairs such as
+        `Headers.getAllRawHeaders()`.  `context` (e.g. the request) is passed
+        to computed rule values.
+        """
+        rules = self._rules
+        names = self._names
+        result = {}
+        connection = None
+        for name, values in headers:
+            entry = names.get(name)
+            if entry is None:
+                entry = self._classify(name)
+            key, rule = entry
+            if rule is None:
+                # The value lists are shared with `headers`, never modified.
+                if key in result:
+                    result[key] = result[key] + values
+                else:
+                    result[key] = values
+                continue
+            action, argument = rule
+            if action == DROP:
+                if key == 'connection':
+                    connection = values
+                continue
+            if action == RENAME:
+                result[argument] = result.get(argument, []) + values
+                continue
+            if callable(argument):
+                argument = argument(context)
+            if argument is None:
+                result[key] = values
+            elif action == APPEND:
+                result[key] = values + [argument]
+            else:
+                result[key] = [argument]
+        if connection is not None:
+            # Headers named by `Connection` are also hop-by-hop, but they
+            # cannot be used to remove headers the rules provide.
+            for value in connection:
+                for token in value.split(','):
+                    token = token.strip().lower()
+                    if token not in rules:
+                        result.pop(token, None)
+        for key, action, argument in self._additions:
+            if key in result:
+                continue
+            if callable(argument):
+                argument = argument(context)
+            if argument is not None:
+                result[key] = [argument]
+        return result
+
+
+def forwarded_for(request):
+    return request.getClientIP()
+
+def forwarded_proto(request):
+    if request.isSecure():
+        return 'https'
+    return 'http'
+
+def forwarded_host(request):
+    return request.getHeader('host')
+
+def forwarded_header_rules():
+    """
+    Rules that tell the proxied service about the original request.
+    """
+    return [
+        (APPEND, 'X-Forwarded-For', forwarded_for),
+        (SET, 'X-Forwarded-Proto', forwarded_proto),
+        (SET, 'X-Forwarded-Host', forwarded_host),
+    ]
+
+def parse_accept_encoding(values):
+    """
+    Parse `Accept-Encoding` header values into a dict of lower case content
+    codings to their quality values.
+    """
+    codings = {}
+    for value in values or ():
+        for part in value.split(','):
+            params = part.split(';')
+            coding = params[0].strip().lower()
+            if coding == '':
+                continue
+            q = 1.0
+            for param in params[1:]:
+                name, sep, argument = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(argument)
+                    except ValueError:
+                        q = 0.0
+            codings[coding] = q
+    return codings
+
+def accepts_encoding(values, coding):
+    """
+    Return True if `Accept-Encoding` header values allow the content coding
+    `coding`.
+    """
+    codings = parse_accept_encoding(values)
+    q = codings.get(coding)
+    if q is None:
+        q = codings.get('*', 0.0)
+    return q > 0.0
@@ -0,0 +1,343 @@
+
+#=======================================================================
+# Shared in-memory HTTP cache for unprotected (excluded) resources.
+#
+# Only fresh responses are served: entries are stored with the freshness
+# lifetime the proxied service gives them (`Cache-Control: s-maxage` or
+# `max-age`, or `Expires`) and are dropped once stale rather than
+# revalidated.  Responses are cached only if a shared cache may store them
+# and they fit the per-entry limit.  The cache holds at most `max_bytes`
+# of responses, evicting the least recently used.
+#=======================================================================
+
+# Standard library
+from collections import OrderedDict
+import email.utils
+import re
+import time
+
+cacheable_status_codes = frozenset([200, 203, 300, 301, 404, 410])
+
+# Headers that belong to one response, not to the stored representation.
+uncached_headers = frozenset([
+    'age',
+    'connection',
+    'content-length',
+    'date',
+    'server-timing',
+    'set-cookie',
+    'transfer-encoding',
+    'x-request-id',
+])
+
+_size_pattern = re.compile(r'^\s*(\d+)\s*([kmg]?)b?\s*$', re.IGNORECASE)
+_size_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(value):
+    """
+    Parse a size in bytes with an optional K, M or G suffix.
+    """
+    m = _size_pattern.match(str(value))
+    if m is None:
+        raise ValueError("Invalid size '{0}'.".format(value))
+    return int(m.group(1)) * _size_units[m.group(2).lower()]
+
+def parse_cache_control(values):
+    """
+    Parse `Cache-Control` header values into a dict of lower case
+    directives to their arguments (or None).
+    """
+    directives = {}
+    for value in values or ():
+        for part in value.split(','):
+            name, sep, argument = part.partition('=')
+            name = name.strip().lower()
+            if name == '':
+                continue
+            if sep:
+                directives[name] = argument.strip().strip('"')
+            else:
+                directives[name] = None
+    return directives
+
+def parse_http_date(value):
+    """
+    Return the POSIX time for an HTTP date, or None if it is invalid.
+    """
+    if value is None:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _first(headers, name):
+    values = headers.getRawHeaders(name)
+    if not values:
+        return None
+    return values[0]
+
+def etag_matches(etag, if_none_match):
+    """
+    Weak comparison of an entity tag with an `If-None-Match` value.
+    """
+    if etag is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class CacheEntry(object):
+    __slots__ = (
+        'key', 'vary', 'code', 'phrase', 'headers', 'body', 'stored',
+        'expires', 'etag', 'last_modified', 'size')
+
+    def __init__(self, key, vary, code, phrase, headers, body, stored, expires):
+        self.key = key
+        self.vary = vary
+        self.code = code
+        self.phrase = phrase
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        self.expires = expires
+        self.etag = None
+        self.last_modified = None
+        size = len(body) + 200
+        for name, values in headers:
+            if name == 'etag':
+                self.etag = values[0]
+            elif name == 'last-modified':
+                self.last_modified = parse_http_date(values[0])
+            size += len(name) + sum(len(v) for v in values)
+        self.size = size
+
+
+class ResponseRecorder(object):
+    """
+    Collect a response body as it is relayed to the user agent and store
+    the response in the cache once it is complete.
+    """
+
+    def __init__(self, cache, entry_args):
+        self.cache = cache
+        self.entry_args = entry_args
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        chunks = self.chunks
+        if chunks is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_entry_size:
+            self.chunks = None
+            return
+        chunks.append(data)
+
+    def finish(self):
+        if self.chunks is not None:
+            self.cache.store(self.entry_args, ''.join(self.chunks))
+        self.chunks = None
+
+
+class ResponseCache(object):
+    """
+    A shared cache of responses to GET (and HEAD) requests, limited to
+    `max_bytes` in total and `max_entry_size` per response.
+    """
+    clock = time.time
+
+    def __init__(self, max_bytes, max_entry_size=1048576):
+        self.max_bytes = max_bytes
+        self.max_entry_size = min(max_entry_size, max_bytes)
+        self.size = 0
+        # (uri, vary values) -> CacheEntry, least recently used first.
+        self._entries = OrderedDict()
+        # uri -> header names the response varies on.
+        self._vary = {}
+        # uri -> keys of its cached variants.
+        self._variants = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _variant_key(self, uri, request):
+        vary = self._vary.get(uri)
+        if vary is None:
+            return None
+        headers = request.requestHeaders
+        return (uri, tuple(
+            ','.join(headers.getRawHeaders(name, ())) for name in vary))
+
+    def lookup(self, request):
+        """
+        Return a fresh entry for `request`, or None.
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        headers = request.requestHeaders
+        if headers.hasHeader('authorization'):
+            return None
+        directives = parse_cache_control(headers.getRawHeaders('cache-control'))
+        if 'no-cache' in directives or 'no-store' in directives or \
+                directives.get('max-age') == '0':
+            return None
+        if 'no-cache' in (headers.getRawHeaders('pragma') or ()):
+            return None
+        key = self._variant_key(request.uri, request)
+        if key is None:
+            return None
+        entries = self._entries
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= self.clock():
+            self._discard(entry)
+            return None
+        # Most recently used.
+        del entries[key]
+        entries[key] = entry
+        return entry
+
+    def serve(self, entry, request):
+        """
+        Answer `request` from `entry`.  Return the body to write.
+        """
+        now = self.clock()
+        if_none_match = _first(request.requestHeaders, 'if-none-match')
+        not_modified = False
+        if if_none_match is not None:
+            not_modified = etag_matches(entry.etag, if_none_match)
+        elif entry.last_modified is not None and entry.code == 200:
+            since = parse_http_date(_first(request.requestHeaders, 'if-modified-since'))
+            not_modified = since is not None and entry.last_modified <= since
+        response_headers = request.responseHeaders
+        for name, values in entry.headers:
+            response_headers.setRawHeaders(name, values)
+        response_headers.setRawHeaders('Age', [str(int(now - entry.stored))])
+        if not_modified and entry.code == 200:
+            request.setResponseCode(304)
+            for name in ('content-type', 'content-encoding', 'content-language'):
+                response_headers.removeHeader(name)
+            return ''
+        request.setResponseCode(entry.code, entry.phrase)
+        response_headers.setRawHeaders('Content-Length', [str(len(entry.body))])
+        if request.method == 'HEAD':
+            return ''
+        return entry.body
+
+    def recorder(self, request, response):
+        """
+        Return a `ResponseRecorder` if the response to `request` may be
+        stored, or None.  Call once the response headers have been set on
+        `request`.
+        """
+        if request.method != 'GET' or response.code not in cacheable_status_codes:
+            return None
+        request_headers = request.requestHeaders
+        if request_headers.hasHeader('authorization'):
+            return None
+        if 'no-store' in parse_cache_control(request_headers.getRawHeaders('cache-control')):
+            return None
+        length = response.length
+        if isinstance(length, (int, long)) and length > self.max_entry_size:
+            return None
+        response_headers = request.responseHeaders
+        if response_headers.hasHeader('set-cookie'):
+            return None
+        directives = parse_cache_control(response_headers.getRawHeaders('cache-control'))
+        for directive in ('no-store', 'no-cache', 'private'):
+            if directive in directives:
+                return None
+        now = self.clock()
+        lifetime = _int_or_none(directives.get('s-maxage'))
+        if lifetime is None:
+            lifetime = _int_or_none(directives.get('max-age'))
+        if lifetime is None:
+            expires = parse_http_date(_first(response_headers, 'expires'))
+            if expires is None:
+                return None
+            date = parse_http_date(_first(response_headers, 'date'))
+            if date is None:
+                date = now
+            lifetime = expires - date
+        if lifetime <= 0:
+            return None
+        vary = []
+        for value in response_headers.getRawHeaders('vary') or ():
+            for name in value.split(','):
+                name = name.strip().lower()
+                if name == '*':
+                    return None
+                if name != '':
+                    vary.append(name)
+        headers = [
+            (name.lower(), values)
+            for name, values in response_headers.getAllRawHeaders()
+            if name.lower() not in uncached_headers]
+        return ResponseRecorder(self, (
+            request.uri, tuple(sorted(vary)), request, response.code, response.phrase,
+            headers, now, now + lifetime))
+
+    def store(self, entry_args, body):
+        uri, vary, request, code, phrase, headers, stored, expires = entry_args
+        if self._vary.get(uri, vary) != vary:
+            # The variants depend on other headers now; drop the old ones.
+            for key in list(self._variants.get(uri, ())):
+                self._discard(self._entries[key])
+        self._vary[uri] = vary
+        key = self._variant_key(uri, request)
+        entry = CacheEntry(key, vary, code, phrase, headers, body, stored, expires)
+        if entry.size > self.max_entry_size:
+            self._forget_uri(uri)
+            return
+        old = self._entries.get(key)
+        if old is not None:
+            self._discard(old)
+            self._vary[uri] = vary
+        self._entries[key] = entry
+        self._variants.setdefault(uri, set([])).add(key)
+        self.size += entry.size
+        entries = self._entries
+        while self.size > self.max_bytes and len(entries) > 0:
+            oldest = next(iter(entries))
+            self._discard(entries[oldest])
+
+    def _discard(self, entry):
+        key = entry.key
+        if self._entries.pop(key, None) is None:
+            return
+        self.size -= entry.size
+        uri = key[0]
+        variants = self._variants.get(uri)
+        if variants is not None:
+            variants.discard(key)
+        self._forget_uri(uri)
+
+    def _forget_uri(self, uri):
+        """
+        Keep the Vary names of `uri` only while some variant is cached.
+        """
+        if not self._variants.get(uri):
+            self._variants.pop(uri, None)
+            self._vary.pop(uri, None)
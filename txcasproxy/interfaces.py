@@ -17,6 +17,7 @@ class IRProxyInfoAcceptor(Interface):
     proxied_scheme = Attribute("Proxied scheme.")
     proxied_netloc = Attribute("Proxied netloc.")
     proxied_path = Attribute("Proxied path.")
+    url_mapper = Attribute("A `proxyutils.URLMapper` for the proxy and proxied URLs.")
     expire_session = Attribute("Expire a session.")
     
     def handle_rproxy_info_set():
@@ -27,19 +28,66 @@ class IRProxyInfoAcceptor(Interface):
 class IResponseContentModifier(Interface):
     
     mod_sequence = Attribute('Sequence number.')
+    content_path_prefixes = Attribute(
+        "Optional.  Proxied resource paths (and their children) whose "
+        "responses should be modified.  None means all paths.")
+    content_types = Attribute(
+        "Optional.  Media types (e.g. 'text/html' or 'text/*') of responses "
+        "that should be modified.  None means all types.")
+    max_content_size = Attribute(
+        "Optional.  Responses with a larger known length are not modified.  "
+        "Whole-body modifiers also pass larger responses of unknown length "
+        "through unmodified.")
     
     def transform_content(content, request):
         """
         Transform `content`
         """
 
+class IStreamingContentModifier(Interface):
+    
+    mod_sequence = Attribute('Sequence number.')
+    content_path_prefixes = Attribute("See `IResponseContentModifier`.")
+    content_types = Attribute("See `IResponseContentModifier`.")
+    max_content_size = Attribute("See `IResponseContentModifier`.")
+    
+    def begin_transform(request, response):
+        """
+        Return an `IContentTransformer` for the body of `response` or None
+        if this response should be left alone.
+        """
+
+class IContentTransformer(Interface):
+    
+    def transform_chunk(data):
+        """
+        Transform the next chunk of content.  Return the transformed content
+        that may be emitted now.  Content that could be part of a pattern
+        split across chunks may be held back until a later call.
+        """
+        
+    def finish():
+        """
+        The content is complete.  Return any held back content (or a 
+        deferred that fires with it).
+        """
+
 class IResourceInterceptor(Interface):
     
     interceptor_sequence = Attribute("Sequence number.")
+    intercepted_paths = Attribute(
+        "Optional.  Proxied resource paths this interceptor handles.")
+    intercepted_prefixes = Attribute(
+        "Optional.  Proxied resource paths that this interceptor handles "
+        "along with their children.  If neither `intercepted_paths` nor "
+        "`intercepted_prefixes` is declared, `should_resource_be_intercepted` "
+        "is called for every resource.")
     
     def should_resource_be_intercepted(url, method, headers, proxy_request):
         """
         Return True if resource should be intercepted.
+        `url` is a `proxyutils.ProxiedURL`, a string that also carries the
+        proxied `path` and the parsed URL `parts`.
         """
         
     def handle_resource(url, method, headers, proxy_request):
@@ -60,3 +108,47 @@ class ICASRedirectHandler(Interface):
         """
         Inspect and return a modified or unmodified service URL.
         """
+
+class ISessionStore(Interface):
+    
+    shared = Attribute("True if the store is shared with other proxy processes.")
+    
+    def get(uid):
+        """
+        Return the session info (a mapping, or a `SessionRecord`, with
+        `username`, `ticket` and `attributes` keys) for session `uid` or
+        None.  Shared stores also give the time the session logged in as
+        `started`.
+        """
+        
+    def add(uid, username, ticket, attributes):
+        """
+        Record an authenticated session.
+        """
+        
+    def remove(uid):
+        """
+        Remove session `uid`.  Return its session info or None.
+        """
+        
+    def uids_for_ticket(ticket):
+        """
+        Return a list of the IDs of sessions established with service 
+        ticket `ticket`.
+        """
+        
+    def touch(uid):
+        """
+        Note that session `uid` has been used.
+        """
+        
+    def purge_expired():
+        """
+        Remove sessions that the store has expired itself.  Return a list of 
+        `(uid, session_info)` for the removed sessions.
+        """
+        
+    def count():
+        """
+        Return the number of authenticated sessions.
+        """
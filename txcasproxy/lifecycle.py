@@ -0,0 +1,295 @@
+
+#=======================================================================
+# Lifetimes of the proxy's web sessions.
+#
+# Every web session is tracked from the moment it is created, whether or
+# not it ever authenticates.  A session that has not logged in within
+# `login_timeout` seconds is expired.  An authenticated session expires
+# after `idle_timeout` seconds without use or `absolute_timeout` seconds
+# after it authenticated, whichever comes first.  At most `max_sessions`
+# authenticated sessions (and `max_pending` unauthenticated ones) are
+# kept; the least recently used are evicted beyond that.
+#
+# Deadlines are kept on a timer wheel that is advanced periodically, so
+# expiry is done in batches instead of with a `DelayedCall` per session.
+# Using a session only records the time; its wheel entry is moved when
+# the old deadline comes up.
+#=======================================================================
+
+# Standard library
+from collections import OrderedDict
+import math
+import time
+
+# External modules
+from twisted.web.server import Session
+
+# Reasons a session ends.
+LOGIN_TIMEOUT = 'login_timeout'
+IDLE_TIMEOUT = 'idle_timeout'
+ABSOLUTE_TIMEOUT = 'absolute_timeout'
+EVICTED = 'evicted'
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel of `slots` slots, `tick` seconds each.
+
+    Keys with deadlines more than one revolution away stay in their slot
+    and are skipped until their time comes.
+    """
+
+    def __init__(self, tick=1.0, slots=1024, now=0.0):
+        self.tick = float(tick)
+        self._slots = [set() for n in range(slots)]
+        # key -> (tick number, deadline)
+        self._deadlines = {}
+        self._current = int(now // self.tick)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline):
+        """
+        Expire `key` at `deadline`, replacing any earlier schedule.
+        """
+        self.cancel(key)
+        number = max(int(math.ceil(deadline / self.tick)), self._current + 1)
+        self._deadlines[key] = (number, deadline)
+        slots = self._slots
+        slots[number % len(slots)].add(key)
+
+    def cancel(self, key):
+        entry = self._deadlines.pop(key, None)
+        if entry is not None:
+            slots = self._slots
+            slots[entry[0] % len(slots)].discard(key)
+
+    def advance(self, now):
+        """
+        Move the wheel on to `now`.  Return the keys whose deadlines have
+        passed; they are no longer scheduled.
+        """
+        last = int(now // self.tick)
+        current = self._current
+        if last <= current:
+            return []
+        slots = self._slots
+        count = len(slots)
+        deadlines = self._deadlines
+        due = []
+        # After a long pause every slot is visited once.
+        first = max(current + 1, last - count + 1)
+        for number in range(first, last + 1):
+            slot = slots[number % count]
+            for key in [key for key in slot if deadlines[key][0] <= last]:
+                slot.discard(key)
+                del deadlines[key]
+                due.append(key)
+        self._current = last
+        return due
+
+
+class _Lifetime(object):
+    __slots__ = ('started', 'last_access')
+
+    def __init__(self, started):
+        self.started = started
+        self.last_access = started
+
+
+class SessionLifecycle(object):
+    """
+    Track the lifetimes of web sessions.  When a session ends, every
+    callable in `expire_callbacks` is called with its ID and the reason.
+    Call `expire_due()` periodically (every `tick` seconds or so).
+    """
+    clock = time.time
+    max_pending = 100000
+
+    def __init__(self, idle_timeout=900, absolute_timeout=0, login_timeout=300,
+                 max_sessions=0, tick=1.0):
+        self.idle_timeout = idle_timeout
+        self.absolute_timeout = absolute_timeout
+        self.login_timeout = login_timeout
+        self.max_sessions = max_sessions
+        self.tick = tick
+        self.expire_callbacks = []
+        # uid -> _Lifetime, least recently used first.
+        self._pending = OrderedDict()
+        self._active = OrderedDict()
+        # One revolution covers the usual deadlines.
+        horizon = max(idle_timeout, login_timeout)
+        slots = min(max(int(math.ceil(horizon / float(tick))) + 1, 64), 4096)
+        self._wheel = TimerWheel(tick, slots, self.clock())
+
+    def __len__(self):
+        return len(self._pending) + len(self._active)
+
+    def count_authenticated(self):
+        return len(self._active)
+
+    def count_pending(self):
+        return len(self._pending)
+
+    def is_authenticated(self, uid):
+        return uid in self._active
+
+    def started(self, uid):
+        """
+        A web session has been created.
+        """
+        if uid in self._active or uid in self._pending:
+            return
+        now = self.clock()
+        pending = self._pending
+        pending[uid] = _Lifetime(now)
+        self._wheel.schedule(uid, now + self.login_timeout)
+        if len(pending) > self.max_pending:
+            self._end(next(iter(pending)), EVICTED)
+
+    def authenticated(self, uid, started=None):
+        """
+        Web session `uid` has logged in, now or at `started` (e.g. through
+        another process sharing the session store).
+        """
+        now = self.clock()
+        self._pending.pop(uid, None)
+        active = self._active
+        active.pop(uid, None)
+        if started is None:
+            started = now
+        lifetime = _Lifetime(started)
+        lifetime.last_access = now
+        active[uid] = lifetime
+        self._wheel.schedule(uid, self._deadline(lifetime))
+        max_sessions = self.max_sessions
+        if max_sessions > 0:
+            while len(active) > max_sessions:
+                self._end(next(iter(active)), EVICTED)
+
+    def restore(self, uid, started, last_access):
+        """
+        Track authenticated web session `uid` with the lifetime it had
+        before a restart.  Restore sessions least recently used first.
+        """
+        self._pending.pop(uid, None)
+        active = self._active
+        active.pop(uid, None)
+        lifetime = _Lifetime(started)
+        lifetime.last_access = last_access
+        active[uid] = lifetime
+        self._wheel.schedule(uid, self._deadline(lifetime))
+
+    def lifetime(self, uid):
+        """
+        Return `(started, last_access)` for authenticated web session `uid`,
+        or None.
+        """
+        lifetime = self._active.get(uid)
+        if lifetime is None:
+            return None
+        return lifetime.started, lifetime.last_access
+
+    def is_expired(self, started, last_access, now):
+        """
+        Return True if an authenticated session with this lifetime would
+        have ended by `now`.
+        """
+        lifetime = _Lifetime(started)
+        lifetime.last_access = last_access
+        return self._deadline(lifetime) <= now
+
+    def logged_out(self, uid):
+        """
+        Web session `uid` is no longer authenticated.  It gets a new login
+        timeout.
+        """
+        if self._active.pop(uid, None) is None:
+            return
+        self._wheel.cancel(uid)
+        self.started(uid)
+
+    def touch(self, uid):
+        """
+        Web session `uid` has been used.
+        """
+        active = self._active
+        lifetime = active.pop(uid, None)
+        if lifetime is not None:
+            lifetime.last_access = self.clock()
+            active[uid] = lifetime
+            return
+        pending = self._pending
+        lifetime = pending.pop(uid, None)
+        if lifetime is not None:
+            pending[uid] = lifetime
+
+    def forget(self, uid):
+        """
+        Stop tracking web session `uid` (e.g. it was expired elsewhere).
+        """
+        if self._active.pop(uid, None) is None and self._pending.pop(uid, None) is None:
+            return
+        self._wheel.cancel(uid)
+
+    def expire_due(self):
+        """
+        End the sessions whose time is up.  Return how many were ended.
+        """
+        now = self.clock()
+        wheel = self._wheel
+        active = self._active
+        ended = 0
+        for uid in wheel.advance(now):
+            lifetime = active.get(uid)
+            if lifetime is None:
+                if uid in self._pending:
+                    self._end(uid, LOGIN_TIMEOUT)
+                    ended += 1
+                continue
+            deadline = self._deadline(lifetime)
+            if deadline > now:
+                # Used since it was scheduled.
+                wheel.schedule(uid, deadline)
+                continue
+            if self.absolute_timeout > 0 and \
+                    lifetime.started + self.absolute_timeout <= now:
+                reason = ABSOLUTE_TIMEOUT
+            else:
+                reason = IDLE_TIMEOUT
+            self._end(uid, reason)
+            ended += 1
+        return ended
+
+    def _deadline(self, lifetime):
+        deadline = lifetime.last_access + self.idle_timeout
+        if self.absolute_timeout > 0:
+            deadline = min(deadline, lifetime.started + self.absolute_timeout)
+        return deadline
+
+    def _end(self, uid, reason):
+        self.forget(uid)
+        for callback in list(self.expire_callbacks):
+            callback(uid, reason)
+
+
+class ManagedSession(Session):
+    """
+    A web session whose expiry is left to the `SessionLifecycle` of its
+    site rather than to a `DelayedCall` of its own.
+    """
+
+    def startCheckingExpiration(self):
+        self.site.lifecycle.started(self.uid)
+
+    def touch(self):
+        self.lastModified = self._reactor.seconds()
+        self.site.lifecycle.touch(self.uid)
+
+    def expire(self):
+        self.site.lifecycle.forget(self.uid)
+        Session.expire(self)
@@ -0,0 +1,170 @@
+
+#=======================================================================
+# Leveled logging for the proxy.
+#
+# Messages are formatted only if their level is enabled, and debug
+# messages can be sampled.  Log lines go to the Twisted log by default,
+# or to a `BufferedLogWriter` that batches lines and writes them to a
+# file from a background thread so the reactor never waits on the disk.
+#=======================================================================
+
+# Standard library
+import threading
+import time
+
+# External modules
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+level_names = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warn': WARN,
+    'error': ERROR,
+}
+
+
+def emit_to_twisted_log(line):
+    log.msg(line)
+
+
+class Logger(object):
+    """
+    A leveled logger.  Messages are given as a format string and arguments
+    (`logger.debug("session %s expired", uid)`) and are only formatted if
+    their level is enabled.  With `debug_sample` set to N, only one of
+    every N debug messages is emitted.
+    """
+
+    def __init__(self, level=INFO, debug_sample=1, emit=emit_to_twisted_log):
+        self.emit = emit
+        self._debug_count = 0
+        self.configure(level, debug_sample)
+
+    def configure(self, level=None, debug_sample=None):
+        if level is not None:
+            self.level = level
+        if debug_sample is not None:
+            self.debug_sample = max(1, debug_sample)
+        level = self.level
+        self.debug_enabled = (level <= DEBUG)
+        self.info_enabled = (level <= INFO)
+        self.warn_enabled = (level <= WARN)
+
+    def debug(self, fmt, *args):
+        if not self.debug_enabled:
+            return
+        sample = self.debug_sample
+        if sample > 1:
+            self._debug_count += 1
+            if self._debug_count % sample != 0:
+                return
+        self._write('DEBUG', fmt, args)
+
+    def info(self, fmt, *args):
+        if self.info_enabled:
+            self._write('INFO', fmt, args)
+
+    def warn(self, fmt, *args):
+        if self.warn_enabled:
+            self._write('WARN', fmt, args)
+
+    def error(self, fmt, *args):
+        self._write('ERROR', fmt, args)
+
+    def _write(self, label, fmt, args):
+        if args:
+            try:
+                fmt = fmt % args
+            except Exception:
+                fmt = "%s %r" % (fmt, args)
+        self.emit("[%s] %s" % (label, fmt))
+
+
+class BufferedLogWriter(object):
+    """
+    Collect log lines in memory and append them to a file in batches.
+
+    A batch is written every `flush_interval` seconds, or as soon as
+    `max_buffer` bytes are waiting.  Writes happen on a single background
+    thread, so batches reach the file in order.
+    """
+
+    def __init__(self, path, flush_interval=1.0, max_buffer=65536):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._lines = []
+        self._size = 0
+        self._stamp_second = None
+        self._stamp = ''
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+        self._threadpool = ThreadPool(minthreads=1, maxthreads=1, name='log-writer')
+        self._flushCall = LoopingCall(self.flush)
+
+    def start(self):
+        self._threadpool.start()
+        self._flushCall.start(self.flush_interval, now=False)
+        reactor.addSystemEventTrigger('after', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._flushCall.running:
+            self._flushCall.stop()
+        self.flush()
+        self._threadpool.stop()
+        with self._lock:
+            self._file.close()
+
+    def __call__(self, line):
+        now = time.time()
+        second = int(now)
+        if second != self._stamp_second:
+            self._stamp_second = second
+            self._stamp = time.strftime('%Y-%m-%dT%H:%M:%S%z ', time.localtime(now))
+        line = self._stamp + line + '\n'
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size >= self.max_buffer:
+            self.flush()
+
+    def flush(self):
+        if len(self._lines) == 0:
+            return
+        data = ''.join(self._lines)
+        self._lines = []
+        self._size = 0
+        if self._threadpool.started:
+            self._threadpool.callInThread(self._write, data)
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(data)
+                self._file.flush()
+
+
+# The logger used throughout the proxy.
+logger = Logger()
+
+def configure_logging(level='info', debug_sample=1, log_file=None):
+    """
+    Configure the proxy `logger` from command line settings.
+    """
+    emit = emit_to_twisted_log
+    if log_file is not None:
+        writer = BufferedLogWriter(log_file)
+        # The writer thread must start after twistd has daemonized.
+        reactor.callWhenRunning(writer.start)
+        emit = writer
+    logger.emit = emit
+    logger.configure(level_names[level], debug_sample)
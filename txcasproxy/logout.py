@@ -0,0 +1,205 @@
+
+#=======================================================================
+# CAS single logout.
+#
+# CAS ends a session by POSTing a SAML `LogoutRequest` to the service
+# (either as the body or as the `logoutRequest` form parameter).  Any
+# unauthenticated POST could be one, so detection must be cheap: bodies
+# above a size limit are ignored, and the XML is parsed incrementally so
+# that documents with another root element are abandoned after their
+# first tag.  Logouts are queued and carried out in batches, so a burst
+# of back-channel requests from CAS does not hold up other requests.
+#=======================================================================
+
+# Standard library
+import calendar
+from collections import deque
+from cStringIO import StringIO
+import re
+import time
+
+# Application modules
+from logger import logger
+
+# External modules
+from dateutil.parser import parse as parse_date
+from lxml import etree
+from twisted.internet import reactor
+
+samlp_ns = "{urn:oasis:names:tc:SAML:2.0:protocol}"
+logout_request_tag = samlp_ns + "LogoutRequest"
+session_index_tag = samlp_ns + "SessionIndex"
+
+xml_media_types = ('text/xml', 'application/xml')
+form_media_type = 'application/x-www-form-urlencoded'
+logout_request_param = 'logoutRequest'
+
+# What may follow the seconds of a UTC `xs:dateTime`.
+utc_fraction = re.compile(r'(?:\.[0-9]+)?Z\Z')
+
+
+def parse_instant(instant):
+    """
+    Return the POSIX time for an `xs:dateTime` such as
+    `2015-06-01T12:00:00Z`, or None if it cannot be parsed.
+    """
+    # CAS sends UTC; anything else (e.g. an offset) goes the slow way.
+    if utc_fraction.match(instant, 19):
+        try:
+            return calendar.timegm(time.strptime(instant[:19], '%Y-%m-%dT%H:%M:%S'))
+        except ValueError:
+            pass
+    try:
+        parsed = parse_date(instant)
+    except (ValueError, OverflowError):
+        return None
+    if parsed.tzinfo is not None:
+        return calendar.timegm(parsed.utctimetuple())
+    return calendar.timegm(parsed.timetuple())
+
+def find_session_index(data):
+    """
+    Return `(issue_instant, session_index)` from a SAML `LogoutRequest`
+    document, or None if `data` is not one.
+    """
+    events = etree.iterparse(
+        StringIO(data),
+        events=('start', 'end'),
+        resolve_entities=False,
+        no_network=True,
+        load_dtd=False)
+    instant = None
+    indexes = []
+    try:
+        for event, elm in events:
+            if event == 'start':
+                if instant is None:
+                    # The root element.
+                    if elm.tag != logout_request_tag:
+                        return None
+                    instant = elm.get('IssueInstant', '')
+                continue
+            if elm.tag == session_index_tag:
+                indexes.append(elm.text)
+            elif elm.tag == logout_request_tag:
+                break
+    except etree.XMLSyntaxError:
+        return None
+    if instant is None or len(indexes) != 1:
+        return None
+    return instant, indexes[0]
+
+
+class LogoutDetector(object):
+    """
+    Recognize CAS single logout requests among unauthenticated POSTs.
+
+    If `logout_resource` is given, only POSTs to that path are considered.
+    Bodies larger than `max_size` bytes are not examined.  A request is
+    only accepted if its `IssueInstant` is within `skew` seconds of now.
+    """
+    clock = time.time
+
+    def __init__(self, logout_resource=None, max_size=65536, skew=5):
+        self.logout_resource = logout_resource
+        self.max_size = max_size
+        self.skew = skew
+
+    def _logout_document(self, request):
+        if request.method != 'POST':
+            return None
+        if self.logout_resource is not None and request.path != self.logout_resource:
+            return None
+        content_type = request.getHeader('content-type')
+        if content_type is None:
+            return None
+        media_type = content_type.split(';', 1)[0].strip().lower()
+        if media_type == form_media_type:
+            # Twisted has already parsed the form.
+            values = request.args.get(logout_request_param)
+            if not values or len(values) != 1 or len(values[0]) > self.max_size:
+                return None
+            return values[0]
+        if media_type not in xml_media_types:
+            return None
+        content = request.content
+        if content is None:
+            return None
+        content.seek(0, 2)
+        size = content.tell()
+        content.seek(0, 0)
+        if size > self.max_size:
+            logger.debug("XML POST of %d bytes is too large for a logout request.", size)
+            return None
+        data = content.read()
+        content.seek(0, 0)
+        return data
+
+    def ticket_to_log_out(self, request):
+        """
+        Return the service ticket that `request` asks to log out, or None if
+        it is not a valid logout request.
+        """
+        data = self._logout_document(request)
+        if data is None:
+            return None
+        found = find_session_index(data)
+        if found is None:
+            return None
+        instant, ticket = found
+        when = parse_instant(instant)
+        if when is None:
+            logger.warn("Odd issue_instant supplied: '%s'.", instant)
+            return None
+        if abs(self.clock() - when) > self.skew:
+            logger.debug("Issue instant was not within %d seconds of actual time.", self.skew)
+            return None
+        return ticket
+
+
+class LogoutQueue(object):
+    """
+    Tickets waiting to be logged out.  `logout(ticket)` is called for each,
+    at most `batch_size` per reactor turn.  At most `max_pending` tickets
+    may wait.
+    """
+    reactor = reactor
+
+    def __init__(self, logout, max_pending=10000, batch_size=200):
+        self.logout = logout
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self._tickets = deque()
+        self._queued = set([])
+        self._call = None
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def put(self, ticket):
+        """
+        Queue `ticket`.  Return False if the queue is full.
+        """
+        if ticket in self._queued:
+            return True
+        if len(self._tickets) >= self.max_pending:
+            return False
+        self._tickets.append(ticket)
+        self._queued.add(ticket)
+        if self._call is None:
+            self._call = self.reactor.callLater(0, self._drain)
+        return True
+
+    def _drain(self):
+        self._call = None
+        tickets = self._tickets
+        queued = self._queued
+        for n in range(min(self.batch_size, len(tickets))):
+            ticket = tickets.popleft()
+            queued.discard(ticket)
+            try:
+                self.logout(ticket)
+            except Exception as ex:
+                logger.error("label='Logout failed.' ticket='%s' error='%s'", ticket, ex)
+        if len(tickets) > 0:
+            self._call = self.reactor.callLater(0, self._drain)
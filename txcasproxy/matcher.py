@@ -0,0 +1,240 @@
+
+#=======================================================================
+# Matching request paths against exclusion rules.
+#
+# Rules are compiled once at startup:
+#   - exact resources go in a dictionary,
+#   - branches go in a trie keyed by path segment,
+#   - glob and regular expression patterns are combined into a single
+#     regular expression per request method.  Regular expressions that
+#     would change meaning inside a combined one (inline flags, named
+#     groups or references to groups) are matched on their own.
+# Matching a path is a dictionary lookup, a walk down the trie (one step
+# per path segment) and, apart from such expressions, at most one regular
+# expression match, however many rules there are.
+#
+# Any rule may be limited to some request methods with a prefix of
+# comma separated method names and a colon, e.g. `GET,HEAD:/health`.
+#
+# `RouteIndex` maps paths and path prefixes to plugins the same way.
+#=======================================================================
+
+# Standard library
+import fnmatch
+import re
+import sre_constants
+import sre_parse
+
+_method_prefix = re.compile(r'^([A-Z]+(?:,[A-Z]+)*):(.*)$')
+
+# The methods a rule applies to when it is not limited to some of them.
+ALL_METHODS = None
+
+
+def parse_rule(rule):
+    """
+    Split `rule` into `(methods, pattern)`.  `methods` is a frozenset of
+    method names, or `ALL_METHODS`.
+    """
+    m = _method_prefix.match(rule)
+    if m is None:
+        return ALL_METHODS, rule
+    return frozenset(m.group(1).split(',')), m.group(2)
+
+def glob_to_regex(pattern):
+    """
+    Translate a shell style glob into a regular expression matching the
+    whole path.  `*` matches across `/`.
+    """
+    regex = fnmatch.translate(pattern)
+    # Python 2 appends global flags, which may not appear in the middle of
+    # a combined expression.
+    if regex.endswith(r'\Z(?ms)'):
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+def is_self_contained(regex):
+    """
+    Return True if `regex` means the same as part of a combined expression:
+    it sets no flags, names no groups and refers to no groups by number.
+    """
+    compiled = re.compile(regex)
+    if compiled.flags != 0 or len(compiled.groupindex) > 0:
+        return False
+    return not _refers_to_groups(sre_parse.parse(regex))
+
+def _refers_to_groups(item):
+    if isinstance(item, sre_parse.SubPattern):
+        for op, av in item:
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                return True
+            if _refers_to_groups(av):
+                return True
+        return False
+    if isinstance(item, (tuple, list)):
+        for part in item:
+            if _refers_to_groups(part):
+                return True
+    return False
+
+def merge_methods(a, b):
+    if a is ALL_METHODS or b is ALL_METHODS:
+        return ALL_METHODS
+    return a | b
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'methods', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        self.methods = ALL_METHODS
+        self.terminal = False
+
+
+class PathMatcher(object):
+    """
+    Match request paths against exact resources, branches (a resource and
+    all its children), globs and regular expressions.  Regular expressions
+    are matched against the start of the path.
+    """
+
+    def __init__(self, resources=None, branches=None, globs=None, regexes=None):
+        self._exact = {}
+        self._root = _TrieNode()
+        self._has_branches = False
+        for rule in (resources or ()):
+            methods, path = parse_rule(rule)
+            if path in self._exact:
+                methods = merge_methods(self._exact[path], methods)
+            self._exact[path] = methods
+        for rule in (branches or ()):
+            methods, path = parse_rule(rule)
+            self._add_branch(path, methods)
+        patterns = []
+        for rule in (globs or ()):
+            methods, glob = parse_rule(rule)
+            patterns.append((methods, glob_to_regex(glob)))
+        for rule in (regexes or ()):
+            methods, regex = parse_rule(rule)
+            # Fail at startup on an invalid expression.
+            re.compile(regex)
+            patterns.append((methods, regex))
+        self._compile_patterns(patterns)
+
+    def _add_branch(self, path, methods):
+        if path != '/':
+            path = path.rstrip('/')
+        # As before, the branch `/` is only the root resource (and paths
+        # starting with `//`), while an empty branch is every path.
+        segments = path.split('/')
+        node = self._root
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                child = _TrieNode()
+                node.children[segment] = child
+            node = child
+        if node.terminal:
+            methods = merge_methods(node.methods, methods)
+        node.methods = methods
+        node.terminal = True
+        self._has_branches = True
+
+    def _compile_patterns(self, patterns):
+        """
+        Combine the patterns into one expression per method named by a rule,
+        plus one for all other methods.  Each method gets a list of compiled
+        expressions: the combined one, then those that cannot be combined.
+        """
+        named = set([])
+        for methods, regex in patterns:
+            if methods is not ALL_METHODS:
+                named.update(methods)
+
+        def combine(method):
+            regexes = [
+                regex for methods, regex in patterns
+                if methods is ALL_METHODS or method in methods]
+            combined = [regex for regex in regexes if is_self_contained(regex)]
+            compiled = []
+            if len(combined) > 0:
+                compiled.append(re.compile('|'.join('(?:%s)' % regex for regex in combined)))
+            compiled.extend(
+                re.compile(regex) for regex in regexes if not is_self_contained(regex))
+            return compiled
+
+        self._default_pattern = combine(None)
+        self._patterns = dict((method, combine(method)) for method in named)
+
+    def match(self, path, method='GET'):
+        methods = self._exact.get(path, False)
+        if methods is not False:
+            if methods is ALL_METHODS or method in methods:
+                return True
+        if self._has_branches:
+            node = self._root
+            for segment in path.split('/'):
+                node = node.children.get(segment)
+                if node is None:
+                    break
+                if node.terminal and (node.methods is ALL_METHODS or method in node.methods):
+                    return True
+        for pattern in self._patterns.get(method, self._default_pattern):
+            if pattern.match(path) is not None:
+                return True
+        return False
+
+
+class RouteIndex(object):
+    """
+    Map exact paths and path prefixes (a path and all its children) to
+    values.  A lookup walks up the segments of the path, so its cost
+    depends on the depth of the path rather than on the number of routes.
+    """
+
+    def __init__(self):
+        self._values = []
+        self._exact = {}
+        self._prefixes = {}
+        self._everywhere = set([])
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value, paths=None, prefixes=None):
+        position = len(self._values)
+        self._values.append(value)
+        for path in (paths or ()):
+            self._exact.setdefault(path, set([])).add(position)
+        for prefix in (prefixes or ()):
+            if prefix != '/' and prefix.endswith('/'):
+                prefix = prefix.rstrip('/')
+            if prefix in ('', '/'):
+                self._everywhere.add(position)
+            else:
+                self._prefixes.setdefault(prefix, set([])).add(position)
+
+    def lookup(self, path):
+        """
+        Return the values routed to `path`, in the order they were added.
+        """
+        matched = self._exact.get(path, None)
+        if len(self._everywhere) > 0:
+            matched = self._everywhere.union(matched or ())
+        prefixes = self._prefixes
+        if len(prefixes) > 0:
+            candidate = path
+            end = len(path)
+            while True:
+                positions = prefixes.get(candidate)
+                if positions is not None:
+                    matched = positions.union(matched or ())
+                end = path.rfind('/', 0, end)
+                if end <= 0:
+                    break
+                candidate = path[:end]
+        if not matched:
+            return []
+        values = self._values
+        return [values[position] for position in sorted(matched)]
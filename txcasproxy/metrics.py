@@ -0,0 +1,250 @@
+
+#=======================================================================
+# Prometheus style metrics.
+#
+# Recording a sample is a dictionary update (plus a bisect for
+# histograms), so metrics are always collected.  They are rendered in
+# the Prometheus text exposition format only when scraped.
+#=======================================================================
+
+# Standard library
+from bisect import bisect_left
+
+# External modules
+from klein import Klein
+from twisted.web.server import Site
+
+# Upper bounds (seconds) of the default latency histogram buckets.
+default_latency_buckets = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        values = self.values
+        values[labels] = values.get(labels, 0) - amount
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+class CallbackGauge(object):
+    """
+    A gauge whose value is computed when the metrics are scraped.
+    `callback` returns a mapping of label tuples to values.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback, labelnames=()):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = labelnames
+
+    def samples(self):
+        for labels, value in sorted(self.callback().items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=default_latency_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., sum, count]
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        values = self.values
+        buckets = self.buckets
+        entry = values.get(labels, None)
+        if entry is None:
+            entry = [0] * (len(buckets) + 3)
+            values[labels] = entry
+        entry[bisect_left(buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def samples(self):
+        name = self.name
+        labelnames = self.labelnames
+        bounds = self.buckets + (float('inf'),)
+        for labels, entry in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, entry):
+                cumulative += count
+                yield (
+                    name + '_bucket',
+                    format_labels(labelnames, labels, ('le', format_value(bound))),
+                    cumulative)
+            text_labels = format_labels(labelnames, labels)
+            yield name + '_sum', text_labels, entry[-2]
+            yield name + '_count', text_labels, entry[-1]
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class ProxyMetrics(object):
+    """
+    The metrics collected by `ProxyApp`.
+    """
+
+    def __init__(self):
+        registry = MetricsRegistry()
+        self.registry = registry
+        self.proxied_requests = registry.register(Counter(
+            'casproxy_proxied_requests_total',
+            'Requests proxied to the proxied service by response status.',
+            ('status',)))
+        self.upstream_latency = registry.register(Histogram(
+            'casproxy_upstream_latency_seconds',
+            'Time until the proxied service returned response headers.'))
+        self.upstream_in_flight = registry.register(Gauge(
+            'casproxy_upstream_in_flight',
+            'Requests to the proxied service in progress.'))
+        self.cas_validation_latency = registry.register(Histogram(
+            'casproxy_cas_validation_latency_seconds',
+            'Time taken by CAS ticket validation requests.'))
+        self.cas_validation_failures = registry.register(Counter(
+            'casproxy_cas_validation_failures_total',
+            'CAS ticket validations that did not authenticate a user.',
+            ('reason',)))
+        self.cas_redirects = registry.register(Counter(
+            'casproxy_cas_redirects_total',
+            'User agents redirected to CAS to log in.'))
+        self.single_logouts = registry.register(Counter(
+            'casproxy_single_logouts_total',
+            'CAS single logout requests that ended a session.'))
+
+    def watch_response_cache(self, cache):
+        self.response_cache_requests = self.registry.register(Counter(
+            'casproxy_response_cache_requests_total',
+            'Requests for unprotected resources by cache result '
+            '(hit, not_modified or miss).',
+            ('result',)))
+        self.registry.register(CallbackGauge(
+            'casproxy_response_cache_bytes',
+            'Approximate size of the cached responses.',
+            lambda: {(): cache.size}))
+        self.registry.register(CallbackGauge(
+            'casproxy_response_cache_entries',
+            'Cached responses.',
+            lambda: {(): len(cache)}))
+
+    def watch_sessions(self, session_store):
+        self.registry.register(CallbackGauge(
+            'casproxy_sessions',
+            'Authenticated sessions.',
+            lambda: {(): session_store.count()}))
+
+    def watch_lifecycle(self, lifecycle):
+        self.session_expirations = self.registry.register(Counter(
+            'casproxy_session_expirations_total',
+            'Web sessions ended by the session lifecycle by reason '
+            '(login_timeout, idle_timeout, absolute_timeout or evicted).',
+            ('reason',)))
+        self.registry.register(CallbackGauge(
+            'casproxy_pending_sessions',
+            'Web sessions that have not logged in yet.',
+            lambda: {(): lifecycle.count_pending()}))
+
+    def watch_pools(self, pools):
+        """
+        `pools` maps pool names to `HTTPConnectionPool` instances.  The
+        proxy counts the requests using each pool in `pool_active_requests`.
+        """
+        self.pool_active_requests = self.registry.register(Gauge(
+            'casproxy_pool_active_requests',
+            'Requests in progress, each holding a connection, in each connection pool.',
+            ('pool',)))
+        for name in pools:
+            self.pool_active_requests.set(0, (name,))
+
+        def idle_connections():
+            # HTTPConnectionPool only keeps idle connections, and has no
+            # public way to count them.
+            return dict(
+                ((name,), sum(len(c) for c in getattr(pool, '_connections', {}).values()))
+                for name, pool in pools.items())
+
+        self.registry.register(CallbackGauge(
+            'casproxy_pool_idle_connections',
+            'Idle persistent connections cached in each connection pool.',
+            idle_connections,
+            ('pool',)))
+
+
+class MetricsApp(object):
+    app = Klein()
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    @app.route("/metrics")
+    def metrics(self, request):
+        request.responseHeaders.setRawHeaders(
+            'Content-Type', ['text/plain; version=0.0.4'])
+        return self.registry.render()
+
+def makeMetricsSite(registry):
+    app = MetricsApp(registry)
+    root = app.app.resource()
+    site = Site(root)
+    return site
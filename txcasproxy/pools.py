@@ -0,0 +1,61 @@
+
+#=======================================================================
+# HTTP connection pools for the proxied service and for CAS.
+#=======================================================================
+
+# Application modules
+from logger import logger
+
+# External modules
+from twisted.internet import defer
+from twisted.web.client import HTTPConnectionPool, readBody
+
+# Settings used for options that are not specified.
+default_pool_options = {
+    'max_persistent': 2,
+    'idle_timeout': 240,
+    'retry': True,
+    'warmup': 0,
+}
+
+
+def make_connection_pool(reactor, options=None):
+    """
+    Create a persistent `HTTPConnectionPool` configured from a mapping with
+    `max_persistent` (connections cached per host), `idle_timeout`
+    (seconds an idle connection is cached) and `retry` (retry idempotent
+    requests that fail on a stale connection) keys.
+    """
+    settings = dict(default_pool_options)
+    if options is not None:
+        settings.update(options)
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = settings['max_persistent']
+    pool.cachedConnectionTimeout = settings['idle_timeout']
+    pool.retryAutomatically = settings['retry']
+    return pool
+
+def warm_pool(agent, url, connections):
+    """
+    Open up to `connections` persistent connections to the server for `url`
+    by making concurrent HEAD requests.  The connections are returned to
+    the agent's pool, so the first real requests skip TCP and TLS setup.
+    Return a deferred that fires with the number of connections opened.
+    """
+    def opened(response):
+        return readBody(response).addCallback(lambda ignored: True)
+
+    def failed(err):
+        logger.warn("Could not pre-open a connection for '%s': %s",
+            url, err.getErrorMessage())
+        return False
+
+    requests = []
+    for n in range(connections):
+        d = agent.request('HEAD', url)
+        d.addCallback(opened)
+        d.addErrback(failed)
+        requests.append(d)
+    d = defer.gatherResults(requests)
+    d.addCallback(lambda results: len([r for r in results if r]))
+    return d
@@ -1,7 +1,15 @@
 
 
+# Standard library
 import urlparse
 
+# Application modules
+from cache import LRUCache
+
+default_ports = {'http': 80, 'https': 443}
+
+_missing = object()
+
 def is_proxy_path_or_child(proxied_path, path):
     if path == proxied_path:
         return True
@@ -12,20 +20,215 @@ def is_proxy_path_or_child(proxied_path, path):
 
 is_resource_or_child = is_proxy_path_or_child
 
+
+class ProxiedURL(str):
+    """
+    A proxied URL that carries its path and, parsed on first use, its
+    components, so plugins need not parse the URL again.
+    """
+
+    def __new__(cls, url, path):
+        self = str.__new__(cls, url)
+        self.path = path
+        self._parts = None
+        return self
+
+    @property
+    def parts(self):
+        parts = self._parts
+        if parts is None:
+            parts = urlparse.urlparse(self)
+            self._parts = parts
+        return parts
+
+def parse_url(url):
+    """
+    Return the components of `url`, parsing it only if it is not a
+    `ProxiedURL`.
+    """
+    if isinstance(url, ProxiedURL):
+        return url.parts
+    return urlparse.urlparse(url)
+
+def url_path(url):
+    """
+    Return the path of `url`.
+    """
+    if isinstance(url, ProxiedURL):
+        return url.path
+    return urlparse.urlparse(url).path
+
+def make_netloc(host, port, scheme=None):
+    """
+    Return `host:port`, or just `host` if `port` is None or the default port
+    for `scheme`.
+    """
+    if port is None or default_ports.get(scheme) == port:
+        return host
+    return "%s:%d" % (host, port)
+
+def split_netloc(netloc, scheme):
+    """
+    Return `(host, port)` for `netloc`, filling in the default port for
+    `scheme`.
+    """
+    host, sep, port = netloc.rpartition(':')
+    if sep == '' or not port.isdigit() or host.endswith(':'):
+        # No port (or a bare IPv6 address).
+        return netloc, default_ports.get(scheme)
+    return host, int(port)
+
+
+class URLMapper(object):
+    """
+    Map URLs between the proxy and the proxied service.
+
+    Built once from the proxy and proxied base URLs: mapping a URL compares
+    it with precomputed prefixes (a URL may name a host with or without its
+    default port) and results are kept in a bounded cache.
+    """
+
+    def __init__(self, proxy_scheme, proxy_fqdn, proxy_port, proxied_url, cache_size=1000):
+        if proxy_port is None:
+            proxy_port = default_ports[proxy_scheme]
+        self.proxy_scheme = proxy_scheme
+        self.proxy_fqdn = proxy_fqdn
+        self.proxy_port = proxy_port
+        self.proxy_base = "%s://%s" % (
+            proxy_scheme, make_netloc(proxy_fqdn, proxy_port, proxy_scheme))
+        p = urlparse.urlparse(proxied_url)
+        proxied_path = p.path
+        if proxied_path.endswith('/'):
+            proxied_path = proxied_path[:-1]
+        self.proxied_path = proxied_path
+        proxied_host, proxied_port = split_netloc(p.netloc, p.scheme)
+        self.proxied_base = "%s://%s" % (
+            p.scheme, make_netloc(proxied_host, proxied_port, p.scheme))
+        self._proxied_origins = self._origins(proxied_host, proxied_port)
+        self._proxy_origins = self._origins(proxy_fqdn, proxy_port)
+        self._to_proxy_cache = LRUCache(cache_size)
+        self._to_proxied_cache = LRUCache(cache_size)
+
+    @staticmethod
+    def _origins(host, port):
+        """
+        Lower case `scheme://netloc` spellings of a host and port.  The scheme
+        is not significant; services often redirect to `https` URLs when TLS
+        is terminated in front of them.
+        """
+        host = host.lower()
+        origins = set([])
+        for scheme, default_port in default_ports.items():
+            origins.add("%s://%s:%d" % (scheme, host, port))
+            if port == default_port:
+                origins.add("%s://%s" % (scheme, host))
+        # Longest first, so 'host:8080' is not taken for 'host' and a port.
+        return sorted(origins, key=len, reverse=True)
+
+    @staticmethod
+    def _split_origin(url, origins):
+        """
+        Return the rest of `url` after one of `origins`, or None.
+        """
+        for origin in origins:
+            size = len(origin)
+            if url[:size].lower() == origin:
+                rest = url[size:]
+                if rest == '' or rest[0] in '/?#':
+                    return rest
+        return None
+
+    def _strip_proxied_path(self, rest):
+        """
+        Return the proxy path (and query) for `rest`, the proxied path (and
+        query) of a URL, or None if it is not under the proxied path.
+        """
+        proxied_path = self.proxied_path
+        if proxied_path != '':
+            if not rest.startswith(proxied_path):
+                return None
+            rest = rest[len(proxied_path):]
+        if rest == '' or rest[0] in '?#':
+            return '/' + rest
+        if rest[0] != '/':
+            return None
+        return rest
+
+    def proxied_url_to_proxy_url(self, url):
+        """
+        Return the proxy URL for `url`, an absolute URL or absolute path on
+        the proxied service, or None if `url` is not under the proxied URL.
+        """
+        cache = self._to_proxy_cache
+        result = cache.get(url, _missing)
+        if result is not _missing:
+            return result
+        result = None
+        if url.startswith('/') and not url.startswith('//'):
+            rest = url
+        else:
+            rest = self._split_origin(url, self._proxied_origins)
+        if rest is not None:
+            rest = self._strip_proxied_path(rest)
+            if rest is not None:
+                result = self.proxy_base + rest
+        cache.set(url, result)
+        return result
+
+    def proxy_url_to_proxied_url(self, url):
+        """
+        Return the proxied URL for `url`, an absolute URL on the proxy, or
+        None if `url` is not on the proxy.
+        """
+        cache = self._to_proxied_cache
+        result = cache.get(url, _missing)
+        if result is not _missing:
+            return result
+        result = None
+        rest = self._split_origin(url, self._proxy_origins)
+        if rest is not None:
+            if rest == '' or rest[0] != '/':
+                rest = '/' + rest
+            result = self.proxied_base + self.proxied_path + rest
+        cache.set(url, result)
+        return result
+
+    def proxy_url(self, uri):
+        """
+        Return the absolute proxy URL for the request URI `uri`.
+        """
+        if not uri.startswith('/'):
+            # An absolute request URI; only its path and query are ours.
+            p = urlparse.urlparse(uri)
+            uri = urlparse.urlunparse(('', '', p.path or '/', p.params, p.query, ''))
+        return self.proxy_base + uri
+
+    def url_prefix_pairs(self):
+        """
+        Return `(proxied prefix, proxy prefix)` pairs, longest first, for
+        rewriting URLs embedded in content.  The prefixes end with `/` so
+        that they cannot match another host or a longer path segment.
+        """
+        pairs = []
+        for origin in self._proxied_origins:
+            pairs.append((origin + self.proxied_path + '/', self.proxy_base + '/'))
+        return pairs
+
+
 def proxied_url_to_proxy_url(proxy_scheme, proxy_fqdn, proxy_port, proxied_netloc, proxied_path, target_url):
     p = urlparse.urlparse(target_url)
     if p.netloc == proxied_netloc:
         target_path = p.path
         if p.path.startswith(proxied_path):
             new_target_path = target_path[len(proxied_path):]
-            proxy_netloc = "%s:%d" % (proxy_fqdn, proxy_port)
+            proxy_netloc = make_netloc(proxy_fqdn, proxy_port, proxy_scheme)
             p = urlparse.ParseResult(*tuple((proxy_scheme,) + (proxy_netloc, new_target_path) + p[3:]))
             new_target_url = urlparse.urlunparse(p)
             return new_target_url
     return None
     
 def proxy_url_to_proxied_url(proxied_scheme, proxy_fqdn, proxy_port, proxied_netloc, proxied_path, target_url):
-    proxy_netloc = "%s:%d" % (proxy_fqdn, proxy_port)
+    proxy_netloc = make_netloc(proxy_fqdn, proxy_port)
     p = urlparse.urlparse(target_url)
     if p.netloc == proxy_netloc:
         target_path = p.path
@@ -39,4 +242,3 @@ def proxy_url_to_proxied_url(proxied_scheme, proxy_fqdn, proxy_port, proxied_net
         new_target_url = urlparse.urlunparse(p)
         return new_target_url
     return None
-        
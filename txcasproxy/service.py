@@ -2,18 +2,39 @@
 import sys
 from txcasproxy import ProxyApp
 from authinfo import AuthInfoApp
+from metrics import makeMetricsSite
+from sessionstore import SessionStoreSite
+from snapshot import restore_sessions, save_sessions
+from static import StaticFileCache
+from workers import adopt_listening_socket
 from twisted.application.service import Service
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.internet.endpoints import serverFromString
 from twisted.web.server import Site
 
 class ProxyService(Service):
+    sessionPurgeInterval = 60
+
     def __init__(self, endpoint_s, proxied_url, cas_info, 
                     fqdn=None, authorities=None, plugins=None,
                     authInfoResource=None, authInfoEndpointStr=None,
-                    excluded_resources=None, excluded_branches=None): 
+                    excluded_resources=None, excluded_branches=None,
+                    session_store=None, inherited_fd=None,
+                    validation_cache_ttl=None, backend_pool_options=None,
+                    cas_pool_options=None, metricsEndpointStr=None,
+                    server_timing=False, timing_log=False,
+                    excluded_globs=None, excluded_regexes=None,
+                    request_header_rules=None, response_header_rules=None,
+                    forwarded_headers=True, response_cache=None,
+                    static_max_age=None, static_cache_size=None,
+                    compression=None, lifecycle=None, 
+                    session_snapshot=None, snapshot_interval=60,
+                    logout_resource=None, logout_max_size=65536): 
         self.port_s = endpoint_s
+        self.inheritedFD = inherited_fd
         self.authInfoEndpointStr = authInfoEndpointStr
+        self.metricsEndpointStr = metricsEndpointStr
         if endpoint_s.startswith("ssl:"):
             is_https = True
         else:
@@ -28,15 +49,60 @@ class ProxyService(Service):
             plugins=plugins,
             is_https=is_https,
             excluded_resources=excluded_resources,
-            excluded_branches=excluded_branches)
+            excluded_branches=excluded_branches,
+            excluded_globs=excluded_globs,
+            excluded_regexes=excluded_regexes,
+            session_store=session_store,
+            backend_pool_options=backend_pool_options,
+            cas_pool_options=cas_pool_options,
+            request_header_rules=request_header_rules,
+            response_header_rules=response_header_rules,
+            forwarded_headers=forwarded_headers,
+            response_cache=response_cache,
+            compression=compression,
+            lifecycle=lifecycle,
+            logout_resource=logout_resource,
+            logout_max_size=logout_max_size)
         app.authInfoResource = authInfoResource
+        app.server_timing = server_timing
+        app.timing_log = timing_log
+        if validation_cache_ttl is not None:
+            app.validation_cache_ttl = validation_cache_ttl
+        if static_max_age is not None:
+            app.static_max_age = static_max_age
+        if static_cache_size is not None:
+            if static_cache_size > 0:
+                app.static_cache = StaticFileCache(static_cache_size)
+            else:
+                app.static_cache = None
         root = app.app.resource()
         self.app = app
-        self.site = Site(root)
+        self.site = SessionStoreSite(root)
+        self.site.session_store = app.session_store
+        self.site.session_timed_out = app._session_timed_out
+        if lifecycle is not None:
+            self.site.manage_sessions(lifecycle)
+        self.lifecycle = lifecycle
+        if session_snapshot is not None and lifecycle is None:
+            # Without session lifetimes, expired sessions would be restored.
+            raise ValueError("Session snapshots require a session lifecycle.")
+        self.sessionSnapshot = session_snapshot
+        self.snapshotInterval = snapshot_interval
         self.listeningPorts = []
+        self.sessionPurgeCall = None
+        self.lifecycleCall = None
+        self.snapshotCall = None
 
     def startService(self):
-        if self.port_s is not None:
+        if self.sessionSnapshot is not None:
+            restore_sessions(self.sessionSnapshot, self.app.session_store, self.lifecycle)
+            self.snapshotCall = LoopingCall(self.save_sessions)
+            self.snapshotCall.start(self.snapshotInterval, now=False)
+        if self.inheritedFD is not None:
+            # Worker process: serve the socket created by the supervisor.
+            port = adopt_listening_socket(self.port_s, self.inheritedFD, self.site)
+            self.register_port(port, 'app')
+        elif self.port_s is not None:
             endpoint = serverFromString(reactor, self.port_s)
             d = endpoint.listen(self.site)
             d.addCallback(self.register_port, 'app')
@@ -47,6 +113,18 @@ class ProxyService(Service):
             endpoint = serverFromString(reactor, self.authInfoEndpointStr)
             d2 = endpoint.listen(authInfoSite)
             d2.addCallback(self.register_port, 'authInfoSite')
+        if self.metricsEndpointStr is not None:
+            metricsSite = makeMetricsSite(self.app.metrics.registry)
+            endpoint = serverFromString(reactor, self.metricsEndpointStr)
+            d3 = endpoint.listen(metricsSite)
+            d3.addCallback(self.register_port, 'metricsSite')
+        self.app.warm_up()
+        if self.app.session_store.shared:
+            self.sessionPurgeCall = LoopingCall(self.app.purge_sessions)
+            self.sessionPurgeCall.start(self.sessionPurgeInterval, now=False)
+        if self.lifecycle is not None:
+            self.lifecycleCall = LoopingCall(self.lifecycle.expire_due)
+            self.lifecycleCall.start(self.lifecycle.tick, now=False)
             
     def register_port(self, listeningPort, serviceName):
         self.listeningPorts.append(listeningPort)
@@ -56,7 +134,21 @@ class ProxyService(Service):
             self.app.handle_port_set()
         if serviceName == 'authInfoSite':
             self.app.authInfoCallback = self.authInfoApp.setAuthInfo
+            if self.sessionSnapshot is not None:
+                # Sessions restored from the snapshot are already established.
+                for uid, record in self.app.session_store.records():
+                    self.authInfoApp.setAuthInfo(record.username, record.attributes)
+
+    def save_sessions(self):
+        save_sessions(self.sessionSnapshot, self.app.session_store, self.lifecycle)
 
     def stopService(self):
+        if self.sessionPurgeCall is not None and self.sessionPurgeCall.running:
+            self.sessionPurgeCall.stop()
+        if self.lifecycleCall is not None and self.lifecycleCall.running:
+            self.lifecycleCall.stop()
+        if self.snapshotCall is not None and self.snapshotCall.running:
+            self.snapshotCall.stop()
+            self.save_sessions()
         for listeningPort in self.listeningPorts:
             listeningPort.stopListening()
@@ -0,0 +1,418 @@
+
+#=======================================================================
+# Storage for authenticated proxy sessions.
+#
+# The memory store keeps sessions in the proxy process.  The SQLite
+# store keeps them in a database file (WAL mode) that several proxy
+# processes on the same host can share, so a session established or
+# logged out through one process is seen by all of them.
+#
+# In memory, a session is a small `SessionRecord`.  The username and
+# attributes of a user are held once in a `UserAttributes` object that
+# all the sessions of that user share.
+#=======================================================================
+
+# Standard library
+import json
+import sqlite3
+import time
+
+# Application modules
+from interfaces import ISessionStore
+from lifecycle import ManagedSession
+
+# External modules
+from twisted.web.server import Site
+from zope.interface import implementer
+
+
+class FrozenAttributes(dict):
+    """
+    An attribute mapping that cannot be changed.
+    """
+
+    def _read_only(self, *args, **kwds):
+        raise TypeError("Session attributes are read-only.")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (FrozenAttributes, (dict(self),))
+
+
+class UserAttributes(object):
+    """
+    The username and attributes of a user, shared by the sessions that have
+    the same ones.  The attributes are a `FrozenAttributes` of tuples, so
+    they cannot be changed through one session.  Attribute names and
+    values are interned, so values common to many users (e.g. group names)
+    are held once.
+    """
+    __slots__ = ('key', 'username', 'attributes', 'refs')
+
+    def __init__(self, key, username, attributes):
+        self.key = key
+        self.username = username
+        self.attributes = attributes
+        self.refs = 0
+
+
+def _intern(value):
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+class AttributeTable(object):
+    """
+    Interned `UserAttributes`, reference counted by the sessions that use
+    them.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def acquire(self, username, attributes):
+        """
+        Return the shared `UserAttributes` for `username` and `attributes`
+        (a mapping of names to lists of values) with a reference added.
+        """
+        items = tuple(sorted(
+            (_intern(name), tuple(_intern(value) for value in values))
+            for name, values in attributes.iteritems()))
+        key = (username, items)
+        entries = self._entries
+        entry = entries.get(key)
+        if entry is None:
+            entry = UserAttributes(key, _intern(username), FrozenAttributes(items))
+            entries[key] = entry
+        entry.refs += 1
+        return entry
+
+    def release(self, entry):
+        entry.refs -= 1
+        if entry.refs <= 0:
+            self._entries.pop(entry.key, None)
+
+
+class SessionRecord(object):
+    """
+    An authenticated session.  Also readable as a mapping with `username`,
+    `ticket` and `attributes` keys.
+    """
+    __slots__ = ('ticket', 'user')
+
+    fields = frozenset(['username', 'ticket', 'attributes'])
+
+    def __init__(self, ticket, user):
+        self.ticket = ticket
+        self.user = user
+
+    @property
+    def username(self):
+        return self.user.username
+
+    @property
+    def attributes(self):
+        return self.user.attributes
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        return getattr(self, key)
+
+
+@implementer(ISessionStore)
+class MemorySessionStore(object):
+    """
+    Sessions held in dictionaries in this process.
+    """
+    shared = False
+
+    def __init__(self):
+        self.valid_sessions = {}
+        self.logout_tickets = {}
+        self.user_attributes = AttributeTable()
+
+    def get(self, uid):
+        return self.valid_sessions.get(uid, None)
+
+    def add(self, uid, username, ticket, attributes):
+        if uid in self.valid_sessions:
+            self.remove(uid)
+        user = self.user_attributes.acquire(username, attributes)
+        self.valid_sessions[uid] = SessionRecord(ticket, user)
+        uids = self.logout_tickets.setdefault(ticket, [])
+        if uid not in uids:
+            uids.append(uid)
+
+    def remove(self, uid):
+        session_info = self.valid_sessions.pop(uid, None)
+        if session_info is not None:
+            self.user_attributes.release(session_info.user)
+            ticket = session_info.ticket
+            logout_tickets = self.logout_tickets
+            uids = logout_tickets.get(ticket, None)
+            if uids is not None and uid in uids:
+                uids.remove(uid)
+                if len(uids) == 0:
+                    del logout_tickets[ticket]
+        return session_info
+
+    def uids_for_ticket(self, ticket):
+        return list(self.logout_tickets.get(ticket, ()))
+
+    def records(self):
+        """
+        Return an iterator over `(uid, SessionRecord)` for all sessions.
+        """
+        return self.valid_sessions.iteritems()
+
+    def touch(self, uid):
+        pass
+
+    def purge_expired(self):
+        return []
+
+    def count(self):
+        return len(self.valid_sessions)
+
+
+@implementer(ISessionStore)
+class SQLiteSessionStore(object):
+    """
+    Sessions held in an SQLite database in WAL mode that can be shared by
+    several proxy processes on the same host.
+
+    Calls block, but local WAL reads and single row writes take a few
+    microseconds, which is cheaper than a round trip to a network store.
+    Sessions that have not been used by any process for `idle_timeout`
+    seconds, or that logged in more than `absolute_timeout` seconds ago
+    (if that is set), are removed by `purge_expired()`.  Access times are
+    written at most once every `touch_interval` seconds per session per
+    process.
+    """
+    shared = True
+    clock = time.time
+
+    def __init__(self, path, idle_timeout=900, touch_interval=60, absolute_timeout=0):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.absolute_timeout = absolute_timeout
+        self.touch_interval = touch_interval
+        self._touched = {}
+        db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        # Session data is handled as byte strings, as the memory store keeps it.
+        db.text_factory = str
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "uid TEXT PRIMARY KEY, "
+            "username TEXT NOT NULL, "
+            "ticket TEXT NOT NULL, "
+            "attributes TEXT NOT NULL, "
+            "started REAL NOT NULL, "
+            "last_access REAL NOT NULL)")
+        columns = [row[1] for row in db.execute("PRAGMA table_info(sessions)")]
+        if 'started' not in columns:
+            # A database from before login times were kept.
+            db.execute("ALTER TABLE sessions ADD COLUMN started REAL")
+            db.execute("UPDATE sessions SET started = last_access")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_ticket ON sessions (ticket)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_access ON sessions (last_access)")
+        self._db = db
+
+    def get(self, uid):
+        row = self._db.execute(
+            "SELECT username, ticket, attributes, started FROM sessions WHERE uid = ?",
+            (uid,)).fetchone()
+        if row is None:
+            return None
+        username, ticket, attributes, started = row
+        return {
+            'username': username,
+            'ticket': ticket,
+            'attributes': _load_attributes(attributes),
+            'started': started}
+
+    def add(self, uid, username, ticket, attributes):
+        now = self.clock()
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions "
+            "(uid, username, ticket, attributes, started, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (uid, username, ticket, json.dumps(attributes), now, now))
+        self._touched[uid] = now
+
+    def remove(self, uid):
+        self._touched.pop(uid, None)
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            session_info = self.get(uid)
+            if session_info is not None:
+                db.execute("DELETE FROM sessions WHERE uid = ?", (uid,))
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return session_info
+
+    def uids_for_ticket(self, ticket):
+        rows = self._db.execute(
+            "SELECT uid FROM sessions WHERE ticket = ?", (ticket,)).fetchall()
+        return [row[0] for row in rows]
+
+    def touch(self, uid):
+        now = self.clock()
+        touched = self._touched
+        if now - touched.get(uid, 0) < self.touch_interval:
+            return
+        touched[uid] = now
+        self._db.execute(
+            "UPDATE sessions SET last_access = ? WHERE uid = ?", (now, uid))
+
+    def purge_expired(self):
+        """
+        Remove sessions that have been idle for longer than the idle timeout
+        or have outlived the absolute timeout.  Return a list of
+        `(uid, session_info)` for the removed sessions.
+        """
+        now = self.clock()
+        cutoff = now - self.idle_timeout
+        if self.absolute_timeout > 0:
+            started_cutoff = now - self.absolute_timeout
+        else:
+            started_cutoff = float('-inf')
+        db = self._db
+        expired = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                "SELECT uid, username, ticket, attributes, started FROM sessions "
+                "WHERE last_access < ? OR started < ?", (cutoff, started_cutoff)).fetchall()
+            db.execute(
+                "DELETE FROM sessions WHERE last_access < ? OR started < ?",
+                (cutoff, started_cutoff))
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        touched = self._touched
+        for uid, username, ticket, attributes, started in rows:
+            touched.pop(uid, None)
+            expired.append((uid, {
+                'username': username,
+                'ticket': ticket,
+                'attributes': _load_attributes(attributes),
+                'started': started}))
+        return expired
+
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def utf8(value):
+    """
+    Return `value` as a UTF-8 encoded `str` if it is unicode (as strings
+    loaded from JSON are), so session data is always byte strings.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def utf8_attributes(attributes):
+    """
+    Return a copy of an attribute mapping with names and values passed
+    through `utf8()`.
+    """
+    return dict(
+        (utf8(name), [utf8(value) for value in values])
+        for name, values in attributes.iteritems())
+
+def _load_attributes(text):
+    return utf8_attributes(json.loads(text))
+
+
+def make_session_store(spec, idle_timeout=900, absolute_timeout=0):
+    """
+    Create a session store from a specification string:
+
+    - `memory`: sessions are kept in this process (the default).
+    - `sqlite:PATH`: sessions are kept in a shared SQLite database, which
+      purges sessions no process has used for `idle_timeout` seconds or
+      that logged in more than `absolute_timeout` seconds ago.
+    """
+    if spec is None or spec == 'memory':
+        return MemorySessionStore()
+    kind, sep, arg = spec.partition(':')
+    if kind == 'sqlite' and arg != '':
+        return SQLiteSessionStore(
+            arg, idle_timeout=idle_timeout, absolute_timeout=absolute_timeout)
+    raise ValueError("Invalid session store '{0}'.".format(spec))
+
+
+class SessionStoreSite(Site):
+    """
+    A `Site` that accepts session cookies for sessions it did not create
+    itself as long as they are present in the session store.  This lets
+    a session established by one proxy process be used with any other
+    process sharing the store.
+
+    If a `SessionLifecycle` is given to `manage_sessions()`, it decides
+    when web sessions expire.  `session_timed_out`, if set, is called with
+    the ID of an adopted web session when it expires, as the proxy does
+    for the web sessions that log in through it.
+    """
+    session_store = None
+    lifecycle = None
+    session_timed_out = None
+
+    def manage_sessions(self, lifecycle):
+        self.lifecycle = lifecycle
+        self.sessionFactory = ManagedSession
+        lifecycle.expire_callbacks.append(self._session_ended)
+
+    def _session_ended(self, uid, reason):
+        session = self.sessions.get(uid)
+        if session is not None:
+            session.expire()
+
+    def getSession(self, uid):
+        try:
+            return Site.getSession(self, uid)
+        except KeyError:
+            session_store = self.session_store
+            if session_store is None:
+                raise
+            session_info = session_store.get(uid)
+            if session_info is None:
+                raise
+        lifecycle = self.lifecycle
+        adopting = lifecycle is not None and not lifecycle.is_authenticated(uid)
+        # Keep the time the session logged in (through whichever process),
+        # so its maximum lifetime is not restarted by adopting it.
+        started = session_info.get('started')
+        if adopting and started is not None:
+            now = lifecycle.clock()
+            if lifecycle.is_expired(started, now, now):
+                raise KeyError(uid)
+        session = self.sessionFactory(self, uid)
+        self.sessions[uid] = session
+        session_timed_out = self.session_timed_out
+        if session_timed_out is not None:
+            session.notifyOnExpire(lambda: session_timed_out(uid))
+        session.startCheckingExpiration()
+        if adopting:
+            lifecycle.authenticated(uid, started)
+        return session
@@ -0,0 +1,148 @@
+
+#=======================================================================
+# Snapshots of the memory session store, so authenticated sessions
+# survive a restart of the proxy.
+#
+# A snapshot is a file of JSON lines: a header, then each distinct set of
+# user attributes once, then the sessions (least recently used first)
+# with their ticket, user and lifetime.  The ticket index is rebuilt from
+# the sessions when they are restored.  Snapshots are written to a
+# temporary file that replaces the previous snapshot once complete, and
+# are readable only by their owner since session IDs are credentials.
+#=======================================================================
+
+# Standard library
+import json
+import os
+import time
+
+# Application modules
+from logger import logger
+from sessionstore import utf8, utf8_attributes
+
+snapshot_format = 'txcasproxy-sessions'
+snapshot_version = 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SessionSnapshot(object):
+    """
+    Save and restore the sessions of a `MemorySessionStore` and their
+    lifetimes in a `SessionLifecycle` to and from `path`.
+    """
+    clock = time.time
+
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, store, lifecycle):
+        """
+        Write a snapshot of `store`.  Return the number of sessions written.
+        """
+        now = self.clock()
+        sessions = []
+        for uid, record in store.records():
+            lifetime = lifecycle.lifetime(uid)
+            if lifetime is None:
+                lifetime = (now, now)
+            sessions.append((lifetime[1], lifetime[0], uid, record))
+        sessions.sort(key=lambda session: session[0])
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write = f.write
+                dumps = json.dumps
+                write(dumps({
+                    'format': snapshot_format,
+                    'version': snapshot_version,
+                    'written': now}))
+                write('\n')
+                users = {}
+                for last_access, started, uid, record in sessions:
+                    user = record.user
+                    index = users.get(id(user))
+                    if index is None:
+                        index = len(users)
+                        users[id(user)] = index
+                        write(dumps(['u', index, user.username, user.attributes]))
+                        write('\n')
+                    write(dumps(['s', uid, record.ticket, index, started, last_access]))
+                    write('\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        os.rename(tmp_path, self.path)
+        return len(sessions)
+
+    def load(self, store, lifecycle):
+        """
+        Add the sessions of the snapshot that have not expired by the
+        limits of `lifecycle` to `store` and `lifecycle`.  Return the
+        number of sessions restored.
+        Raise `SnapshotError` if the snapshot cannot be read.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        now = self.clock()
+        restored = 0
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header.get('format') != snapshot_format:
+                    raise SnapshotError("'{0}' is not a session snapshot.".format(self.path))
+                if header.get('version') != snapshot_version:
+                    raise SnapshotError("Unsupported session snapshot version {0}.".format(
+                        header.get('version')))
+                users = {}
+                for line in f:
+                    entry = json.loads(line)
+                    if entry[0] == 'u':
+                        index, username, attributes = entry[1:]
+                        users[index] = (utf8(username), utf8_attributes(attributes))
+                        continue
+                    uid, ticket, index, started, last_access = entry[1:]
+                    if lifecycle.is_expired(started, last_access, now):
+                        continue
+                    uid = utf8(uid)
+                    username, attributes = users[index]
+                    store.add(uid, username, utf8(ticket), attributes)
+                    lifecycle.restore(uid, started, last_access)
+                    restored += 1
+        except (IOError, ValueError, KeyError, IndexError, TypeError, AttributeError) as ex:
+            raise SnapshotError("Could not read session snapshot '{0}': {1}".format(self.path, ex))
+        return restored
+
+
+def restore_sessions(snapshot, store, lifecycle):
+    """
+    Restore sessions from `snapshot`, logging the outcome.  A snapshot that
+    cannot be read is logged and ignored.
+    """
+    try:
+        count = snapshot.load(store, lifecycle)
+    except SnapshotError as ex:
+        logger.error("label='Session snapshot not restored.' error='%s'", ex)
+        return 0
+    logger.info("label='Restored sessions.' count=%d path='%s'", count, snapshot.path)
+    return count
+
+def save_sessions(snapshot, store, lifecycle):
+    """
+    Save a snapshot, logging failures rather than raising them.
+    """
+    try:
+        count = snapshot.save(store, lifecycle)
+    except (IOError, OSError) as ex:
+        logger.error("label='Session snapshot not saved.' error='%s'", ex)
+        return 0
+    logger.debug("label='Saved sessions.' count=%d path='%s'", count, snapshot.path)
+    return count
@@ -0,0 +1,169 @@
+
+#=======================================================================
+# Static resources of plugins (`IStaticResourceProvider`).
+#
+# Files get a strong entity tag (inode, size and modification time) and
+# may be cached by user agents for `max_age` seconds.  A precompressed
+# `.gz` sibling that is at least as recent as the file is served to user
+# agents that accept gzip.  Small files are answered from memory; larger
+# ones are streamed from disk by `twisted.web.static.File`, which also
+# handles byte ranges.
+#=======================================================================
+
+# Standard library
+from collections import OrderedDict
+import errno
+
+# Application modules
+from headers import accepts_encoding
+from httpcache import etag_matches
+
+# External modules
+from twisted.web import http
+from twisted.web.static import File, getTypeAndEncoding
+
+
+class StaticFileCache(object):
+    """
+    The contents of small static files, limited to `max_bytes` in total
+    and `max_file_size` per file.  Contents are looked up by path, size
+    and modification time, so a changed file is read again.
+    """
+
+    def __init__(self, max_bytes, max_file_size=65536):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.size = 0
+        # (path, size, mtime) -> contents, least recently used first.
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entries = self._entries
+        data = entries.pop(key, None)
+        if data is not None:
+            entries[key] = data
+        return data
+
+    def set(self, key, data):
+        if len(data) > self.max_file_size:
+            return
+        entries = self._entries
+        old = entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            oldest, old = entries.popitem(last=False)
+            self.size -= len(old)
+
+
+class StaticFile(File):
+    """
+    A `File` for static resources: no directory listings, entity tags,
+    `Cache-Control`, precompressed variants and small files from memory.
+    """
+    max_age = 86400
+    memory_cache = None
+
+    def directoryListing(self):
+        return self.forbidden
+
+    def createSimilarFile(self, path):
+        f = File.createSimilarFile(self, path)
+        f.max_age = self.max_age
+        f.memory_cache = self.memory_cache
+        return f
+
+    def etag(self):
+        return '"{0:x}-{1:x}-{2:x}"'.format(
+            self.getInodeNumber(),
+            self.getsize(),
+            int(self.getModificationTime() * 1000000))
+
+    def compressed_variant(self):
+        """
+        Return the fresh `.gz` sibling of this file, or None.
+        """
+        if self.encoding is not None:
+            return None
+        gz = self.createSimilarFile(self.path + '.gz')
+        if not gz.isfile() or gz.getModificationTime() < self.getModificationTime():
+            return None
+        return gz
+
+    def render_GET(self, request):
+        self.restat(False)
+        if not self.exists():
+            return self.childNotFound.render(request)
+        if self.isdir():
+            return self.redirect(request)
+        if self.type is None:
+            self.type, self.encoding = getTypeAndEncoding(
+                self.basename(),
+                self.contentTypes,
+                self.contentEncodings,
+                self.defaultType)
+        request_headers = request.requestHeaders
+        variant = self
+        gz = self.compressed_variant()
+        if gz is not None:
+            request.setHeader('vary', 'Accept-Encoding')
+            if accepts_encoding(request_headers.getRawHeaders('accept-encoding'), 'gzip'):
+                variant = gz
+                variant.type = self.type
+                variant.encoding = 'gzip'
+        etag = variant.etag()
+        request.setHeader('etag', etag)
+        request.setHeader('cache-control', 'public, max-age={0}'.format(self.max_age))
+        if_none_match = request_headers.getRawHeaders('if-none-match')
+        if if_none_match is not None:
+            if etag_matches(etag, ','.join(if_none_match)):
+                request.setResponseCode(http.NOT_MODIFIED)
+                return ''
+            # `If-Modified-Since` is ignored when there are entity tags.
+            request_headers.removeHeader('if-modified-since')
+        cache = self.memory_cache
+        if cache is not None and variant.getsize() <= cache.max_file_size and \
+                not request_headers.hasHeader('range'):
+            return variant.render_from_memory(request, cache)
+        return File.render_GET(variant, request)
+    render_HEAD = render_GET
+
+    def render_from_memory(self, request, cache):
+        mtime = self.getModificationTime()
+        key = (self.path, self.getsize(), mtime)
+        data = cache.get(key)
+        if data is None:
+            try:
+                f = self.openForReading()
+            except IOError as e:
+                if e.errno == errno.EACCES:
+                    return self.forbidden.render(request)
+                raise
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            cache.set(key, data)
+        if request.setLastModified(mtime) is http.CACHED:
+            return ''
+        request.setHeader('accept-ranges', 'bytes')
+        self._setContentHeaders(request, len(data))
+        if request.method == 'HEAD':
+            return ''
+        return data
+
+
+def make_static_resource(resource_dir, max_age=None, memory_cache=None):
+    """
+    Return the root resource for a static resource folder.
+    """
+    resource = StaticFile(resource_dir)
+    if max_age is not None:
+        resource.max_age = max_age
+    resource.memory_cache = memory_cache
+    return resource
@@ -0,0 +1,143 @@
+
+#=======================================================================
+# Helpers for streaming proxied message bodies between the user agent
+# and the proxied service without holding them in memory.
+#=======================================================================
+
+# Standard library
+import time
+
+# External modules
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.web.client import FileBodyProducer, ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+
+class ResponseStreamer(Protocol):
+    """
+    Protocol that relays an upstream response body to a proxy request as
+    it arrives.
+
+    The upstream transport is registered as a streaming producer on the
+    proxy request, so a slow user agent pauses reads from the proxied
+    service rather than letting the body pile up in memory.
+    `finished` fires with `None` once the whole body has been written.
+
+    If a `ContentPipeline` is supplied, the body is passed through it on
+    the way to the user agent.  If a `RequestTimer` is supplied, the time
+    spent in the pipeline is recorded as the 'modify' phase.  If a 
+    recorder (e.g. an `httpcache.ResponseRecorder`) is supplied, it is given
+    the body as written and told when the whole body has been written.
+    """
+
+    def __init__(self, request, pipeline=None, timer=None, recorder=None):
+        self.request = request
+        self.pipeline = pipeline
+        self.timer = timer
+        self.recorder = recorder
+        self.modifyTime = 0.0
+        self.disconnected = False
+        self.finished = defer.Deferred(self._cancel)
+        request.notifyFinish().addErrback(self._requestLost)
+
+    def connectionMade(self):
+        self.request.registerProducer(self.transport, True)
+
+    def dataReceived(self, data):
+        if self.disconnected:
+            return
+        pipeline = self.pipeline
+        if pipeline is not None:
+            if self.timer is None:
+                data = pipeline.feed(data)
+            else:
+                start = time.time()
+                data = pipeline.feed(data)
+                self.modifyTime += time.time() - start
+        if data:
+            self.request.write(data)
+            if self.recorder is not None:
+                self.recorder.write(data)
+
+    def connectionLost(self, reason):
+        if not self.disconnected:
+            self.request.unregisterProducer()
+        finished = self.finished
+        if finished.called:
+            return
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            finished.errback(reason)
+            return
+        pipeline = self.pipeline
+        if pipeline is None or self.disconnected:
+            if not self.disconnected:
+                self._recorded()
+            finished.callback(None)
+            return
+        start = time.time()
+        d = pipeline.finish()
+        d.addCallback(self._writeTail, start)
+        d.chainDeferred(finished)
+
+    def _writeTail(self, data, start):
+        timer = self.timer
+        if timer is not None:
+            timer.add('modify', self.modifyTime + time.time() - start)
+        if self.disconnected:
+            return
+        if data:
+            self.request.write(data)
+            if self.recorder is not None:
+                self.recorder.write(data)
+        self._recorded()
+
+    def _recorded(self):
+        recorder = self.recorder
+        if recorder is not None:
+            self.recorder = None
+            recorder.finish()
+
+    def _requestLost(self, err):
+        """
+        The user agent went away; stop reading from the proxied service.
+        """
+        self.disconnected = True
+        self._stopUpstream()
+
+    def _cancel(self, d):
+        self._stopUpstream()
+
+    def _stopUpstream(self):
+        transport = self.transport
+        if transport is not None:
+            transport.stopProducing()
+
+def stream_response(response, request, pipeline=None, timer=None, recorder=None):
+    """
+    Write the body of `response` to `request` as it arrives, optionally
+    transformed by a `ContentPipeline` and copied to a recorder.
+    Return a deferred that fires when the body has been relayed.
+    """
+    streamer = ResponseStreamer(request, pipeline, timer, recorder)
+    response.deliverBody(streamer)
+    return streamer.finished
+
+def request_body_producer(request):
+    """
+    Return an `IBodyProducer` that streams the body of the proxy request to
+    the proxied service, or `None` if the request carries no body.
+
+    Twisted has already spooled the body to `request.content` (a temporary
+    file for large bodies), so it is read back in chunks from there.  The
+    producer reports the spooled size so the upstream request gets an
+    accurate Content-Length.
+    """
+    headers = request.requestHeaders
+    if not (headers.hasHeader('Content-Length') or headers.hasHeader('Transfer-Encoding')):
+        return None
+    content = request.content
+    if content is None:
+        return None
+    content.seek(0, 0)
+    return FileBodyProducer(content)
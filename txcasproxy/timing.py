@@ -0,0 +1,68 @@
+
+#=======================================================================
+# Per-phase timing of proxied requests.
+#=======================================================================
+
+# Standard library
+import binascii
+import os
+import re
+import time
+
+# Twisted canonicalizes header names this way.
+request_id_header = 'X-Request-Id'
+_is_valid_request_id = re.compile(r'^[A-Za-z0-9._:-]{1,200}$').match
+
+
+def request_id_for(request):
+    """
+    Return the request ID supplied by the user agent (or a load balancer in
+    front of the proxy) or generate a new one.
+    """
+    values = request.requestHeaders.getRawHeaders(request_id_header)
+    if values and _is_valid_request_id(values[0]):
+        return values[0]
+    return binascii.hexlify(os.urandom(16))
+
+
+class RequestTimer(object):
+    """
+    Record how long each phase of a proxied request takes.
+    A phase ends when it is marked; it began when the previous one ended.
+    """
+    __slots__ = ('request_id', 'start', 'last', 'phases')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = self.last = time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def add(self, phase, duration):
+        """
+        Record time spent in `phase` that overlaps other phases (e.g. content
+        modification while the body is written).
+        """
+        self.phases.append((phase, duration))
+
+    def server_timing(self):
+        """
+        Return the phases recorded so far as a Server-Timing header value.
+        """
+        return ', '.join(
+            '%s;dur=%.1f' % (phase, duration * 1000.0)
+            for phase, duration in self.phases)
+
+    def log_fields(self):
+        """
+        Return the phases and the total time as structured log fields.
+        """
+        fields = ["request_id='%s'" % self.request_id]
+        for phase, duration in self.phases:
+            fields.append("%s_ms=%.1f" % (phase, duration * 1000.0))
+        fields.append("total_ms=%.1f" % ((time.time() - self.start) * 1000.0))
+        return ' '.join(fields)
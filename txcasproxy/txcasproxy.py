@@ -1,33 +1,46 @@
 #! /usr/bin/env python
 
-import Cookie
 import cookielib
-import datetime
 import json
 import os.path
-import pprint
 import socket
+import time
 from urllib import urlencode
 import urlparse
 from ca_trust import CustomPolicyForHTTPS
 from interfaces import (
         IRProxyInfoAcceptor, 
-        IResponseContentModifier,
+        IResponseContentModifier, IStreamingContentModifier,
         ICASRedirectHandler, IResourceInterceptor,
         IStaticResourceProvider)
+from cache import LRUCache
+from metrics import ProxyMetrics
+from headers import (
+    DROP, REPLACE, SET, forwarded_header_rules, HeaderRewriter)
+from cookies import SetCookieRewriter
+from compression import content_coding
+from contentmod import (
+        as_streaming_modifier, media_type, ContentModifierIndex, ContentPipeline)
+from pools import make_connection_pool, warm_pool
 import proxyutils
-from dateutil.parser import parse as parse_date
+from sessionstore import MemorySessionStore
+from static import make_static_resource, StaticFileCache
+from lifecycle import ABSOLUTE_TIMEOUT, EVICTED
+from logger import logger
+from logout import LogoutDetector, LogoutQueue
+from matcher import PathMatcher, RouteIndex
+import streaming
+from timing import request_id_for, request_id_header, RequestTimer
 from klein import Klein
 from OpenSSL import crypto
 import treq
 from treq.client import HTTPClient
 from twisted.internet import defer, reactor
 from twisted.internet.ssl import Certificate
-from twisted.python import log
+from twisted.python.failure import Failure
 import twisted.web.client as twclient
 from twisted.web.client import BrowserLikePolicyForHTTPS, Agent
-from twisted.web.client import HTTPConnectionPool
-from twisted.web.static import File
+from twisted.web.iweb import UNKNOWN_LENGTH
 from lxml import etree
 
 
@@ -43,12 +56,29 @@ class ProxyApp(object):
     reactor = reactor
     authInfoResource = None
     authInfoCallback = None
+    validation_cache_ttl = 10
+    server_timing = False
+    timing_log = False
+    validation_cache_size = 10000
+    logged_out_ticket_ttl = 300
+    static_max_age = 86400
+    static_cache_size = 4194304
     
     def __init__(self, proxied_url, cas_info, 
             fqdn=None, authorities=None, plugins=None, is_https=True,
-            excluded_resources=None, excluded_branches=None):
+            excluded_resources=None, excluded_branches=None,
+            session_store=None, backend_pool_options=None, cas_pool_options=None,
+            excluded_globs=None, excluded_regexes=None, request_header_rules=None,
+            response_header_rules=None, forwarded_headers=True, response_cache=None,
+            compression=None, lifecycle=None, logout_resource=None,
+            logout_max_size=65536):
         self.excluded_resources = excluded_resources
         self.excluded_branches = excluded_branches
+        self.exclusions = PathMatcher(
+            resources=excluded_resources,
+            branches=excluded_branches,
+            globs=excluded_globs,
+            regexes=excluded_regexes)
         self.is_https = is_https
         if proxied_url.endswith('/'):
             proxied_url = proxied_url[:-1]
@@ -60,6 +90,9 @@ class ProxyApp(object):
         self.proxied_netloc = netloc
         self.proxied_host = netloc.split(':')[0]
         self.proxied_path = p.path
+        self.compression = compression
+        self._make_header_rewriters(
+            request_header_rules, response_header_rules, forwarded_headers)
         self.cas_info = cas_info
         cas_param_names = set([])
         cas_param_names.add(self.ticket_name.lower())
@@ -70,9 +103,36 @@ class ProxyApp(object):
         if fqdn is None:
             fqdn = socket.getfqdn()
         self.fqdn = fqdn
-        self.valid_sessions = {}
-        self.logout_tickets = {}
+        self.cookie_rewriter = SetCookieRewriter(self.proxied_path, self.proxied_host, fqdn)
+        self.url_mapper = self._make_url_mapper()
+        if session_store is None:
+            session_store = MemorySessionStore()
+        self.session_store = session_store
+        self._validations_in_flight = {}
+        self._validation_cache = LRUCache(self.validation_cache_size)
+        self._logged_out_tickets = LRUCache(self.validation_cache_size)
+        self.backend_pool_options = backend_pool_options or {}
+        self.cas_pool_options = cas_pool_options or {}
         self._make_agent(authorities)
+        metrics = ProxyMetrics()
+        metrics.watch_sessions(session_store)
+        metrics.watch_pools({
+            'backend': self.connectionPool,
+            'cas': self.casConnectionPool})
+        self.response_cache = response_cache
+        if response_cache is not None:
+            metrics.watch_response_cache(response_cache)
+        self.lifecycle = lifecycle
+        if lifecycle is not None:
+            metrics.watch_lifecycle(lifecycle)
+            lifecycle.expire_callbacks.append(self._lifecycle_ended)
+        self.metrics = metrics
+        self.logout_detector = LogoutDetector(
+            logout_resource=logout_resource,
+            max_size=logout_max_size,
+            skew=self.logout_instant_skew)
+        self.logout_queue = LogoutQueue(self._log_out_ticket)
+        self.logout_queue.reactor = self.reactor
         # Sort/tag plugins
         if plugins is None:
             plugins = []
@@ -81,8 +141,9 @@ class ProxyApp(object):
         cas_redirect_handlers = []
         interceptors = []
         for plugin in plugins:
-            if IResponseContentModifier.providedBy(plugin):
-                content_modifiers.append(plugin)
+            if IStreamingContentModifier.providedBy(plugin) or \
+                    IResponseContentModifier.providedBy(plugin):
+                content_modifiers.append(as_streaming_modifier(plugin))
             if IRProxyInfoAcceptor.providedBy(plugin):
                 info_acceptors.append(plugin)
             if ICASRedirectHandler.providedBy(plugin):
@@ -92,10 +153,25 @@ class ProxyApp(object):
         self.info_acceptors = info_acceptors
         content_modifiers.sort(key=lambda x: x.mod_sequence)
         self.content_modifiers = content_modifiers
+        self.content_modifier_index = ContentModifierIndex(content_modifiers)
         cas_redirect_handlers.sort(key=lambda x: x.cas_redirect_sequence)
         self.cas_redirect_handlers = cas_redirect_handlers
         interceptors.sort(key=lambda x: x.interceptor_sequence)
         self.interceptors = interceptors
+        # Interceptors that declare the resources they handle are found
+        # through the index.  Others are asked about every resource.
+        interceptor_index = RouteIndex()
+        routed_interceptors = set([])
+        for interceptor in interceptors:
+            paths = getattr(interceptor, 'intercepted_paths', None)
+            prefixes = getattr(interceptor, 'intercepted_prefixes', None)
+            if paths is None and prefixes is None:
+                interceptor_index.add(interceptor, prefixes=['/'])
+            else:
+                interceptor_index.add(interceptor, paths=paths, prefixes=prefixes)
+                routed_interceptors.add(interceptor)
+        self.interceptor_index = interceptor_index
+        self.routed_interceptors = routed_interceptors
         # Create static resources.
         static_resources = {}
         for plugin in plugins:
@@ -108,18 +184,40 @@ class ProxyApp(object):
                             plugin.static_resource_dir))
                 else:
                     static_resources[plugin.static_resource_base] = plugin.static_resource_dir
+        self.static_cache = StaticFileCache(self.static_cache_size)
         self.static_handlers = []
-        for n, (resource_base, resource_dir) in enumerate(static_resources.iteritems()):
-            handler = lambda self, request: File(resource_dir)
-            handler = self.app.route(resource_base, branch=True)(handler)
+        for resource_base, resource_dir in static_resources.iteritems():
+            # Each mount needs its own endpoint name, or Klein maps every
+            # mount to the last handler.
+            handler = self.app.route(
+                resource_base, 
+                branch=True, 
+                endpoint='static:' + resource_base)(self._make_static_handler(resource_dir))
             self.static_handlers.append(handler)
 
+    def _make_static_handler(self, resource_dir):
+        def serve_static(self, request):
+            return make_static_resource(
+                resource_dir, 
+                max_age=self.static_max_age, 
+                memory_cache=self.static_cache)
+        return serve_static
+
+    def _make_url_mapper(self):
+        if self.is_https:
+            scheme = 'https'
+        else:
+            scheme = 'http'
+        return proxyutils.URLMapper(scheme, self.fqdn, self.port, self.proxied_url)
+
     def handle_port_set(self):
         fqdn = self.fqdn
         port = self.port
         proxied_scheme = self.proxied_scheme
         proxied_netloc = self.proxied_netloc
         proxied_path = self.proxied_path
+        url_mapper = self._make_url_mapper()
+        self.url_mapper = url_mapper
         
         for plugin in self.info_acceptors:
             plugin.proxy_fqdn = fqdn
@@ -127,141 +225,130 @@ class ProxyApp(object):
             plugin.proxied_scheme = proxied_scheme
             plugin.proxied_netloc = proxied_netloc
             plugin.proxied_path = proxied_path
+            plugin.url_mapper = url_mapper
             plugin.handle_rproxy_info_set()
             plugin.expire_session = self._expired
 
     def _make_agent(self, auth_files):
-        self.connectionPool = HTTPConnectionPool(self.reactor)
-        if auth_files is None or len(auth_files) == 0:
-            self.agent = Agent(self.reactor, pool=self.connectionPool)
-        else:
-            extra_ca_certs = []
+        """
+        Create separate agents (and connection pools) for the proxied service
+        and for CAS, so slow ticket validations and bulk proxied traffic do 
+        not compete for the same connections.
+        """
+        self.connectionPool = make_connection_pool(self.reactor, self.backend_pool_options)
+        self.casConnectionPool = make_connection_pool(self.reactor, self.cas_pool_options)
+        extra_ca_certs = []
+        if auth_files is not None:
             for ca_cert in auth_files:
                 with open(ca_cert, "rb") as f:
                     data = f.read()
                 cert = crypto.load_certificate(crypto.FILETYPE_PEM, data)
                 del data
                 extra_ca_certs.append(cert)
-            
-            policy = CustomPolicyForHTTPS(extra_ca_certs)
-            agent = Agent(self.reactor, contextFactory=policy, pool=self.connectionPool)
-            self.agent = agent
+        # The policy caches TLS client contexts per netloc, so it is used
+        # even without extra trust roots.
+        policy = CustomPolicyForHTTPS(extra_ca_certs)
+        agent = Agent(self.reactor, contextFactory=policy, pool=self.connectionPool)
+        self.agent = agent
+        self.cas_agent = Agent(self.reactor, contextFactory=policy, pool=self.casConnectionPool)
+
+    def warm_up(self):
+        """
+        Pre-open the configured number of connections to the proxied service
+        and to CAS.  Return a deferred that fires when they are open.
+        """
+        def report(count, name):
+            logger.info("Pre-opened %d connection(s) to %s.", count, name)
+
+        warmups = []
+        count = self.backend_pool_options.get('warmup', 0)
+        if count > 0:
+            d = warm_pool(self.agent, self.proxied_url + '/', count)
+            d.addCallback(report, 'the proxied service')
+            warmups.append(d)
+        count = self.cas_pool_options.get('warmup', 0)
+        if count > 0:
+            d = warm_pool(self.cas_agent, self.cas_info['login_url'], count)
+            d.addCallback(report, 'CAS')
+            warmups.append(d)
+        return defer.gatherResults(warmups)
 
     def is_excluded(self, request):
-        resource = request.path
-        if resource in self.excluded_resources:
-            return True
-        for excluded in self.excluded_branches:
-            if proxyutils.is_resource_or_child(excluded, resource):
-                return True
-        return False
+        return self.exclusions.match(request.path, request.method)
 
-    def mod_headers(self, h):
-        keymap = {}
-        for k,v in h.iteritems():
-            key = k.lower()
-            if key in keymap:
-                keymap[key].append(k)
-            else:
-                keymap[key] = [k]
-                
-        if 'host' in keymap:
-            for k in keymap['host']:
-                h[k] = [self.proxied_netloc]
-        if 'origin' in keymap:
-            for k in keymap['origin']:
-                h[k] = [self.proxied_netloc]
-        if 'content-length' in keymap:
-            for k in keymap['content-length']:
-                del h[k]
-                
-        if 'referer' in keymap:
-            for k in keymap['referer']:
-                del h[k]
-        if False:
-            keys = keymap['referer']
-            if len(keys) == 1:
-                k = keys[0]
-                values = h[k]
-                if len(values) == 1:
-                    referer = values[0]
-                    new_referer = self.proxy_url_to_proxied_url(referer)
-                    if new_referer is not None:
-                        h[k] = [new_referer]
-                        log.msg("[DEBUG] Re-wrote Referer header: '%s' => '%s'" % (referer, new_referer))
-        return h
+    def _make_header_rewriters(self, request_rules, response_rules, forwarded_headers):
+        """
+        Compile the header rewriting rules for requests to the proxied service
+        and for its responses.  Rules from the command line override the
+        defaults.
+        """
+        proxied_netloc = self.proxied_netloc
+        rules = [
+            (REPLACE, 'Host', proxied_netloc),
+            (REPLACE, 'Origin', proxied_netloc),
+            (DROP, 'Content-Length', None),
+            (REPLACE, 'Referer', self._proxied_referer),
+            # Only the proxy asserts who the user is.
+            (DROP, 'REMOTE_USER', None),
+            (DROP, 'Remote-User', None),
+        ]
+        if forwarded_headers:
+            rules.extend(forwarded_header_rules())
+        if self.compression is not None:
+            # Ask for what the proxy can decode, whatever the user agent
+            # accepts.
+            rules.append((SET, 'Accept-Encoding', self.compression.upstream_accept_encoding))
+        rules.extend(request_rules or ())
+        self.request_headers = HeaderRewriter(rules)
+        self.response_headers = HeaderRewriter(response_rules or ())
 
-    def _check_for_logout(self, request):
-        data = request.content.read()
-        samlp_ns = "{urn:oasis:names:tc:SAML:2.0:protocol}"
-        try:
-            root = etree.fromstring(data)
-        except Exception as ex:
-            log.msg("[DEBUG] Not XML.\n%s" % str(ex))
-            root = None
-        if (root is not None) and (root.tag == "%sLogoutRequest" % samlp_ns):
-            instant = root.get('IssueInstant')
-            if instant is not None:
-                log.msg("[DEBUG] instant string == '%s'" % instant)
-                try:
-                    instant = parse_date(instant)
-                except ValueError:
-                    log.msg("[WARN] Odd issue_instant supplied: '%s'." % instant)
-                    instant = None
-                if instant is not None:
-                    utcnow = datetime.datetime.utcnow()
-                    log.msg("[DEBUG] UTC now == %s" % utcnow.strftime("%Y-%m-%dT%H:%M:%S"))
-                    seconds = abs((utcnow - instant.replace(tzinfo=None)).total_seconds())
-                    if seconds <= self.logout_instant_skew:
-                        results = root.findall("%sSessionIndex" % samlp_ns)
-                        if len(results) == 1:
-                            result = results[0]
-                            ticket = result.text
-                            log.msg("[INFO] Received request to logout session with ticket '%s'." % ticket)
-                            sess_uid = self.logout_tickets.get(ticket, None)
-                            if sess_uid is not None:
-                                self._expired(sess_uid)
-                                return True
-                            else:
-                                log.msg("[WARN] No matching session for logout request for ticket '%s'." % ticket)
-                    else:
-                        log.msg("[DEBUG] Issue instant was not within %d seconds of actual time." % self.logout_instant_skew)
-                else:
-                    log.msg("[DEBUG] Could not parse issue instant.")
-            else:
-                log.msg("[DEBUG] 'IssueInstant' attribute missing from root.")
-        elif root is None:
-            log.msg("[DEBUG] Could not parse XML.")
-        else:
-            log.msg("[DEBUG] root.tag == '%s'" % root.tag)
-            
-        return False
+    def _proxied_referer(self, request):
+        """
+        Return the proxied URL for a Referer on the proxy (other referers
+        are passed on unchanged).
+        """
+        referer = request.getHeader('referer')
+        if referer is None:
+            return None
+        return self.url_mapper.proxy_url_to_proxied_url(referer)
+
+    def _log_out_ticket(self, ticket):
+        """
+        End the sessions established with service ticket `ticket`.
+        """
+        logger.info("Received request to logout session with ticket '%s'.", ticket)
+        # A cached or in-progress validation of this ticket must not log
+        # the user back in.
+        self._logged_out_tickets.set(ticket, True, self.logged_out_ticket_ttl)
+        sess_uids = self.session_store.uids_for_ticket(ticket)
+        if len(sess_uids) == 0:
+            logger.warn("No matching session for logout request for ticket '%s'.", ticket)
+            return
+        for sess_uid in sess_uids:
+            self._expired(sess_uid)
+        self.metrics.single_logouts.inc()
 
     @app.route("/", branch=True)
     def proxy(self, request):
+        timer = self.make_timer(request)
         if self.is_excluded(request):
-            return self.reverse_proxy(request, protected=False)
-        valid_sessions = self.valid_sessions
+            return self.reverse_proxy(request, protected=False, timer=timer)
+        session_store = self.session_store
         sess = request.getSession()
         sess_uid = sess.uid
-        if not sess_uid in valid_sessions:
-            log.msg("[DEBUG] session {0} not in valid sessions.  Will authenticate with CAS.".format(sess_uid))
+        session_info = session_store.get(sess_uid)
+        if timer is not None:
+            timer.mark('session')
+        if session_info is None:
+            logger.debug("session %s not in valid sessions.  Will authenticate with CAS.", sess_uid)
             if request.method == 'POST':
-                headers = request.requestHeaders
-                if headers.hasHeader("Content-Type"):
-                    ct_list =  headers.getRawHeaders("Content-Type") 
-                    log.msg("[DEBUG] ct_list: %s" % str(ct_list))
-                    for ct in ct_list:
-                        if ct.find('text/xml') != -1 or ct.find('application/xml') != -1:
-                            if self._check_for_logout(request):
-                                return ""
-                            else:
-                                # If reading the body failed the first time, it won't succeed later!
-                                log.msg("[DEBUG] _check_for_logout() returned failure.")
-                                break
-                else:
-                    log.msg("[DEBUG] No content-type.")
-                            
+                ticket = self.logout_detector.ticket_to_log_out(request)
+                if ticket is not None:
+                    if not self.logout_queue.put(ticket):
+                        logger.warn("Logout queue full; dropped logout for ticket '%s'.", ticket)
+                        request.setResponseCode(503)
+                    return ""
+
             # CAS Authentication
             # Does this request have a ticket?  I.e. is it coming back from a successful
             # CAS authentication?
@@ -278,18 +365,23 @@ class ProxyApp(object):
             d = self.redirect_to_cas_login(request)
             return d
         elif request.path == self.authInfoResource:
-            log.msg("[DEBUG] Providing authentication info.")
-            return self.deliver_auth_info(request)
+            logger.debug("Providing authentication info.")
+            return self.deliver_auth_info(request, session_info)
         else:
-            log.msg("[DEBUG] session {0} is in valid sessions.".format(sess_uid))
-            d = self.reverse_proxy(request)
+            logger.debug("session %s is in valid sessions.", sess_uid)
+            session_store.touch(sess_uid)
+            d = self.reverse_proxy(request, session_info=session_info, timer=timer)
             return d
 
-    def deliver_auth_info(self, request):
-        valid_sessions = self.valid_sessions
-        sess = request.getSession()    
-        sess_uid = sess.uid
-        session_info = valid_sessions[sess_uid]
+    def make_timer(self, request):
+        """
+        Return a `RequestTimer` for `request` if request timing is enabled.
+        """
+        if self.server_timing or self.timing_log:
+            return RequestTimer(request_id_for(request))
+        return None
+
+    def deliver_auth_info(self, request, session_info):
         username = session_info['username']
         attributes = session_info['attributes']
         doc = {'username': username, 'attributes': attributes}
@@ -298,25 +390,13 @@ class ProxyApp(object):
         return serialized 
         
     def get_url(self, request):
-        if self.is_https:
-            scheme = 'https'
-            default_port = 443
-        else:
-            scheme = 'http'
-            default_port = 80
-        fqdn = self.fqdn
-        port = self.port
-        if port is None:
-            port = default_port
-        if port == default_port:
-            return urlparse.urljoin("%s://%s" % (scheme, fqdn), request.uri)
-        else:
-            return urlparse.urljoin("%s://%s:%d" % (scheme, fqdn, port), request.uri)
+        return self.url_mapper.proxy_url(request.uri)
         
     def redirect_to_cas_login(self, request):
         """
         Begin the CAS redirection process.
         """        
+        self.metrics.cas_redirects.inc()
         service_url = self.get_url(request)
         d = None
         for plugin in self.cas_redirect_handlers:
@@ -374,26 +454,81 @@ class ProxyApp(object):
         p = urlparse.ParseResult(*tuple(p[:4] + (param_str,) + p[5:]))
         service_validate_url = urlparse.urlunparse(p)
         
-        log.msg("[INFO] requesting URL '%s' ..." % service_validate_url)
-        http_client = HTTPClient(self.agent) 
-        d = http_client.get(service_validate_url)
-        d.addCallback(treq.content)
-        d.addCallback(self.parse_sv_results, service_url, ticket, request)
+        # A browser that retries or double-submits the ticket URL shares the
+        # validation already in progress (or just completed) rather than 
+        # replaying the ticket, which CAS would reject.
+        key = (ticket, service_url, request.getClientIP())
+        result = self._validation_cache.get(key)
+        if result is not None:
+            logger.debug("Using cached validation of ticket '%s'.", ticket)
+            return self.complete_validation(result, service_url, ticket, request)
+        d = self._fetch_validation(key, service_validate_url)
+        d.addCallback(self.complete_validation, service_url, ticket, request)
+        return d
+
+    def _fetch_validation(self, key, service_validate_url):
+        """
+        Return a deferred that fires with the parsed results of validating a
+        ticket.  Concurrent validations with the same `key` share a single
+        request to CAS.
+        """
+        d = defer.Deferred()
+        in_flight = self._validations_in_flight
+        waiters = in_flight.get(key, None)
+        if waiters is not None:
+            logger.debug("Joining validation in progress for ticket '%s'.", key[0])
+            waiters.append(d)
+            return d
+        in_flight[key] = [d]
+        logger.info("requesting URL '%s' ...", service_validate_url)
+        metrics = self.metrics
+        metrics.pool_active_requests.inc(('cas',))
+        start = time.time()
+        http_client = HTTPClient(self.cas_agent) 
+        request_d = http_client.get(service_validate_url)
+        request_d.addCallback(treq.content)
+        request_d.addCallback(self.parse_sv_results)
+
+        def notify_waiters(result):
+            waiters = in_flight.pop(key)
+            failed = isinstance(result, Failure)
+            metrics.pool_active_requests.dec(('cas',))
+            metrics.cas_validation_latency.observe(time.time() - start)
+            if failed:
+                metrics.cas_validation_failures.inc(('error',))
+            elif result is None:
+                metrics.cas_validation_failures.inc(('rejected',))
+            if not failed and result is not None and self.validation_cache_ttl > 0:
+                self._validation_cache.set(key, result, self.validation_cache_ttl)
+            for waiter in waiters:
+                # Waiters are cancelled when their user agent disconnects.
+                if waiter.called:
+                    continue
+                if failed:
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        request_d.addBoth(notify_waiters)
         return d
         
-    def parse_sv_results(self, payload, service_url, ticket, request):
-        log.msg("[INFO] Parsing /serviceValidate results  ...")
+    def parse_sv_results(self, payload):
+        """
+        Parse /serviceValidate results.  Return `(username, attributes)` for
+        a successful validation or None.
+        """
+        logger.debug("Parsing /serviceValidate results  ...")
         ns = self.ns
         root = etree.fromstring(payload)
         if root.tag != ('%sserviceResponse' % ns):
-            return request.redirect(service_url)
+            return None
         results = root.findall("%sauthenticationSuccess" % ns)
         if len(results) != 1:
-            return request.redirect(service_url)
+            return None
         success = results[0]
         results = success.findall("%suser" % ns)
         if len(results) != 1:
-            return request.redirect(service_url)
+            return None
         user = results[0]
         username = user.text
         attributes = success.findall("{0}attributes".format(ns))
@@ -403,167 +538,249 @@ class ProxyApp(object):
                 tag_name = elm.tag[len(ns):]
                 value = elm.text
                 attrib_map.setdefault(tag_name, []).append(value)
+        return (username, attrib_map)
+
+    def complete_validation(self, result, service_url, ticket, request):
+        """
+        Establish an authenticated session for a successful validation, then
+        redirect the user agent to the service URL.
+        """
+        if result is None:
+            return request.redirect(service_url)
+        if self._logged_out_tickets.get(ticket) is not None:
+            logger.info("Ticket '%s' has been logged out; not establishing a session.", ticket)
+            return request.redirect(service_url)
+        username, attrib_map = result
         # Update session session
-        valid_sessions = self.valid_sessions
-        logout_tickets = self.logout_tickets
         sess = request.getSession()
         sess_uid = sess.uid
-        if sess_uid not in valid_sessions:
-            valid_sessions[sess_uid] = {}
-        valid_sessions[sess_uid].update({
-            'username': username,
-            'ticket': ticket,
-            'attributes': attrib_map})
-        if not ticket in logout_tickets:
-            logout_tickets[ticket] = sess_uid
+        self.session_store.add(sess_uid, username, ticket, attrib_map)
+        if self.lifecycle is not None:
+            self.lifecycle.authenticated(sess_uid)
         authInfoCallback = self.authInfoCallback
         if authInfoCallback is not None: 
             authInfoCallback(username, attrib_map)
-        sess.notifyOnExpire(lambda: self._expired(sess_uid))
+        sess.notifyOnExpire(lambda: self._session_timed_out(sess_uid))
         # Reverse proxy.
         return request.redirect(service_url)
         
     def _expired(self, uid):
-        valid_sessions = self.valid_sessions
-        if uid in valid_sessions:
-            session_info = valid_sessions[uid]
-            username = session_info['username']
-            ticket = session_info['ticket']
-            del valid_sessions[uid]
-            authInfoCallback = self.authInfoCallback
-            if authInfoCallback is not None:
-                authInfoCallback(username, None)
-            logout_tickets = self.logout_tickets
-            if ticket in logout_tickets:
-                del logout_tickets[ticket]
-            log.msg("[INFO] label='Expired session.' session_id='%s' username='%s'" % (uid, username))
-        
+        session_info = self.session_store.remove(uid)
+        if session_info is not None:
+            if self.lifecycle is not None:
+                self.lifecycle.logged_out(uid)
+            self._session_removed(uid, session_info)
+
+    def _session_removed(self, uid, session_info):
+        username = session_info['username']
+        authInfoCallback = self.authInfoCallback
+        if authInfoCallback is not None:
+            authInfoCallback(username, None)
+        logger.info("label='Expired session.' session_id='%s' username='%s'", uid, username)
+
+    def _session_timed_out(self, uid):
+        """
+        The web session for `uid` timed out in this process.
+        """
+        # Other processes sharing the store may still be serving this
+        # session.  Shared stores expire idle sessions themselves.
+        if not self.session_store.shared:
+            self._expired(uid)
+
+    def _lifecycle_ended(self, uid, reason):
+        """
+        The session lifecycle ended web session `uid`.
+        """
+        self.metrics.session_expirations.inc((reason,))
+        # Other processes sharing the store may still be serving an idle
+        # session; this process just lets go of its web session.  A session
+        # past its maximum lifetime or evicted is over everywhere.
+        if self.session_store.shared and reason not in (ABSOLUTE_TIMEOUT, EVICTED):
+            return
+        session_info = self.session_store.remove(uid)
+        if session_info is not None:
+            self._session_removed(uid, session_info)
+
+    def purge_sessions(self):
+        """
+        Purge sessions that the session store has expired.
+        """
+        lifecycle = self.lifecycle
+        for uid, session_info in self.session_store.purge_expired():
+            if lifecycle is not None:
+                lifecycle.logged_out(uid)
+            self._session_removed(uid, session_info)
         
-    def reverse_proxy(self, request, protected=True):
+    def reverse_proxy(self, request, protected=True, session_info=None, timer=None):
         if protected:
-            sess = request.getSession()
-            valid_sessions = self.valid_sessions
-            sess_uid = sess.uid
-            username = valid_sessions[sess_uid]['username']
+            if session_info is None:
+                sess = request.getSession()
+                session_info = self.session_store.get(sess.uid)
+            username = session_info['username']
+            response_cache = None
+        else:
+            response_cache = self.response_cache
+            if response_cache is not None:
+                entry = response_cache.lookup(request)
+                if entry is not None:
+                    body = response_cache.serve(entry, request)
+                    if request.code == 304:
+                        self.metrics.response_cache_requests.inc(('not_modified',))
+                    else:
+                        self.metrics.response_cache_requests.inc(('hit',))
+                    return body
+                self.metrics.response_cache_requests.inc(('miss',))
         # Normal reverse proxying.
         kwds = {}
         #cookiejar = cookielib.CookieJar()
         cookiejar = {}
         kwds['allow_redirects'] = False
         kwds['cookies'] = cookiejar
-        req_headers = self.mod_headers(dict(request.requestHeaders.getAllRawHeaders()))
+        req_headers = self.request_headers.rewrite(
+            request.requestHeaders.getAllRawHeaders(), request)
         kwds['headers'] = req_headers
         if protected:
-            kwds['headers']['REMOTE_USER'] = [username]
-        #print "** HEADERS **"
-        #pprint.pprint(self.mod_headers(dict(request.requestHeaders.getAllRawHeaders())))
-        #print
-        if request.method in ('PUT', 'POST'):
-            kwds['data'] = request.content.read()
+            req_headers['remote_user'] = [username]
+        if timer is not None:
+            request_id = timer.request_id
+        else:
+            request_id = request_id_for(request)
+        req_headers[request_id_header.lower()] = [request_id]
+        body = streaming.request_body_producer(request)
+        if body is not None:
+            kwds['data'] = body
         #print "request.method", request.method
         #print "url", self.proxied_url + request.uri
         #print "kwds:"
         #pprint.pprint(kwds)
         #print
-        url = self.proxied_url + request.uri
+        url = proxyutils.ProxiedURL(
+            self.proxied_url + request.uri, 
+            self.proxied_path + request.path)
         
         # Determine if a plugin wants to intercept this URL.
-        interceptors = self.interceptors
-        for interceptor in interceptors:
-            if interceptor.should_resource_be_intercepted(url, request.method, req_headers, request):
+        routed_interceptors = self.routed_interceptors
+        for interceptor in self.interceptor_index.lookup(url.path):
+            if interceptor in routed_interceptors or \
+                    interceptor.should_resource_be_intercepted(url, request.method, req_headers, request):
                 return interceptor.handle_resource(url, request.method, req_headers, request)
-        log.msg("[INFO] Proxying URL: %s" % url)
+        if timer is not None:
+            timer.mark('intercept')
+        logger.debug("Proxying URL: %s", url)
+        metrics = self.metrics
+        metrics.upstream_in_flight.inc()
+        metrics.pool_active_requests.inc(('backend',))
+        start = time.time()
         http_client = HTTPClient(self.agent) 
         d = http_client.request(request.method, url, **kwds)
         #print "** Requesting %s %s" % (request.method, self.proxied_url + request.uri)
         def process_response(response, request):
+            if timer is not None:
+                timer.mark('upstream')
+            metrics.upstream_latency.observe(time.time() - start)
+            metrics.proxied_requests.inc((response.code,))
             req_resp_headers = request.responseHeaders
             resp_code = response.code
             resp_headers = response.headers
-            resp_header_map = dict(resp_headers.getAllRawHeaders())
+            resp_header_map = self.response_headers.rewrite(
+                resp_headers.getAllRawHeaders(), request)
             # Rewrite Location headers for redirects as required.
-            if resp_code in (301, 302, 303, 307, 308) and "Location" in resp_header_map:
-                values = resp_header_map["Location"]
+            if resp_code in (301, 302, 303, 307, 308) and 'location' in resp_header_map:
+                values = resp_header_map['location']
                 if len(values) == 1:
                     location = values[0]
-                    if request.isSecure():
-                        proxy_scheme = 'https'
-                    else:
-                        proxy_scheme = 'http'
-                    new_location = self.proxied_url_to_proxy_url(proxy_scheme, location)
+                    new_location = self.url_mapper.proxied_url_to_proxy_url(location)
                     if new_location is not None:
-                        resp_header_map['Location'] = [new_location]
-                        log.msg("[DEBUG] Re-wrote Location header: '%s' => '%s'" % (location, new_location))
+                        resp_header_map['location'] = [new_location]
+                        logger.debug("Re-wrote Location header: '%s' => '%s'", location, new_location)
             request.setResponseCode(response.code, message=response.phrase)
             for k,v in resp_header_map.iteritems():
-                if k == 'Set-Cookie':
+                if k == 'set-cookie':
                     v = self.mod_cookies(v)
-                print("Browser Response >>> Setting response header: %s: %s" % (k, v))
+                logger.debug("Browser Response >>> Setting response header: %s: %s", k, v)
                 req_resp_headers.setRawHeaders(k, v)
+            req_resp_headers.setRawHeaders(request_id_header, [request_id])
+            if timer is not None:
+                timer.mark('headers')
+                if self.server_timing:
+                    req_resp_headers.setRawHeaders('Server-Timing', [timer.server_timing()])
             return response
-            
-        def show_cookies(resp):
-            jar = resp.cookies()
-            print("Cookie Jar:")
-            pprint.pprint(cookiejar)
-            print("")
-            return resp
-            
-        def mod_content(body, request):
+
+        def deliver_body(response, request):
             """
-            Modify response content before returning it to the user agent.
+            Relay the response body to the user agent, passing it through
+            the content modifiers that want to see it, decoded if need be,
+            and compressing it for the user agent.
             """
-            d = None
-            for content_modifier in self.content_modifiers:
-                if d is None:
-                    d = content_modifier.transform_content(body, request)
-                else:
-                    d.addCallback(content_modifier.transform_content, request)
-            if d is None:
-                return body
-            else:
-                return d
+            pipeline = self.make_content_pipeline(response, request)
+            if self.compression is not None:
+                pipeline = self.compression.apply(request, response, pipeline)
+            if pipeline is None:
+                length = response.length
+                if length is not UNKNOWN_LENGTH and response.code not in (204, 304) \
+                        and request.method != 'HEAD':
+                    request.responseHeaders.setRawHeaders('Content-Length', [str(length)])
+            recorder = None
+            if response_cache is not None:
+                recorder = response_cache.recorder(request, response)
+            return streaming.stream_response(response, request, pipeline, timer, recorder)
+
+        def request_done(result):
+            metrics.upstream_in_flight.dec()
+            metrics.pool_active_requests.dec(('backend',))
+            if timer is not None and self.timing_log:
+                timer.mark('body')
+                logger.info("label='Request timing.' method='%s' uri='%s' status=%d %s",
+                    request.method, request.uri, request.code, timer.log_fields())
+            return result
+
+        def request_failed(err):
+            metrics.proxied_requests.inc(('error',))
+            return err
             
-        d.addCallback(show_cookies)
-        d.addCallback(process_response, request)
-        d.addCallback(treq.content)
-        d.addCallback(mod_content, request)
+        d.addCallbacks(process_response, request_failed, callbackArgs=(request,))
+        d.addCallback(deliver_body, request)
+        d.addBoth(request_done)
         return d
+
+    def make_content_pipeline(self, response, request):
+        """
+        Return a `ContentPipeline` made up of the transformers that the 
+        content modifiers (in `mod_sequence` order) want to apply to the 
+        body of `response`, or None if the body can be relayed as is.
+        Only modifiers whose declared scope covers the response are asked.
+        Whole-body modifiers buffer the content that passes through them.
+        """
+        index = self.content_modifier_index
+        if len(index) == 0:
+            return None
+        length = response.length
+        if length is UNKNOWN_LENGTH or content_coding(response.headers) is not None:
+            # The length of encoded content says little about the decoded size.
+            length = None
+        content_modifiers = index.select(
+            self.proxied_path + request.path,
+            media_type(response.headers),
+            length)
+        if len(content_modifiers) == 0:
+            return None
+        transformers = []
+        for content_modifier in content_modifiers:
+            transformer = content_modifier.begin_transform(request, response)
+            if transformer is not None:
+                transformers.append(transformer)
+        if len(transformers) == 0:
+            return None
+        return ContentPipeline(transformers)
     
     def mod_cookies(self, value_list):
-        proxied_path = self.proxied_path
-        proxied_path_size = len(proxied_path)
-        results = []
-        for cookie_value in value_list:
-            c = Cookie.SimpleCookie()
-            c.load(cookie_value)
-            for k in c.keys():
-                m = c[k]
-                if m.has_key('path'):
-                    m_path = m['path']
-                    if self.is_proxy_path_or_child(m_path):
-                        m_path = m_path[proxied_path_size:]
-                        m['path'] = m_path
-            results.append(c.output(header='')[1:])
-        return results
+        return self.cookie_rewriter.rewrite_all(value_list)
                      
     def is_proxy_path_or_child(self, path):
         return proxyutils.is_proxy_path_or_child(self.proxied_path, path)
     
     def proxied_url_to_proxy_url(self, proxy_scheme, target_url):
-        return proxyutils.proxied_url_to_proxy_url(
-            proxy_scheme,
-            self.fqdn, 
-            self.port, 
-            self.proxied_netloc, 
-            self.proxied_path, 
-            target_url)
+        return self.url_mapper.proxied_url_to_proxy_url(target_url)
         
     def proxy_url_to_proxied_url(self, target_url):
-        return proxyutils.proxy_url_to_proxied_url(
-            self.proxied_scheme,
-            self.fqdn, 
-            self.port, 
-            self.proxied_netloc,
-            self.proxied_path,
-            target_url)
+        return self.url_mapper.proxy_url_to_proxied_url(target_url)
@@ -0,0 +1,208 @@
+
+#=======================================================================
+# Multi-process worker mode.
+#
+# A supervisor creates the listening socket once and starts N worker
+# processes that inherit it.  Each worker runs its own reactor,
+# `ProxyApp` and connection pool and accepts connections from the shared
+# socket.  Workers that exit are restarted.
+#=======================================================================
+
+# Standard library
+import os
+import socket
+import sys
+
+# Application modules
+from logger import logger
+
+# External modules
+from twisted.application.service import Service
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import (
+    serverFromString,
+    SSL4ServerEndpoint,
+    TCP4ServerEndpoint,
+    TCP6ServerEndpoint)
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.python import usage
+
+# The file descriptor the listening socket has in worker processes.
+WORKER_FD = 3
+
+
+def parse_listening_endpoint(endpoint_s):
+    """
+    Return `(endpoint, address_family)` for a TCP or SSL server endpoint
+    string.  Worker mode can only share stream sockets.
+    """
+    endpoint = serverFromString(reactor, endpoint_s)
+    if isinstance(endpoint, TCP6ServerEndpoint):
+        return endpoint, socket.AF_INET6
+    if isinstance(endpoint, (TCP4ServerEndpoint, SSL4ServerEndpoint)):
+        return endpoint, socket.AF_INET
+    raise ValueError(
+        "Worker mode requires a 'tcp:', 'tcp6:' or 'ssl:' endpoint, not '{0}'.".format(
+            endpoint_s))
+
+def create_listening_socket(endpoint_s):
+    """
+    Create, bind and listen on the socket described by `endpoint_s`.
+    """
+    endpoint, family = parse_listening_endpoint(endpoint_s)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((endpoint._interface, endpoint._port))
+    sock.listen(endpoint._backlog)
+    sock.setblocking(False)
+    return sock
+
+def adopt_listening_socket(endpoint_s, fd, factory):
+    """
+    Accept connections for `factory` on the inherited listening socket `fd`.
+    The socket is wrapped in TLS if `endpoint_s` is an 'ssl:' endpoint.
+    Return the listening port.
+    """
+    endpoint, family = parse_listening_endpoint(endpoint_s)
+    if isinstance(endpoint, SSL4ServerEndpoint):
+        factory = TLSMemoryBIOFactory(endpoint._sslContextFactory, False, factory)
+    port = reactor.adoptStreamPort(fd, family, factory)
+    # The reactor has its own copy of the descriptor.
+    os.close(fd)
+    return port
+
+def worker_argv(argv, fd=WORKER_FD, tapname='casproxy'):
+    """
+    Build the command line for a worker from the supervisor's `twistd`
+    command line, in which the plugin is named `tapname`.  Workers run in
+    the foreground without a PID file and serve the socket they inherit
+    as `fd`.
+    """
+    args = list(argv[1:])
+    try:
+        index = args.index(tapname)
+    except ValueError:
+        raise usage.UsageError(
+            "Worker mode must be started as 'twistd [options] {0} [options]'; "
+            "'{0}' is not on the command line: {1}".format(tapname, ' '.join(argv)))
+    twistd_args = args[:index] + ['--nodaemon', '--pidfile=']
+    plugin_args = []
+    skip = False
+    for arg in args[index + 1:]:
+        if skip:
+            skip = False
+            continue
+        if arg == '--workers':
+            skip = True
+            continue
+        if arg.startswith('--workers='):
+            continue
+        plugin_args.append(arg)
+    plugin_args.append('--worker-fd={0}'.format(fd))
+    return twistd_args + [tapname] + plugin_args
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerSupervisorService(Service):
+    """
+    Run `workers` proxy processes that share one listening socket.
+    """
+    restartDelay = 1.0
+    maxRestartDelay = 30.0
+    quickExit = 5.0
+    stopTimeout = 10.0
+
+    def __init__(self, endpoint_s, workers, argv=None, tapname='casproxy'):
+        self.endpoint_s = endpoint_s
+        self.workers = workers
+        if argv is None:
+            argv = sys.argv
+        self.args = worker_argv(argv, tapname=tapname)
+        self.processes = {}
+        self.delays = {}
+        self.started = {}
+        self.socket = None
+
+    def startService(self):
+        Service.startService(self)
+        self.socket = create_listening_socket(self.endpoint_s)
+        for worker_id in range(self.workers):
+            self.spawn_worker(worker_id)
+
+    def spawn_worker(self, worker_id):
+        if not self.running:
+            return
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        protocol = WorkerProcessProtocol(self, worker_id)
+        args = [
+            sys.executable,
+            '-c',
+            'from twisted.scripts.twistd import run; run()'] + self.args
+        reactor.spawnProcess(
+            protocol,
+            sys.executable,
+            args,
+            env=env,
+            childFDs={0: 0, 1: 1, 2: 2, WORKER_FD: self.socket.fileno()})
+        self.processes[worker_id] = protocol
+        self.started[worker_id] = reactor.seconds()
+        logger.info("Started worker %d (pid %d).", worker_id, protocol.transport.pid)
+
+    def worker_ended(self, protocol, reason):
+        worker_id = protocol.worker_id
+        if self.processes.get(worker_id) is protocol:
+            del self.processes[worker_id]
+        if not self.running:
+            return
+        logger.warn("Worker %d exited: %s", worker_id, reason.getErrorMessage())
+        # Back off if the worker keeps dying right after it starts.
+        delay = self.delays.get(worker_id, self.restartDelay)
+        if reactor.seconds() - self.started.get(worker_id, 0) < self.quickExit:
+            self.delays[worker_id] = min(delay * 2, self.maxRestartDelay)
+        else:
+            delay = self.restartDelay
+            self.delays[worker_id] = delay
+        reactor.callLater(delay, self.spawn_worker, worker_id)
+
+    def stopService(self):
+        Service.stopService(self)
+        ended = []
+        for protocol in self.processes.values():
+            ended.append(protocol.ended)
+            try:
+                protocol.transport.signalProcess('TERM')
+            except Exception:
+                pass
+        d = defer.DeferredList(ended)
+        killCall = reactor.callLater(self.stopTimeout, self._kill_workers)
+
+        def cleanup(result):
+            if killCall.active():
+                killCall.cancel()
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+            return result
+
+        d.addBoth(cleanup)
+        return d
+
+    def _kill_workers(self):
+        for protocol in self.processes.values():
+            try:
+                protocol.transport.signalProcess('KILL')
+            except Exception:
+                pass